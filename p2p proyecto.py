@@ -1,3013 +1,10719 @@
 
 
+import argparse
+
+import asyncio
+
+import base64
+
 import http.server
 
+import io
+
+import mmap
+
+import multiprocessing
+
+import select
+
+import signal
+
+import socket
+
+import string
+
+import struct
+
 import socketserver
 
 import sqlite3
 
 import hashlib
 
+import hmac
+
+import secrets
+
+import gzip
+
+import zlib
+
 import json
 
 import datetime
 
+import math
+
 import threading
 
 import webbrowser
 
 import random
 
+import re
+
 import time
 
 import os
 
-from urllib.parse import parse_qs, urlparse
+import sys
 
-from typing import List, Dict, Optional
+import platform
 
-from dataclasses import dataclass
+import queue
 
-from enum import Enum
+import bisect
 
+import heapq
 
+import itertools
 
-# Configuración
+import dataclasses
 
-PORT = 8000
+from collections import OrderedDict, deque
 
-DB_NAME = "p2p_trading.db"
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+from contextlib import contextmanager, redirect_stdout
 
+from urllib.parse import parse_qs, urlencode, urlparse
 
-# Datos para generación aleatoria
+from typing import List, Dict, Optional, Tuple
 
-RANDOM_NAMES = [
+from dataclasses import dataclass
 
-    "CryptoMaster", "BitcoinPro", "ElonMusk", "SatoshiNakamoto", "DigitalTrader",
+from enum import Enum
 
-    "BlockchainKing", "CryptoWhale", "TradingExpert", "Web3Enthusiast", "DeFiMaster"
 
-]
 
+try:
 
+    import orjson  # opcional: serialización JSON más rápida para la API
 
-RANDOM_PAYMENT_METHODS = [
+except ImportError:
 
-    ["Bank Transfer", "PayPal"],
+    orjson = None
 
-    ["Bank Transfer", "Wise", "Revolut"],
 
-    ["PayPal", "Credit Card"],
 
-    ["Bank Transfer", "Cash Deposit"],
+# Configuración
 
-    ["Wise", "PayPal", "Bank Transfer"]
+PORT = 8000
 
-]
+DB_NAME = "p2p_trading.db"
 
 
 
-ASSETS = ["USDT", "BTC", "ETH"]
+# Servidor HTTP: "single" atiende una petición a la vez, "threaded" usa un pool
 
-FIATS = ["USD", "EUR"]
+# de hilos y "asyncio" mantiene las conexiones en un bucle de eventos y manda
 
+# el trabajo bloqueante a un executor; "prefork" arranca N procesos "threaded"
 
+# que comparten el puerto con SO_REUSEPORT
 
-class OrderType(Enum):
+SERVER_MODES = ["single", "threaded", "asyncio", "prefork"]
 
-    BUY = "BUY"
+SERVER_MODE = "single"
 
-    SELL = "SELL"
+SERVER_WORKERS = 16
 
+SERVER_BACKLOG = 128
 
+KEEPALIVE_TIMEOUT = 15.0
 
-class OrderStatus(Enum):
+MAX_KEEPALIVE_REQUESTS = 100
 
-    PENDING = "PENDING"
+PREFORK_PROCESSES = os.cpu_count() or 1
 
-    PARTIALLY_FILLED = "PARTIALLY_FILLED"
+PREFORK_STATS_INTERVAL = 60.0
 
-    FILLED = "FILLED"
+ORDER_EVENTS_RETENTION = 100_000
 
-    CANCELLED = "CANCELLED"
+# Plazo para pagar un trade iniciado con start_trade (segundos)
 
+TRADE_PAYMENT_WINDOW = 15 * 60
 
 
-class TradeStatus(Enum):
 
-    PENDING_PAYMENT = "PENDING_PAYMENT"
+# Control de admisión: token buckets por sesión y por IP en las rutas de
 
-    PAYMENT_SENT = "PAYMENT_SENT"
+# escritura y un límite global de peticiones en curso (503 + Retry-After)
 
-    PAYMENT_CONFIRMED = "PAYMENT_CONFIRMED"
+RATE_LIMIT_SESSION_RATE = 2.0
 
-    COMPLETED = "COMPLETED"
+RATE_LIMIT_SESSION_BURST = 10
 
-    CANCELLED = "CANCELLED"
+RATE_LIMIT_IP_RATE = 10.0
 
+RATE_LIMIT_IP_BURST = 50
 
+RATE_LIMIT_MAX_CLIENTS = 100_000
 
-@dataclass
+MAX_IN_FLIGHT = 256
 
-class User:
+OVERLOAD_RETRY_AFTER = 1
 
-    id: int
+# Los streams (SSE y WebSocket) retienen un hilo del servidor hasta que terminan:
 
-    username: str
+# como mucho esta fracción de --workers, para que /login y el resto sigan respondiendo
 
-    email: str
+STREAM_WORKER_RATIO = 0.25
 
-    created_at: str
 
 
+def stream_limit(workers: int) -> int:
 
-@dataclass
+    return max(1, int(workers * STREAM_WORKER_RATIO))
 
-class P2POrder:
 
-    id: int
 
-    user_id: int
+# Sesiones: token firmado con HMAC en la cookie, verificado sin tocar SQLite.
 
-    username: str
+# El secreto se guarda en la base de datos (compartido entre procesos) salvo
 
-    order_type: OrderType
+# que venga en la variable de entorno SESSION_SECRET_ENV
 
-    asset: str
+SESSION_COOKIE = "session"
 
-    fiat: str
+SESSION_TTL = 24 * 3600
 
-    price: float
+SESSION_CACHE_SIZE = 100_000
 
-    quantity: float
+SESSION_SECRET_ENV = "P2P_SESSION_SECRET"
 
-    available_quantity: float
 
-    payment_methods: List[str]
 
-    status: OrderStatus
+# Contraseñas: KDF con sal y parámetros guardados junto al hash de cada
 
-    created_at: str
+# usuario; se calcula en un pool de procesos aparte para que un pico de
 
-    min_amount: float
+# logins no deje sin CPU (ni GIL) a las rutas de trading
 
-    max_amount: float
+PASSWORD_KDF = "scrypt" if hasattr(hashlib, 'scrypt') else "pbkdf2_sha256"
 
+SCRYPT_N = 2 ** 14
 
+SCRYPT_R = 8
 
-class P2PSystem:
+SCRYPT_P = 1
 
-    def __init__(self, db_name: str = DB_NAME):
+PBKDF2_ITERATIONS = 600_000
 
-        self.db_name = db_name
+KDF_SALT_BYTES = 16
 
-        self.init_database()
+KDF_PROCESSES = max(1, min(4, (os.cpu_count() or 1) // 2))
 
-   
+# Fracción de los hilos del servidor que puede esperar un hash a la vez (main la aplica a --workers)
 
-    def init_database(self):
+KDF_PENDING_RATIO = 0.5
 
-        # Eliminar base de datos existente para forzar recreación
 
-        if os.path.exists(self.db_name):
 
-            os.remove(self.db_name)
+def kdf_max_pending(workers: int) -> int:
 
-           
+    return max(1, int(workers * KDF_PENDING_RATIO))
 
-        conn = sqlite3.connect(self.db_name)
 
-        cursor = conn.cursor()
 
-       
+# Benchmark de operaciones de P2PSystem (--bench)
 
-        # Tabla de usuarios
+BENCH_SCALES = {'1k': 1_000, '100k': 100_000, '1m': 1_000_000}
 
-        cursor.execute('''
+BENCH_SAMPLES = 500
 
-            CREATE TABLE IF NOT EXISTS users (
+BENCH_OUTPUT = "benchmark_results.json"
 
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+BENCH_REGRESSION_THRESHOLD = 0.10
 
-                username TEXT UNIQUE NOT NULL,
 
-                email TEXT UNIQUE NOT NULL,
 
-                password_hash TEXT NOT NULL,
+# Registro estructurado de peticiones
 
-                created_at TEXT NOT NULL,
+LOG_FILE = "p2p_requests.log"
 
-                reputation INTEGER DEFAULT 100,
+LOG_LEVEL = "INFO"
 
-                completed_trades INTEGER DEFAULT 0
+LOG_SAMPLE_RATE = 1.0
 
-            )
+LOG_RING_SIZE = 65536
 
-        ''')
+LOG_FLUSH_INTERVAL = 1.0
 
-       
+LOG_MAX_BYTES = 10 * 1024 * 1024
 
-        # Tabla de órdenes P2P
+LOG_BACKUPS = 5
 
-        cursor.execute('''
 
-            CREATE TABLE IF NOT EXISTS p2p_orders (
 
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+# Server-Sent Events
 
-                user_id INTEGER NOT NULL,
+SSE_HEARTBEAT = 15.0
 
-                order_type TEXT NOT NULL,
+SSE_RETRY_MS = 3000
 
-                asset TEXT NOT NULL,
+EVENT_BUS_RETAINED = 10_000
 
-                fiat TEXT NOT NULL,
 
-                price REAL NOT NULL,
 
-                quantity REAL NOT NULL,
+# Plantillas
 
-                available_quantity REAL NOT NULL,
+FRAGMENT_CACHE_SIZE = 20_000
 
-                payment_methods TEXT NOT NULL,
+DASHBOARD_PAGE_SIZE = 50
 
-                status TEXT NOT NULL,
 
-                min_amount REAL NOT NULL,
 
-                max_amount REAL NOT NULL,
+# Assets estáticos
 
-                created_at TEXT NOT NULL,
+STATIC_PREFIX = "/static"
 
-                FOREIGN KEY (user_id) REFERENCES users (id)
+STATIC_CACHE_CONTROL = "public, max-age=31536000, immutable"
 
-            )
 
-        ''')
 
-       
+# Compresión de respuestas
 
-        # Tabla de trades
+COMPRESSION_LEVEL = 6
 
-        cursor.execute('''
+COMPRESSION_MIN_SIZE = 1024
 
-            CREATE TABLE IF NOT EXISTS trades (
+COMPRESSION_CACHE_SIZE = 128
 
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript')
 
-                buyer_id INTEGER NOT NULL,
 
-                seller_id INTEGER NOT NULL,
 
-                order_id INTEGER NOT NULL,
+# Market data por WebSocket
 
-                asset TEXT NOT NULL,
+MARKET_DATA_DEPTH = 20
 
-                fiat TEXT NOT NULL,
+MARKET_DATA_INTERVAL = 0.1
 
-                price REAL NOT NULL,
+MARKET_DATA_POLL = 1.0
 
-                quantity REAL NOT NULL,
+WS_MAX_MESSAGE = 65536
 
-                amount REAL NOT NULL,
+MAX_REQUEST_HEAD = 65536
 
-                status TEXT NOT NULL,
+MAX_REQUEST_BODY = 1048576
 
-                created_at TEXT NOT NULL,
 
-                qr_code TEXT,
 
-                payment_deadline TEXT,
+# API JSON versionada
 
-                FOREIGN KEY (buyer_id) REFERENCES users (id),
+API_PREFIX = "/api/v1"
 
-                FOREIGN KEY (seller_id) REFERENCES users (id),
+API_ORDERS_LIMIT = 100
 
-                FOREIGN KEY (order_id) REFERENCES p2p_orders (id)
+API_ORDERS_MAX_LIMIT = 1000
 
-            )
 
-        ''')
 
-       
+# Pool de conexiones SQLite
 
-        # Tabla de wallets
+DB_POOL_SIZE = 8
 
-        cursor.execute('''
+DB_POOL_TIMEOUT = 5.0
 
-            CREATE TABLE IF NOT EXISTS wallets (
+DB_STATEMENT_CACHE = 256
 
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
 
-                user_id INTEGER NOT NULL,
 
-                asset TEXT NOT NULL,
+# Perfiles de almacenamiento (PRAGMAs aplicados a cada conexión nueva)
 
-                balance REAL NOT NULL,
+STORAGE_PROFILES = {
 
-                locked_balance REAL NOT NULL,
+    # Máxima seguridad ante cortes de luz: fsync en cada commit
 
-                FOREIGN KEY (user_id) REFERENCES users (id)
+    'durable': {
 
-            )
+        'journal_mode': 'WAL',
 
-        ''')
+        'synchronous': 'FULL',
 
-       
+        'mmap_size': 0,
 
-        # Insertar datos de ejemplo
+        'cache_size': -8000,
 
-        self._create_sample_data(cursor)
+        'temp_store': 'MEMORY',
 
-       
+        'busy_timeout': 5000
 
-        conn.commit()
+    },
 
-        conn.close()
+    # WAL + synchronous=NORMAL: un corte puede perder los últimos commits,
 
-        print("✅ Base de datos creada correctamente")
+    # pero la base de datos nunca queda corrupta
 
-   
+    'throughput': {
 
-    def _create_sample_data(self, cursor):
+        'journal_mode': 'WAL',
 
-        """Crear datos de ejemplo"""
+        'synchronous': 'NORMAL',
 
-        users_data = [
+        'mmap_size': 268435456,
 
-            ("trader1", "trader1@example.com", "password123"),
+        'cache_size': -65536,
 
-            ("trader2", "trader2@example.com", "password123"),
+        'temp_store': 'MEMORY',
 
-            ("trader3", "trader3@example.com", "password123")
+        'busy_timeout': 5000
 
-        ]
+    }
 
-       
+}
 
-        for username, email, password in users_data:
+STORAGE_PROFILE = "throughput"
 
-            try:
 
-                password_hash = hashlib.sha256(password.encode()).hexdigest()
 
-                created_at = datetime.datetime.now().isoformat()
+# Motor de cruce continuo (precio-tiempo) para órdenes que se cruzan
 
-                cursor.execute(
+MATCHING_ENGINE = False
 
-                    'INSERT INTO users (username, email, password_hash, created_at) VALUES (?, ?, ?, ?)',
+QUANTITY_EPSILON = 1e-9
 
-                    (username, email, password_hash, created_at)
 
-                )
 
-                user_id = cursor.lastrowid
+# Índices gestionados por init_database
 
-                print(f"✅ Usuario creado: {username}")
+MANAGED_INDEXES = {
 
-               
+    # Órdenes abiertas para load_order_books: el libro vive en memoria, así que
 
-                # Crear wallets
+    # basta con el estado (un índice cubriente duplicaría la tabla entera)
 
-                assets = [
+    'idx_orders_status': 'CREATE INDEX IF NOT EXISTS idx_orders_status ON p2p_orders (status)',
 
-                    ('USDT', 5000.0), ('BTC', 0.5), ('ETH', 3.0),
+    'idx_wallets_user_asset': 'CREATE UNIQUE INDEX IF NOT EXISTS idx_wallets_user_asset ON wallets (user_id, asset)',
 
-                    ('USD', 10000.0), ('EUR', 8000.0)
+    'idx_trades_status': 'CREATE INDEX IF NOT EXISTS idx_trades_status ON trades (status)',
 
-                ]
+    'idx_trades_buyer': 'CREATE INDEX IF NOT EXISTS idx_trades_buyer ON trades (buyer_id)',
 
-                for asset, balance in assets:
+    'idx_trades_seller': 'CREATE INDEX IF NOT EXISTS idx_trades_seller ON trades (seller_id)'
 
-                    cursor.execute(
+}
 
-                        'INSERT INTO wallets (user_id, asset, balance, locked_balance) VALUES (?, ?, ?, ?)',
 
-                        (user_id, asset, balance, 0.0)
 
-                    )
+# Una orden con el nombre de su autor, en el orden de columnas de P2PSystem._row_to_order
 
-                   
+ORDER_ROW_QUERY = '''
 
-            except sqlite3.IntegrityError:
+    SELECT po.id, po.user_id, u.username, po.order_type, po.asset, po.fiat, po.price,
 
-                print(f"⚠️ Usuario {username} ya existe")
+           po.quantity, po.available_quantity, po.payment_methods, po.status,
 
-                continue
+           po.min_amount, po.max_amount, po.created_at
 
-       
+    FROM p2p_orders po
 
-        # Crear anuncios iniciales
+    JOIN users u ON po.user_id = u.id
 
-        self._generate_random_orders(cursor, num_orders=8)
+'''
 
-   
+# Órdenes publicadas (OrderBook.OPEN_STATUSES); sin ORDER BY, ver load_order_books
 
-    def _generate_random_orders(self, cursor, num_orders=8):
+OPEN_ORDERS_QUERY = ORDER_ROW_QUERY + 'WHERE po.status IN (?, ?)'
 
-        """Genera órdenes aleatorias de compra y venta"""
 
-        for i in range(num_orders):
 
-            try:
+# Consultas que de verdad se ejecutan en caliente (el libro de órdenes se sirve
 
-                cursor.execute("SELECT id FROM users ORDER BY RANDOM() LIMIT 1")
+# desde memoria); su plan no debe degradar a SCAN ni a ordenación temporal
 
-                user_result = cursor.fetchone()
+HOT_QUERIES = {
 
-                if not user_result:
+    'open_orders': (OPEN_ORDERS_QUERY, ('PENDING', 'PARTIALLY_FILLED')),
 
-                    continue
+    'orders_by_id': (ORDER_ROW_QUERY + 'WHERE po.id IN (?, ?)', (1, 2)),
 
-                   
+    'order_events': ('SELECT seq, order_id FROM order_events WHERE seq > ? ORDER BY seq', (0,)),
 
-                user_id = user_result[0]
+    'login': ('SELECT id, username, email, created_at, password_hash FROM users WHERE username = ?',
 
-                order_type = random.choice(['BUY', 'SELL'])
+              ('trader1',)),
 
-                asset = random.choice(ASSETS)
+    'wallet_balance': ('SELECT balance FROM wallets WHERE user_id = ? AND asset = ?', (1, 'USDT')),
 
-                fiat = random.choice(FIATS)
+    'wallet_update': ('''
 
-               
+        UPDATE wallets SET balance = balance - ?, locked_balance = locked_balance + ?
 
-                # Precios base
+        WHERE user_id = ? AND asset = ?
 
-                base_prices = {
+    ''', (0, 0, 1, 'USDT')),
 
-                    'USDT': {'USD': 1.0, 'EUR': 0.92},
+    'user_wallets': ('SELECT asset, balance, locked_balance FROM wallets WHERE user_id = ?', (1,))
 
-                    'BTC': {'USD': 45000.0, 'EUR': 41400.0},
+}
 
-                    'ETH': {'USD': 2800.0, 'EUR': 2576.0}
 
-                }
 
-               
+# Datos para generación aleatoria
 
-                base_price = base_prices[asset][fiat]
+RANDOM_NAMES = [
 
-                if order_type == 'SELL':
+    "CryptoMaster", "BitcoinPro", "ElonMusk", "SatoshiNakamoto", "DigitalTrader",
 
-                    price_variation = random.uniform(0.01, 0.03)
+    "BlockchainKing", "CryptoWhale", "TradingExpert", "Web3Enthusiast", "DeFiMaster"
 
-                else:
+]
 
-                    price_variation = random.uniform(-0.03, -0.01)
 
-               
 
-                price = base_price * (1 + price_variation)
+RANDOM_PAYMENT_METHODS = [
 
-                price = round(price, 2)
+    ["Bank Transfer", "PayPal"],
 
-               
+    ["Bank Transfer", "Wise", "Revolut"],
 
-                # Cantidades
+    ["PayPal", "Credit Card"],
 
-                quantity_ranges = {
+    ["Bank Transfer", "Cash Deposit"],
 
-                    'USDT': (100, 1000),
+    ["Wise", "PayPal", "Bank Transfer"]
 
-                    'BTC': (0.01, 0.1),
+]
 
-                    'ETH': (0.1, 2.0)
+PAYMENT_METHODS = sorted({method for methods in RANDOM_PAYMENT_METHODS for method in methods})
 
-                }
 
-                min_qty, max_qty = quantity_ranges[asset]
 
-                quantity = round(random.uniform(min_qty, max_qty), 2)
+ASSETS = ["USDT", "BTC", "ETH"]
 
-               
+FIATS = ["USD", "EUR"]
 
-                payment_methods = random.choice(RANDOM_PAYMENT_METHODS)
 
-                min_amount = round(random.uniform(50, 200), 2)
 
-                max_amount = round(quantity * price * 0.8, 2)
+# Modelo de precios y cantidades de las órdenes aleatorias (datos de ejemplo y benchmark)
 
-               
+BASE_PRICES = {
 
-                created_at = datetime.datetime.now().isoformat()
+    'USDT': {'USD': 1.0, 'EUR': 0.92},
 
-                payment_json = json.dumps(payment_methods)
+    'BTC': {'USD': 45000.0, 'EUR': 41400.0},
 
-               
+    'ETH': {'USD': 2800.0, 'EUR': 2576.0}
 
-                cursor.execute('''
+}
 
-                    INSERT INTO p2p_orders
+QUANTITY_RANGES = {
 
-                    (user_id, order_type, asset, fiat, price, quantity, available_quantity,
+    'USDT': (100, 1000),
 
-                     payment_methods, status, min_amount, max_amount, created_at)
+    'BTC': (0.01, 0.1),
 
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    'ETH': (0.1, 2.0)
 
-                ''', (user_id, order_type, asset, fiat, price, quantity, quantity,
+}
 
-                      payment_json, 'PENDING', min_amount, max_amount, created_at))
 
-               
 
-                print(f"✅ Anuncio {order_type} {asset}/{fiat} a {price}")
+def random_order_params(rng: random.Random = random) -> Tuple[str, str, str, float, float, List[str], float, float]:
 
-               
+    """(order_type, asset, fiat, price, quantity, payment_methods, min_amount, max_amount) aleatorios.
 
-            except Exception as e:
 
-                print(f"❌ Error creando anuncio: {e}")
 
-   
+    Las compras quedan entre un 1% y un 3% por debajo del precio base y las
 
-    def hash_password(self, password: str) -> str:
+    ventas por encima, así que dos órdenes generadas nunca se cruzan.
 
-        return hashlib.sha256(password.encode()).hexdigest()
+    """
 
-   
+    order_type = rng.choice(['BUY', 'SELL'])
 
-    def register_user(self, username: str, email: str, password: str) -> bool:
+    asset = rng.choice(ASSETS)
 
-        try:
+    fiat = rng.choice(FIATS)
 
-            conn = sqlite3.connect(self.db_name)
+    if order_type == 'SELL':
 
-            cursor = conn.cursor()
+        price_variation = rng.uniform(0.01, 0.03)
 
-           
+    else:
 
-            password_hash = self.hash_password(password)
+        price_variation = rng.uniform(-0.03, -0.01)
 
-            created_at = datetime.datetime.now().isoformat()
+    price = round(BASE_PRICES[asset][fiat] * (1 + price_variation), 2)
 
-           
+    min_qty, max_qty = QUANTITY_RANGES[asset]
 
-            cursor.execute('''
+    quantity = round(rng.uniform(min_qty, max_qty), 2)
 
-                INSERT INTO users (username, email, password_hash, created_at)
+    payment_methods = rng.choice(RANDOM_PAYMENT_METHODS)
 
-                VALUES (?, ?, ?, ?)
+    min_amount = round(rng.uniform(50, 200), 2)
 
-            ''', (username, email, password_hash, created_at))
+    max_amount = round(quantity * price * 0.8, 2)
 
-           
+    return order_type, asset, fiat, price, quantity, payment_methods, min_amount, max_amount
 
-            user_id = cursor.lastrowid
 
-            initial_assets = [
 
-                ('USDT', 1000.0), ('BTC', 0.01), ('ETH', 0.1),
+class OrderType(Enum):
 
-                ('USD', 2000.0), ('EUR', 1600.0)
+    BUY = "BUY"
 
-            ]
+    SELL = "SELL"
 
-            for asset, balance in initial_assets:
 
-                cursor.execute('''
 
-                    INSERT INTO wallets (user_id, asset, balance, locked_balance)
+class OrderStatus(Enum):
 
-                    VALUES (?, ?, ?, ?)
+    PENDING = "PENDING"
 
-                ''', (user_id, asset, balance, 0.0))
+    PARTIALLY_FILLED = "PARTIALLY_FILLED"
 
-           
+    FILLED = "FILLED"
 
-            conn.commit()
+    CANCELLED = "CANCELLED"
 
-            conn.close()
 
-            return True
 
-        except sqlite3.IntegrityError:
+class TradeStatus(Enum):
 
-            return False
+    PENDING_PAYMENT = "PENDING_PAYMENT"
 
-   
+    PAYMENT_SENT = "PAYMENT_SENT"
 
-    def authenticate_user(self, username: str, password: str) -> Optional[User]:
+    PAYMENT_CONFIRMED = "PAYMENT_CONFIRMED"
 
-        conn = sqlite3.connect(self.db_name)
+    COMPLETED = "COMPLETED"
 
-        cursor = conn.cursor()
+    CANCELLED = "CANCELLED"
 
-       
 
-        password_hash = self.hash_password(password)
 
-        cursor.execute('''
+# Estados tras los que un trade ya no cambia
 
-            SELECT id, username, email, created_at FROM users
+TRADE_FINAL_STATUSES = (TradeStatus.COMPLETED.value, TradeStatus.CANCELLED.value)
 
-            WHERE username = ? AND password_hash = ?
 
-        ''', (username, password_hash))
 
-       
+@dataclass
 
-        result = cursor.fetchone()
+class User:
 
-        conn.close()
+    id: int
 
-       
+    username: str
 
-        if result:
+    email: str
 
-            return User(*result)
+    created_at: str
 
-        return None
 
-   
 
-    def get_user_stats(self, user_id: int) -> Dict[str, any]:
+@dataclass
 
-        conn = sqlite3.connect(self.db_name)
+class P2POrder:
 
-        cursor = conn.cursor()
+    id: int
 
-       
+    user_id: int
 
-        cursor.execute('SELECT reputation, completed_trades FROM users WHERE id = ?', (user_id,))
+    username: str
 
-        result = cursor.fetchone()
+    order_type: OrderType
 
-       
+    asset: str
 
-        stats = {
+    fiat: str
 
-            'reputation': result[0] if result else 100,
+    price: float
 
-            'completed_trades': result[1] if result else 0,
+    quantity: float
 
-            'trust_level': "✅ Confiable"
+    available_quantity: float
 
-        }
+    payment_methods: List[str]
 
-       
+    status: OrderStatus
 
-        conn.close()
+    created_at: str
 
-        return stats
+    min_amount: float
 
-   
+    max_amount: float
 
-    def create_order(self, user_id: int, order_type: str, asset: str, fiat: str,
 
-                    price: float, quantity: float, payment_methods: List[str],
 
-                    min_amount: float, max_amount: float) -> bool:
+def compute_reputation(completed: int, cancelled: int, avg_release_seconds: float) -> int:
 
-        try:
+    """0-100: porcentaje de trades completados, menos hasta 10 puntos por liberar lento"""
 
-            conn = sqlite3.connect(self.db_name)
+    finished = completed + cancelled
 
-            cursor = conn.cursor()
+    if not finished:
 
-           
+        return 100
 
-            # Validar fondos
+    score = 100.0 * completed / finished
 
-            if order_type == 'SELL':
+    score -= 10.0 * min(1.0, avg_release_seconds / TRADE_PAYMENT_WINDOW)
 
-                cursor.execute('''
+    return max(0, round(score))
 
-                    SELECT balance FROM wallets
 
-                    WHERE user_id = ? AND asset = ?
 
-                ''', (user_id, asset))
+@dataclass
 
-                result = cursor.fetchone()
+class UserStats:
 
-                if not result or result[0] < quantity:
+    """Agregados materializados de un usuario (tabla user_stats).
 
-                    return False
 
-            else:  # BUY
 
-                cursor.execute('''
+    Se actualizan dentro de la misma transacción que completa o cancela un
 
-                    SELECT balance FROM wallets
+    trade, así que leerlos nunca requiere recorrer la tabla trades.
 
-                    WHERE user_id = ? AND asset = ?
+    """
 
-                ''', (user_id, fiat))
+    user_id: int
 
-                result = cursor.fetchone()
+    completed_trades: int = 0
 
-                total_amount = price * quantity
+    cancelled_trades: int = 0
 
-                if not result or result[0] < total_amount:
+    release_seconds: float = 0.0
 
-                    return False
+    released_trades: int = 0
 
-           
+    volume: Dict[str, float] = dataclasses.field(default_factory=dict)
 
-            created_at = datetime.datetime.now().isoformat()
+    reputation: int = 100
 
-            payment_methods_json = json.dumps(payment_methods)
 
-           
 
-            cursor.execute('''
+    @property
 
-                INSERT INTO p2p_orders
+    def avg_release_seconds(self) -> float:
 
-                (user_id, order_type, asset, fiat, price, quantity, available_quantity,
+        return self.release_seconds / self.released_trades if self.released_trades else 0.0
 
-                 payment_methods, status, min_amount, max_amount, created_at)
 
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
 
-            ''', (user_id, order_type, asset, fiat, price, quantity, quantity,
+    @property
 
-                  payment_methods_json, OrderStatus.PENDING.value, min_amount, max_amount, created_at))
+    def cancellation_rate(self) -> float:
 
-           
+        finished = self.completed_trades + self.cancelled_trades
 
-            # Bloquear fondos
+        return self.cancelled_trades / finished if finished else 0.0
 
-            if order_type == 'SELL':
 
-                cursor.execute('''
 
-                    UPDATE wallets
+    @property
 
-                    SET balance = balance - ?, locked_balance = locked_balance + ?
+    def trust_level(self) -> str:
 
-                    WHERE user_id = ? AND asset = ?
+        if not self.completed_trades:
 
-                ''', (quantity, quantity, user_id, asset))
+            return "🆕 Nuevo"
 
-            else:  # BUY
+        if self.reputation >= 90:
 
-                total_amount = price * quantity
+            return "✅ Confiable"
 
-                cursor.execute('''
+        if self.reputation >= 70:
 
-                    UPDATE wallets
+            return "⚠️ Regular"
 
-                    SET balance = balance - ?, locked_balance = locked_balance + ?
+        return "❌ Poco fiable"
 
-                    WHERE user_id = ? AND asset = ?
 
-                ''', (total_amount, total_amount, user_id, fiat))
 
-           
+    def add(self, completed: int = 0, cancelled: int = 0, release_seconds: float = 0.0,
 
-            conn.commit()
+            released: int = 0, volume: Optional[Dict[str, float]] = None) -> 'UserStats':
 
-            conn.close()
+        """Copia con los incrementos aplicados y la reputación recalculada"""
 
-            return True
+        merged = dict(self.volume)
 
-        except Exception as e:
+        for asset, amount in (volume or {}).items():
 
-            print(f"Error creating order: {e}")
+            merged[asset] = round(merged.get(asset, 0.0) + amount, 8)
 
-            return False
+        stats = dataclasses.replace(
 
-   
+            self, completed_trades=self.completed_trades + completed,
 
-    def get_orders(self, asset: str = "USDT", fiat: str = "USD", order_type: str = None) -> List[P2POrder]:
+            cancelled_trades=self.cancelled_trades + cancelled,
 
-        conn = sqlite3.connect(self.db_name)
+            release_seconds=self.release_seconds + release_seconds,
 
-        cursor = conn.cursor()
+            released_trades=self.released_trades + released, volume=merged
 
-       
+        )
 
-        query = '''
+        stats.reputation = compute_reputation(stats.completed_trades, stats.cancelled_trades,
 
-            SELECT po.id, po.user_id, u.username, po.order_type, po.asset, po.fiat, po.price,
+                                              stats.avg_release_seconds)
 
-                   po.quantity, po.available_quantity, po.payment_methods, po.status,
+        return stats
 
-                   po.min_amount, po.max_amount, po.created_at
 
-            FROM p2p_orders po
 
-            JOIN users u ON po.user_id = u.id
+    def to_dict(self) -> Dict[str, any]:
 
-            WHERE po.asset = ? AND po.fiat = ? AND po.status = ?
+        return {
 
-        '''
+            'reputation': self.reputation,
 
-        params = [asset, fiat, OrderStatus.PENDING.value]
+            'trust_level': self.trust_level,
 
-       
+            'completed_trades': self.completed_trades,
 
-        if order_type:
+            'cancelled_trades': self.cancelled_trades,
 
-            query += ' AND po.order_type = ?'
+            'cancellation_rate': round(self.cancellation_rate, 4),
 
-            params.append(order_type)
+            'avg_release_seconds': round(self.avg_release_seconds, 1),
 
-       
+            'volume': self.volume
 
-        query += ' ORDER BY po.price ASC'
+        }
 
-       
 
-        cursor.execute(query, params)
 
-        results = cursor.fetchall()
+def stats_change(changes: Dict[int, Dict[str, any]], user_id: int) -> Dict[str, any]:
 
-        conn.close()
+    """Incrementos pendientes de un usuario dentro de una transacción (ver UserStats.add)"""
 
-       
+    return changes.setdefault(user_id, {'completed': 0, 'cancelled': 0, 'release_seconds': 0.0,
 
-        orders = []
+                                        'released': 0, 'volume': {}})
 
-        for result in results:
 
-            payment_methods = json.loads(result[9])
 
-            orders.append(P2POrder(
+def add_volume(change: Dict[str, any], asset: str, amount: float):
 
-                id=result[0], user_id=result[1], username=result[2],
+    change['volume'][asset] = change['volume'].get(asset, 0.0) + amount
 
-                order_type=OrderType(result[3]), asset=result[4], fiat=result[5],
 
-                price=result[6], quantity=result[7], available_quantity=result[8],
 
-                payment_methods=payment_methods, status=OrderStatus(result[10]),
+class OrderBook:
 
-                min_amount=result[11], max_amount=result[12], created_at=result[13]
+    """Libro de órdenes en memoria de un par (asset, fiat).
 
-            ))
 
-       
 
-        return orders
+    Cada lado mantiene sus niveles de precio en una lista ordenada (mejor
 
-   
+    precio primero) y, dentro de cada nivel, las órdenes por orden de llegada.
 
-    def start_trade(self, buyer_id: int, order_id: int, quantity: float) -> Optional[int]:
+    Las órdenes guardadas no se modifican nunca: las actualizaciones las
 
-        try:
+    sustituyen, así que las listas devueltas a los lectores siguen siendo válidas.
 
-            conn = sqlite3.connect(self.db_name)
+    """
 
-            cursor = conn.cursor()
+    # Estados con los que una orden sigue publicada en el libro
 
-           
+    OPEN_STATUSES = (OrderStatus.PENDING, OrderStatus.PARTIALLY_FILLED)
 
-            cursor.execute('''
 
-                SELECT user_id, order_type, asset, fiat, price, available_quantity,
 
-                       min_amount, max_amount
+    def __init__(self, asset: str, fiat: str):
 
-                FROM p2p_orders WHERE id = ? AND status = ?
+        self.asset = asset
 
-            ''', (order_id, OrderStatus.PENDING.value))
+        self.fiat = fiat
 
-           
+        self._lock = threading.RLock()
 
-            order_data = cursor.fetchone()
+        # Claves de nivel ordenadas ascendentemente: -precio en BUY, precio en SELL
 
-            if not order_data:
+        self._keys = {OrderType.BUY: [], OrderType.SELL: []}
 
-                return None
+        self._levels = {OrderType.BUY: {}, OrderType.SELL: {}}
 
-           
+        self._orders: Dict[int, P2POrder] = {}
 
-            seller_id, order_type, asset, fiat, price, available_quantity, min_amount, max_amount = order_data
+        # (lado, método de pago) -> [(precio, id)] ordenado, para filtrar sin recorrer el libro
 
-           
+        self._by_method: Dict[Tuple[OrderType, str], List[Tuple[float, int]]] = {}
 
-            amount = price * quantity
+        # Se incrementa con cada cambio; es el seq del feed de market data
 
-           
+        self.version = 0
 
-            if quantity > available_quantity:
 
-                return None
 
-            if amount < min_amount or amount > max_amount:
+    @staticmethod
 
-                return None
+    def _key(side: OrderType, price: float) -> float:
 
-           
+        return -price if side is OrderType.BUY else price
 
-            # Validar fondos
 
-            if order_type == 'SELL':
 
-                cursor.execute('''
+    def __len__(self):
 
-                    SELECT balance FROM wallets WHERE user_id = ? AND asset = ?
+        return len(self._orders)
 
-                ''', (buyer_id, fiat))
 
-                buyer_balance = cursor.fetchone()
 
-                if not buyer_balance or buyer_balance[0] < amount:
+    def get(self, order_id: int) -> Optional[P2POrder]:
 
-                    return None
+        return self._orders.get(order_id)
 
-            else:
 
-                cursor.execute('''
 
-                    SELECT balance FROM wallets WHERE user_id = ? AND asset = ?
+    def add(self, order: P2POrder):
 
-                ''', (buyer_id, asset))
+        if order.status not in self.OPEN_STATUSES or order.available_quantity <= 0:
 
-                buyer_balance = cursor.fetchone()
+            return
 
-                if not buyer_balance or buyer_balance[0] < quantity:
+        with self._lock:
 
-                    return None
+            if order.id in self._orders:
 
-           
+                self._replace(order)
 
-            # Bloquear fondos
+                return
 
-            if order_type == 'SELL':
+            side = order.order_type
 
-                cursor.execute('''
+            key = self._key(side, order.price)
 
-                    UPDATE wallets SET balance = balance - ?, locked_balance = locked_balance + ?
+            level = self._levels[side].get(key)
 
-                    WHERE user_id = ? AND asset = ?
+            if level is None:
 
-                ''', (amount, amount, buyer_id, fiat))
+                level = self._levels[side][key] = OrderedDict()
 
-            else:
+                bisect.insort(self._keys[side], key)
 
-                cursor.execute('''
+            out_of_order = bool(level) and next(reversed(level)) > order.id
 
-                    UPDATE wallets SET balance = balance - ?, locked_balance = locked_balance + ?
+            level[order.id] = order
 
-                    WHERE user_id = ? AND asset = ?
+            self._orders[order.id] = order
 
-                ''', (quantity, quantity, buyer_id, asset))
+            self.version += 1
 
-           
+            for method in set(order.payment_methods):
 
-            # Actualizar orden
+                bisect.insort(self._by_method.setdefault((side, method), []), (order.price, order.id))
 
-            new_available_quantity = available_quantity - quantity
+            if out_of_order:
 
-            new_status = OrderStatus.FILLED.value if new_available_quantity == 0 else OrderStatus.PARTIALLY_FILLED.value
+                # Orden más antigua conocida tarde (la creó otro proceso): reordenar el nivel por id
 
-           
+                self._levels[side][key] = OrderedDict(sorted(level.items()))
 
-            cursor.execute('''
 
-                UPDATE p2p_orders
 
-                SET available_quantity = ?, status = ?
+    def _replace(self, order: P2POrder):
 
-                WHERE id = ?
+        # Mismo precio y lado: conserva la prioridad temporal dentro del nivel
 
-            ''', (new_available_quantity, new_status, order_id))
+        self._levels[order.order_type][self._key(order.order_type, order.price)][order.id] = order
 
-           
+        self._orders[order.id] = order
 
-            # Crear trade
+        self.version += 1
 
-            created_at = datetime.datetime.now().isoformat()
 
-            deadline = (datetime.datetime.now() + datetime.timedelta(minutes=15)).isoformat()
 
-           
+    def remove(self, order_id: int) -> Optional[P2POrder]:
 
-            cursor.execute('''
+        with self._lock:
 
-                INSERT INTO trades
+            order = self._orders.pop(order_id, None)
 
-                (buyer_id, seller_id, order_id, asset, fiat, price, quantity, amount,
+            if order is None:
 
-                 status, created_at, payment_deadline)
+                return None
 
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            side = order.order_type
 
-            ''', (buyer_id, seller_id, order_id, asset, fiat, price, quantity, amount,
+            key = self._key(side, order.price)
 
-                  TradeStatus.PENDING_PAYMENT.value, created_at, deadline))
+            level = self._levels[side][key]
 
-           
+            del level[order_id]
 
-            trade_id = cursor.lastrowid
+            if not level:
 
-            conn.commit()
+                del self._levels[side][key]
 
-            conn.close()
+                del self._keys[side][bisect.bisect_left(self._keys[side], key)]
 
-            return trade_id
+            for method in set(order.payment_methods):
 
-           
+                index = self._by_method[(side, method)]
 
-        except Exception as e:
+                del index[bisect.bisect_left(index, (order.price, order_id))]
 
-            print(f"Error starting trade: {e}")
+            self.version += 1
 
-            return None
+            return order
 
-   
 
-    def confirm_payment(self, trade_id: int) -> bool:
 
-        try:
+    def update(self, order_id: int, available_quantity: float, status: OrderStatus) -> Optional[P2POrder]:
 
-            conn = sqlite3.connect(self.db_name)
+        """Aplica un cambio de cantidad/estado; la orden sale del libro si deja de estar abierta"""
 
-            cursor = conn.cursor()
+        with self._lock:
 
-           
+            order = self._orders.get(order_id)
 
-            cursor.execute('''
+            if order is None:
 
-                SELECT buyer_id, seller_id, order_id, asset, fiat, price, quantity, amount, status
+                return None
 
-                FROM trades WHERE id = ? AND status = ?
+            if status not in self.OPEN_STATUSES or available_quantity <= 0:
 
-            ''', (trade_id, TradeStatus.PENDING_PAYMENT.value))
+                self.remove(order_id)
 
-           
+                return None
 
-            trade_data = cursor.fetchone()
+            order = dataclasses.replace(order, available_quantity=available_quantity, status=status)
 
-            if not trade_data:
+            self._replace(order)
 
-                return False
+            return order
 
-           
 
-            buyer_id, seller_id, order_id, asset, fiat, price, quantity, amount, status = trade_data
 
-           
+    def iter_orders(self, side: OrderType):
 
-            cursor.execute('SELECT order_type FROM p2p_orders WHERE id = ?', (order_id,))
+        """Recorre un lado en prioridad precio-tiempo sin copiarlo.
 
-            order_type_result = cursor.fetchone()
 
-            if not order_type_result:
 
-                return False
+        No toma el cerrojo: quien itera debe serializarse con los escritores
 
-           
+        (el motor de cruce lo hace con el cerrojo de escritura de P2PSystem).
 
-            order_type = order_type_result[0]
+        """
 
-           
+        levels = self._levels[side]
 
-            if order_type == 'SELL':
+        for key in self._keys[side]:
 
-                # Liberar fondos y transferir
+            yield from levels[key].values()
 
-                cursor.execute('''
 
-                    UPDATE wallets SET locked_balance = locked_balance - ?
 
-                    WHERE user_id = ? AND asset = ?
+    def orders(self, side: OrderType, limit: Optional[int] = None) -> List[P2POrder]:
 
-                ''', (amount, buyer_id, fiat))
+        """Órdenes de un lado, mejor precio primero; O(limit)"""
 
-               
+        result = []
 
-                cursor.execute('''
+        with self._lock:
 
-                    UPDATE wallets SET balance = balance + ?
+            levels = self._levels[side]
 
-                    WHERE user_id = ? AND asset = ?
+            for key in self._keys[side]:
 
-                ''', (amount, seller_id, fiat))
+                for order in levels[key].values():
 
-               
+                    if limit is not None and len(result) >= limit:
 
-                cursor.execute('''
+                        return result
 
-                    UPDATE wallets SET locked_balance = locked_balance - ?
+                    result.append(order)
 
-                    WHERE user_id = ? AND asset = ?
+        return result
 
-                ''', (quantity, seller_id, asset))
 
-               
 
-                cursor.execute('''
+    def depth(self, side: OrderType, levels: Optional[int] = None) -> List[Tuple[float, float, int]]:
 
-                    UPDATE wallets SET balance = balance + ?
+        """Top `levels` niveles de un lado como (precio, cantidad total, nº órdenes); O(levels)"""
 
-                    WHERE user_id = ? AND asset = ?
+        with self._lock:
 
-                ''', (quantity, buyer_id, asset))
+            keys = self._keys[side] if levels is None else self._keys[side][:levels]
 
-               
+            return [
 
-            else:
+                (abs(key),
 
-                cursor.execute('''
+                 sum(order.available_quantity for order in self._levels[side][key].values()),
 
-                    UPDATE wallets SET locked_balance = locked_balance - ?
+                 len(self._levels[side][key]))
 
-                    WHERE user_id = ? AND asset = ?
+                for key in keys
 
-                ''', (quantity, buyer_id, asset))
+            ]
 
-               
 
-                cursor.execute('''
 
-                    UPDATE wallets SET balance = balance + ?
+    def snapshot(self, levels: Optional[int] = None) -> Tuple[int, Dict[OrderType, List[Tuple[float, float, int]]]]:
 
-                    WHERE user_id = ? AND asset = ?
+        """Versión y profundidad de ambos lados, leídas de forma atómica"""
 
-                ''', (quantity, seller_id, asset))
+        with self._lock:
 
-               
+            return self.version, {side: self.depth(side, levels) for side in (OrderType.BUY, OrderType.SELL)}
 
-                cursor.execute('''
 
-                    UPDATE wallets SET locked_balance = locked_balance - ?
 
-                    WHERE user_id = ? AND asset = ?
+    def page(self, order_type: Optional[OrderType] = None, after: Optional[Tuple[float, int]] = None,
 
-                ''', (amount, seller_id, fiat))
+             limit: Optional[int] = None, payment_method: Optional[str] = None) -> List[P2POrder]:
 
-               
+        """Órdenes por (precio, id) ascendente a partir del cursor `after`, excluido.
 
-                cursor.execute('''
 
-                    UPDATE wallets SET balance = balance + ?
 
-                    WHERE user_id = ? AND asset = ?
+        Cada lado se recorre desde el cursor (bisect sobre los niveles, o sobre
 
-                ''', (amount, buyer_id, fiat))
+        el índice del método de pago) y los dos se mezclan de forma perezosa,
 
-           
+        así que el coste depende de `limit` y no del tamaño del libro.
 
-            # Actualizar trade
+        """
 
-            cursor.execute('''
+        sides = [order_type] if order_type else [OrderType.BUY, OrderType.SELL]
 
-                UPDATE trades SET status = ? WHERE id = ?
+        with self._lock:
 
-            ''', (TradeStatus.COMPLETED.value, trade_id))
+            runs = [self._iter_from(side, after, payment_method) for side in sides]
 
-           
+            merged = runs[0] if len(runs) == 1 else heapq.merge(*runs, key=lambda order: (order.price, order.id))
 
-            conn.commit()
+            return list(itertools.islice(merged, limit))
 
-            conn.close()
 
-            return True
 
-           
+    def _iter_from(self, side: OrderType, after: Optional[Tuple[float, int]], payment_method: Optional[str]):
 
-        except Exception as e:
+        if payment_method is not None:
 
-            print(f"Error confirming payment: {e}")
+            index = self._by_method.get((side, payment_method), [])
 
-            return False
+            start = bisect.bisect_right(index, after) if after else 0
 
-   
+            for position in range(start, len(index)):
 
-    def get_trade_status(self, trade_id: int) -> Optional[str]:
+                yield self._orders[index[position][1]]
 
-        conn = sqlite3.connect(self.db_name)
+            return
 
-        cursor = conn.cursor()
 
-       
 
-        cursor.execute('SELECT status FROM trades WHERE id = ?', (trade_id,))
+        keys, levels = self._keys[side], self._levels[side]
 
-        result = cursor.fetchone()
+        if side is OrderType.SELL:
 
-        conn.close()
+            # Claves = precio ascendente
 
-       
+            start = bisect.bisect_left(keys, after[0]) if after else 0
 
-        return result[0] if result else None
+            positions = range(start, len(keys))
 
-   
+        else:
 
-    def get_user_balance(self, user_id: int) -> Dict[str, Dict[str, float]]:
+            # Claves = -precio: el precio ascendente es el recorrido inverso
 
-        conn = sqlite3.connect(self.db_name)
+            end = bisect.bisect_right(keys, -after[0]) if after else len(keys)
 
-        cursor = conn.cursor()
+            positions = range(end - 1, -1, -1)
 
-       
+        for position in positions:
 
-        cursor.execute('''
+            orders = levels[keys[position]].values()
 
-            SELECT asset, balance, locked_balance FROM wallets WHERE user_id = ?
+            if after and abs(keys[position]) == after[0]:
 
-        ''', (user_id,))
+                # Nivel del cursor: dentro del nivel las órdenes van por id
 
-       
+                orders = (order for order in orders if order.id > after[1])
 
-        results = cursor.fetchall()
+            yield from orders
 
-        conn.close()
 
-       
 
-        balance = {}
+class ClusterStats:
 
-        for asset, bal, locked in results:
+    """Memoria compartida entre el supervisor pre-fork y sus workers.
 
-            balance[asset] = {
 
-                'available': bal,
 
-                'locked': locked,
+    Es un mmap anónimo creado antes del fork, así que todos los procesos ven
 
-                'total': bal + locked
+    los mismos bytes. Cabecera: último seq de order_events, nº de reinicios y
 
-            }
+    las versiones de P2PSystem.VERSIONED_TABLES; después un hueco por worker
 
-       
+    que solo escribe su dueño.
 
-        return balance
+    """
 
+    HEADER = struct.Struct('=qqqqqq')
 
+    SLOT = struct.Struct('=qqqqd')  # pid, handled, busy_workers, queue_depth, updated_at
 
-# Sistema P2P global
+    VERSION_OFFSETS = {'p2p_orders': 16, 'wallets': 24, 'revoked_sessions': 32, 'user_stats': 40}
 
-p2p_system = P2PSystem()
 
 
+    def __init__(self, slots: int):
 
-# HTML Templates simplificados
+        self.slots = slots
 
-HTML_TEMPLATES = {
+        self._mm = mmap.mmap(-1, self.HEADER.size + self.SLOT.size * slots)
 
-    'base': '''
+        # Semáforo compartido tras el fork: los incrementos de versión son leer-sumar-escribir
 
-<!DOCTYPE html>
+        self._versions_lock = multiprocessing.Lock()
 
-<html lang="es">
+        start = time.time_ns() // 1000
 
-<head>
+        for offset in self.VERSION_OFFSETS.values():
 
-    <meta charset="UTF-8">
+            struct.pack_into('=q', self._mm, offset, start)
 
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
 
-    <title>{title}</title>
 
-    <style>
+    def order_seq(self) -> int:
 
-        * {{
+        return struct.unpack_from('=q', self._mm, 0)[0]
 
-            margin: 0;
 
-            padding: 0;
 
-            box-sizing: border-box;
+    def set_order_seq(self, seq: int):
 
-        }}
+        struct.pack_into('=q', self._mm, 0, seq)
 
 
 
-        body {{
+    def add_restart(self):
 
-            font-family: Arial, sans-serif;
+        struct.pack_into('=q', self._mm, 8, struct.unpack_from('=q', self._mm, 8)[0] + 1)
 
-            background: #0a0a0a;
 
-            color: #ffffff;
 
-            line-height: 1.6;
+    def data_version(self, table: str) -> int:
 
-        }}
+        return struct.unpack_from('=q', self._mm, self.VERSION_OFFSETS[table])[0]
 
 
 
-        .navbar {{
+    def bump_version(self, table: str):
 
-            background: #111;
+        offset = self.VERSION_OFFSETS[table]
 
-            padding: 1rem 0;
+        with self._versions_lock:
 
-            border-bottom: 1px solid #333;
+            struct.pack_into('=q', self._mm, offset, struct.unpack_from('=q', self._mm, offset)[0] + 1)
 
-        }}
 
 
+    def update_slot(self, slot: int, pid: int, handled: int, busy: int, queue_depth: int):
 
-        .nav-container {{
+        self.SLOT.pack_into(self._mm, self.HEADER.size + self.SLOT.size * slot,
 
-            max-width: 1200px;
+                            pid, handled, busy, queue_depth, time.time())
 
-            margin: 0 auto;
 
-            display: flex;
 
-            justify-content: space-between;
+    def snapshot(self) -> Dict[str, any]:
 
-            align-items: center;
+        workers = []
 
-            padding: 0 2rem;
+        for slot in range(self.slots):
 
-        }}
+            pid, handled, busy, queue_depth, updated_at = self.SLOT.unpack_from(
 
+                self._mm, self.HEADER.size + self.SLOT.size * slot)
 
+            workers.append({'slot': slot, 'pid': pid, 'handled': handled, 'busy_workers': busy,
 
-        .nav-logo h2 {{
+                            'queue_depth': queue_depth, 'updated_at': updated_at})
 
-            color: #00ff88;
+        return {
 
-            font-weight: bold;
+            'processes': self.slots,
 
-        }}
+            'restarts': struct.unpack_from('=q', self._mm, 8)[0],
 
+            'order_seq': self.order_seq(),
 
+            'data_versions': {table: self.data_version(table) for table in self.VERSION_OFFSETS},
 
-        .nav-menu {{
+            'handled': sum(w['handled'] for w in workers),
 
-            display: flex;
+            'busy_workers': sum(w['busy_workers'] for w in workers),
 
-            align-items: center;
+            'queue_depth': sum(w['queue_depth'] for w in workers),
 
-            gap: 1rem;
+            'workers': workers
 
-        }}
+        }
 
 
 
-        .nav-user {{
+class EventBus:
 
-            background: #222;
+    """Bus de eventos en proceso que recuerda el último valor de cada tema.
 
-            padding: 0.5rem 1rem;
 
-            border-radius: 5px;
 
-        }}
+    publish() se llama desde los hilos que escriben en SQLite y ejecuta los
 
+    callbacks en ese mismo hilo, así que deben limitarse a encolar. El último
 
+    valor de los temas más recientes se conserva para que un suscriptor nuevo
 
-        .nav-link {{
+    no tenga que consultar la base de datos.
 
-            color: #fff;
+    """
 
-            text-decoration: none;
+    def __init__(self, retained: int = EVENT_BUS_RETAINED):
 
-            padding: 0.5rem 1rem;
+        self.retained = retained
 
-            border-radius: 5px;
+        self.published = 0
 
-        }}
+        self._lock = threading.Lock()
 
+        self._subscribers: Dict[str, List] = {}
 
+        self._last: OrderedDict = OrderedDict()
 
-        .nav-link:hover {{
 
-            background: #333;
 
-        }}
+    def subscribe(self, topic: str, callback):
 
+        """Registra `callback(value)` para `topic` y devuelve la función que lo da de baja"""
 
+        with self._lock:
 
-        .container {{
+            self._subscribers.setdefault(topic, []).append(callback)
 
-            max-width: 1200px;
 
-            margin: 0 auto;
 
-            padding: 2rem;
+        def unsubscribe():
 
-        }}
+            with self._lock:
 
+                callbacks = self._subscribers.get(topic, [])
 
+                if callback in callbacks:
 
-        .auth-container {{
+                    callbacks.remove(callback)
 
-            display: flex;
+                if not callbacks:
 
-            justify-content: center;
+                    self._subscribers.pop(topic, None)
 
-            align-items: center;
+        return unsubscribe
 
-            min-height: 80vh;
 
-        }}
 
+    def publish(self, topic: str, value):
 
+        with self._lock:
 
-        .auth-card {{
+            self._last[topic] = value
 
-            background: #111;
+            self._last.move_to_end(topic)
 
-            border: 1px solid #333;
+            if len(self._last) > self.retained:
 
-            padding: 2rem;
+                self._last.popitem(last=False)
 
-            border-radius: 10px;
+            callbacks = list(self._subscribers.get(topic, ()))
 
-            width: 100%;
+            self.published += 1
 
-            max-width: 400px;
+        for callback in callbacks:
 
-        }}
+            callback(value)
 
 
 
-        .auth-card h2 {{
+    def last(self, topic: str):
 
-            text-align: center;
+        with self._lock:
 
-            margin-bottom: 1.5rem;
+            return self._last.get(topic)
 
-            color: #00ff88;
 
-        }}
 
+    def stats(self) -> Dict[str, int]:
 
+        with self._lock:
 
-        .auth-form {{
+            return {
 
-            display: flex;
+                'topics': len(self._subscribers),
 
-            flex-direction: column;
+                'subscribers': sum(len(callbacks) for callbacks in self._subscribers.values()),
 
-            gap: 1rem;
+                'retained': len(self._last),
 
-        }}
+                'published': self.published
 
+            }
 
 
-        .form-group {{
 
-            display: flex;
+class RequestLog:
 
-            flex-direction: column;
+    """Registro estructurado (JSON lines) que no bloquea el camino de la petición.
 
-        }}
 
 
+    record() solo añade un dict a un anillo en memoria; si el escritor se
 
-        .form-group label {{
+    retrasa, el anillo descarta los registros más antiguos en lugar de frenar
 
-            margin-bottom: 0.5rem;
+    a los hilos que atienden peticiones. Un hilo de fondo vuelca el anillo
 
-            color: #ccc;
+    por lotes, con una sola escritura por lote, a un fichero que rota por tamaño.
 
-        }}
 
 
+    El nivel y el muestreo se pueden cambiar en caliente con configure();
 
-        .form-group input {{
+    WARNING y ERROR no se muestrean nunca.
 
-            padding: 0.75rem;
+    """
 
-            background: #222;
+    LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
 
-            border: 1px solid #333;
 
-            border-radius: 5px;
 
-            color: #fff;
+    def __init__(self, path: Optional[str] = LOG_FILE, level: str = LOG_LEVEL,
 
-        }}
+                 sample_rate: float = LOG_SAMPLE_RATE, ring_size: int = LOG_RING_SIZE,
 
+                 max_bytes: int = LOG_MAX_BYTES, backups: int = LOG_BACKUPS):
 
+        self.path = path
 
-        .btn {{
+        self.max_bytes = max_bytes
 
-            padding: 0.75rem 1.5rem;
+        self.backups = backups
 
-            border: none;
+        self.level = self.LEVELS[level]
 
-            border-radius: 5px;
+        self.sample_rate = sample_rate
 
-            font-weight: bold;
+        self._ring = deque(maxlen=ring_size)
 
-            cursor: pointer;
+        self._flush_lock = threading.Lock()
 
-            text-decoration: none;
+        self._stop = threading.Event()
 
-            display: inline-block;
+        self._thread = None
 
-            text-align: center;
+        self.written = 0
 
-        }}
+        self.sampled_out = 0
 
+        self.dropped = 0
 
 
-        .btn-primary {{
 
-            background: #00ff88;
+    def configure(self, level: Optional[str] = None, sample_rate: Optional[float] = None):
 
-            color: #000;
+        if level is not None:
 
-        }}
+            self.level = self.LEVELS[level.upper()]
 
+        if sample_rate is not None:
 
+            self.sample_rate = min(1.0, max(0.0, sample_rate))
 
-        .btn-success {{
 
-            background: #00ff88;
 
-            color: #000;
+    def enabled(self, level: str) -> bool:
 
-        }}
+        return self.LEVELS[level] >= self.level
 
 
 
-        .btn-warning {{
+    def record(self, level: str, event: str, **fields):
 
-            background: #ffb800;
+        severity = self.LEVELS[level]
 
-            color: #000;
+        if severity < self.level:
 
-        }}
+            return
 
+        if severity < self.LEVELS['WARNING'] and self.sample_rate < 1.0 and random.random() >= self.sample_rate:
 
+            self.sampled_out += 1
 
-        .btn-buy {{
+            return
 
-            background: #00ff88;
+        if len(self._ring) == self._ring.maxlen:
 
-            color: #000;
+            self.dropped += 1
 
-        }}
+        fields['ts'] = time.time()
 
+        fields['level'] = level
 
+        fields['event'] = event
 
-        .btn-sell {{
+        self._ring.append(fields)
 
-            background: #ff4757;
 
-            color: #fff;
 
-        }}
+    def start(self, path: Optional[str] = None):
 
+        """Arranca el hilo de volcado; en pre-fork cada worker llama aquí tras el fork"""
 
+        if path is not None:
 
-        .alert {{
+            self.path = path
 
-            padding: 1rem;
+        self._stop.clear()
 
-            border-radius: 5px;
+        self._thread = threading.Thread(target=self._run, name="p2p-log", daemon=True)
 
-            margin-bottom: 1rem;
+        self._thread.start()
 
-        }}
 
 
+    def _run(self):
 
-        .alert-error {{
+        while not self._stop.wait(LOG_FLUSH_INTERVAL):
 
-            background: #ff4757;
+            self.flush()
 
-            color: #fff;
 
-        }}
 
+    def flush(self):
 
+        with self._flush_lock:
 
-        .alert-success {{
+            batch = []
 
-            background: #00ff88;
+            while self._ring:
 
-            color: #000;
+                try:
 
-        }}
+                    batch.append(self._ring.popleft())
 
+                except IndexError:
 
+                    break
 
-        .test-users {{
+            if not batch or self.path is None:
 
-            margin-top: 1.5rem;
+                return
 
-            padding: 1rem;
+            data = ''.join(json.dumps(record, separators=(',', ':'), ensure_ascii=False, default=str) + '\n'
 
-            background: #222;
+                           for record in batch).encode('utf-8')
 
-            border-radius: 5px;
+            try:
 
-            font-size: 0.9rem;
+                if os.path.exists(self.path) and os.path.getsize(self.path) + len(data) > self.max_bytes:
 
-        }}
+                    self._rotate()
 
+                with open(self.path, 'ab') as log_file:
 
+                    log_file.write(data)
 
-        .dashboard-header {{
+                self.written += len(batch)
 
-            margin-bottom: 2rem;
+            except OSError as e:
 
-        }}
+                print(f"⚠️  No se pudo escribir el registro {self.path}: {e}")
 
 
 
-        .dashboard-header h1 {{
+    def _rotate(self):
 
-            color: #00ff88;
+        for index in range(self.backups - 1, 0, -1):
 
-            margin-bottom: 1rem;
+            if os.path.exists(f'{self.path}.{index}'):
 
-        }}
+                os.replace(f'{self.path}.{index}', f'{self.path}.{index + 1}')
 
+        if self.backups:
 
+            os.replace(self.path, f'{self.path}.1')
 
-        .user-balance {{
+        else:
 
-            background: #111;
+            os.remove(self.path)
 
-            border: 1px solid #333;
 
-            padding: 1.5rem;
 
-            border-radius: 10px;
+    def close(self):
 
-            margin-bottom: 2rem;
+        self._stop.set()
 
-        }}
+        if self._thread is not None:
 
+            self._thread.join(timeout=LOG_FLUSH_INTERVAL * 2)
 
+        self.flush()
 
-        .balance-grid {{
 
-            display: grid;
 
-            grid-template-columns: repeat(auto-fit, minmax(200px, 1fr));
+    def stats(self) -> Dict[str, any]:
 
-            gap: 1rem;
+        level = next(name for name, value in self.LEVELS.items() if value == self.level)
 
-            margin-top: 1rem;
+        return {
 
-        }}
+            'path': self.path,
 
+            'level': level,
 
+            'sample_rate': self.sample_rate,
 
-        .balance-item {{
+            'buffered': len(self._ring),
 
-            background: #222;
+            'written': self.written,
 
-            padding: 1rem;
+            'sampled_out': self.sampled_out,
 
-            border-radius: 5px;
+            'dropped': self.dropped
 
-            border-left: 4px solid #00ff88;
+        }
 
-        }}
 
 
+request_log = RequestLog()
 
-        .dashboard-content {{
 
-            display: grid;
 
-            grid-template-columns: 2fr 1fr;
+class AdmissionControl:
 
-            gap: 2rem;
+    """Decide si una petición entra antes de que llegue a SQLite.
 
-        }}
 
 
+    - throttle(): token bucket por sesión (sid del token, no usuario) y otro
 
-        .orders-grid {{
+      por IP para las rutas de escritura; solo se gasta un token si ambos
 
-            display: flex;
+      buckets lo tienen. Un rate <= 0 desactiva solo su bucket.
 
-            flex-direction: column;
+    - enter()/leave(): límite global de peticiones en curso (las que esperan
 
-            gap: 1rem;
+      un hilo cuentan también) para rechazar con 503 en vez de encolar sin fin.
 
-            max-height: 600px;
+    - enter_stream()/leave_stream(): cupo aparte para los streams, que ocupan
 
-            overflow-y: auto;
+      un hilo durante minutos y no pasan por enter().
 
-        }}
 
 
+    Los buckets viven en un LRU acotado; en pre-fork cada proceso tiene el suyo.
 
-        .order-card {{
+    """
 
-            background: #111;
+    def __init__(self, session_rate: float = RATE_LIMIT_SESSION_RATE,
 
-            border: 1px solid #333;
+                 session_burst: int = RATE_LIMIT_SESSION_BURST, ip_rate: float = RATE_LIMIT_IP_RATE,
 
-            padding: 1.5rem;
+                 ip_burst: int = RATE_LIMIT_IP_BURST, max_in_flight: int = MAX_IN_FLIGHT,
 
-            border-radius: 10px;
+                 max_clients: int = RATE_LIMIT_MAX_CLIENTS, max_streams: int = stream_limit(SERVER_WORKERS)):
 
-        }}
+        self.session_rate = session_rate
 
+        self.session_burst = session_burst
 
+        self.ip_rate = ip_rate
 
-        .order-card.buy {{
+        self.ip_burst = ip_burst
 
-            border-left: 4px solid #00ff88;
+        self.max_in_flight = max_in_flight
 
-        }}
+        self.max_clients = max_clients
 
+        self.max_streams = max_streams
 
+        self._buckets: OrderedDict = OrderedDict()
 
-        .order-card.sell {{
+        self._lock = threading.Lock()
 
-            border-left: 4px solid #ff4757;
+        self.in_flight = 0
 
-        }}
+        self.admitted = 0
 
+        self.streams = {'sse': 0, 'ws': 0}
 
+        self.rejected = {'session': 0, 'ip': 0, 'overload': 0, 'streams': 0}
 
-        .order-header {{
 
-            display: flex;
 
-            justify-content: space-between;
+    def _refill(self, key: Tuple[str, str], rate: float, burst: int, now: float) -> List[float]:
 
-            align-items: center;
+        bucket = self._buckets.get(key)
 
-            margin-bottom: 1rem;
+        if bucket is None:
 
-        }}
+            bucket = self._buckets[key] = [float(burst), now]
 
+            if len(self._buckets) > self.max_clients:
 
+                self._buckets.popitem(last=False)
 
-        .trade-form {{
+        else:
 
-            display: flex;
+            bucket[0] = min(float(burst), bucket[0] + (now - bucket[1]) * rate)
 
-            gap: 0.5rem;
+            bucket[1] = now
 
-            margin-top: 1rem;
+            self._buckets.move_to_end(key)
 
-        }}
+        return bucket
 
 
 
-        .trade-form input {{
+    def throttle(self, session_key: Optional[str], ip: str) -> Tuple[Optional[str], float]:
 
-            flex: 1;
+        """Devuelve (None, 0) si la petición pasa, o (motivo, segundos hasta el próximo token)"""
 
-            padding: 0.5rem;
+        limits = []
 
-            background: #222;
+        if self.ip_rate > 0:
 
-            border: 1px solid #333;
+            limits.append(('ip', ip, self.ip_rate, self.ip_burst))
 
-            border-radius: 5px;
+        if self.session_rate > 0 and session_key is not None:
 
-            color: #fff;
+            limits.append(('session', session_key, self.session_rate, self.session_burst))
 
-        }}
+        if not limits:
 
+            return None, 0.0
 
+        now = time.monotonic()
 
-        .create-order-section {{
+        with self._lock:
 
-            background: #111;
+            buckets = []
 
-            border: 1px solid #333;
+            for kind, key, rate, burst in limits:
 
-            padding: 1.5rem;
+                bucket = self._refill((kind, key), rate, burst, now)
 
-            border-radius: 10px;
+                if bucket[0] < 1.0:
 
-            height: fit-content;
+                    self.rejected[kind] += 1
 
-        }}
+                    return kind, (1.0 - bucket[0]) / rate
 
+                buckets.append(bucket)
 
+            for bucket in buckets:
 
-        .order-form {{
+                bucket[0] -= 1.0
 
-            display: flex;
+        return None, 0.0
 
-            flex-direction: column;
 
-            gap: 1rem;
 
-        }}
+    def enter(self, waiting: int = 0) -> bool:
 
+        with self._lock:
 
+            if self.in_flight + waiting >= self.max_in_flight:
 
-        .form-row {{
+                self.rejected['overload'] += 1
 
-            display: grid;
+                return False
 
-            grid-template-columns: 1fr 1fr;
+            self.in_flight += 1
 
-            gap: 1rem;
+            self.admitted += 1
 
-        }}
+            return True
 
 
 
-        .modal {{
+    def leave(self):
 
-            display: none;
+        with self._lock:
 
-            position: fixed;
+            self.in_flight -= 1
 
-            z-index: 1000;
 
-            left: 0;
 
-            top: 0;
+    def shed(self):
 
-            width: 100%;
+        """Cuenta un rechazo por sobrecarga decidido fuera de enter() (front end asyncio)"""
 
-            height: 100%;
+        with self._lock:
 
-            background: rgba(0,0,0,0.8);
+            self.rejected['overload'] += 1
 
-        }}
 
 
+    def enter_stream(self, kind: str) -> bool:
 
-        .modal-content {{
+        """Reserva un hilo para un stream ('sse' o 'ws'); False si el cupo está lleno"""
 
-            background: #111;
+        with self._lock:
 
-            border: 1px solid #333;
+            if sum(self.streams.values()) >= self.max_streams:
 
-            border-radius: 10px;
+                self.rejected['streams'] += 1
 
-            padding: 2rem;
+                return False
 
-            width: 90%;
+            self.streams[kind] += 1
 
-            max-width: 400px;
+            return True
 
-            position: absolute;
 
-            top: 50%;
 
-            left: 50%;
+    def leave_stream(self, kind: str):
 
-            transform: translate(-50%, -50%);
+        with self._lock:
 
-            text-align: center;
+            self.streams[kind] -= 1
 
-        }}
 
-    </style>
 
-</head>
+    def stats(self) -> Dict[str, any]:
 
-<body>
+        with self._lock:
 
-    <nav class="navbar">
+            return {
 
-        <div class="nav-container">
+                'in_flight': self.in_flight,
 
-            <div class="nav-logo">
+                'max_in_flight': self.max_in_flight,
 
-                <h2>P2P TRADING</h2>
+                'admitted': self.admitted,
 
-            </div>
+                'open_streams': dict(self.streams),
 
-            <div class="nav-menu">
+                'max_streams': self.max_streams,
 
-                {nav_menu}
+                'rejected': dict(self.rejected),
 
-            </div>
+                'tracked_clients': len(self._buckets)
 
-        </div>
+            }
 
-    </nav>
 
-    <div class="container">
 
-        {content}
+admission = AdmissionControl()
 
-    </div>
 
-    {modal}
 
-    <script>{script}</script>
+def _derive_scrypt(password: bytes, salt: bytes, n: int, r: int, p: int) -> bytes:
 
-</body>
+    return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 1024 * 1024, dklen=32)
 
-</html>
 
-    ''',
 
-   
+def _derive_pbkdf2_sha256(password: bytes, salt: bytes, iterations: int) -> bytes:
 
-    'login': '''
+    return hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
 
-<div class="auth-container">
 
-    <div class="auth-card">
 
-        <h2>Iniciar Sesión</h2>
+# KDFs disponibles: nombre -> (función de derivación, parámetros actuales).
 
-        {error}
+# Un hash con otro KDF u otros parámetros se recalcula en el siguiente login
 
-        <form method="POST" class="auth-form">
+PASSWORD_KDFS = {
 
-            <div class="form-group">
+    'scrypt': (_derive_scrypt, {'n': SCRYPT_N, 'r': SCRYPT_R, 'p': SCRYPT_P}),
 
-                <label>Usuario:</label>
+    'pbkdf2_sha256': (_derive_pbkdf2_sha256, {'iterations': PBKDF2_ITERATIONS})
 
-                <input type="text" name="username" required>
+}
 
-            </div>
 
-            <div class="form-group">
 
-                <label>Contraseña:</label>
+def _b64(data: bytes) -> str:
 
-                <input type="password" name="password" required>
+    return base64.b64encode(data).decode('ascii').rstrip('=')
 
-            </div>
 
-            <button type="submit" class="btn btn-primary">Iniciar Sesión</button>
 
-        </form>
+def _unb64(data: str) -> bytes:
 
-        <p style="text-align: center; margin-top: 1rem;">
+    return base64.b64decode(data + '=' * (-len(data) % 4))
 
-            ¿No tienes cuenta? <a href="/register" style="color: #00ff88;">Regístrate aquí</a>
 
-        </p>
 
-        <div class="test-users">
+def hash_password(password: str, kdf: str = PASSWORD_KDF) -> str:
 
-            <h4>Usuarios de Prueba:</h4>
+    """kdf$param=valor,...$sal$hash: cada usuario guarda cómo se calculó su hash"""
 
-            <p><strong>Usuario: trader1 / Contraseña: password123</strong></p>
+    derive, params = PASSWORD_KDFS[kdf]
 
-            <p><strong>Usuario: trader2 / Contraseña: password123</strong></p>
+    salt = os.urandom(KDF_SALT_BYTES)
 
-            <p><strong>Usuario: trader3 / Contraseña: password123</strong></p>
+    encoded_params = ','.join(f'{key}={value}' for key, value in params.items())
 
-        </div>
+    return f'{kdf}${encoded_params}${_b64(salt)}${_b64(derive(password.encode("utf-8"), salt, **params))}'
 
-    </div>
 
-</div>
 
-    ''',
+def verify_password(password: str, stored: str, kdf: str = PASSWORD_KDF) -> Tuple[bool, bool]:
 
-   
+    """Devuelve (coincide, hay que recalcularlo con el KDF y parámetros actuales)"""
 
-    'register': '''
+    if '$' not in stored:
 
-<div class="auth-container">
+        # Hash heredado: SHA-256 sin sal
 
-    <div class="auth-card">
+        legacy = hashlib.sha256(password.encode('utf-8')).hexdigest()
 
-        <h2>Crear Cuenta</h2>
+        return hmac.compare_digest(legacy, stored), True
 
-        {error}
+    try:
 
-        <form method="POST" class="auth-form">
+        name, encoded_params, salt, expected = stored.split('$')
 
-            <div class="form-group">
+        derive, current = PASSWORD_KDFS[name]
 
-                <label>Usuario:</label>
+        params = {key: int(value) for key, value in (item.split('=') for item in encoded_params.split(','))}
 
-                <input type="text" name="username" required>
+        derived = derive(password.encode('utf-8'), _unb64(salt), **params)
 
-            </div>
+    except (KeyError, TypeError, ValueError):
 
-            <div class="form-group">
+        return False, False
 
-                <label>Email:</label>
+    return hmac.compare_digest(derived, _unb64(expected)), (name != kdf or params != current)
 
-                <input type="email" name="email" required>
 
-            </div>
 
-            <div class="form-group">
+class PasswordPoolBusy(Exception):
 
-                <label>Contraseña:</label>
+    """Demasiados cálculos de KDF pendientes: mejor un 503 que ocupar todos los hilos"""
 
-                <input type="password" name="password" required>
 
-            </div>
 
-            <button type="submit" class="btn btn-primary">Registrarse</button>
+class PasswordPool:
 
-        </form>
+    """Pool de procesos dedicado a hash_password/verify_password.
 
-        <p style="text-align: center; margin-top: 1rem;">
 
-            ¿Ya tienes cuenta? <a href="/login" style="color: #00ff88;">Inicia sesión aquí</a>
 
-        </p>
+    Se crea al primer uso (en pre-fork, dentro de cada worker) con el método
 
-    </div>
+    'spawn': hacer fork de un proceso con hilos puede heredar locks tomados.
 
-</div>
+    Los hilos del servidor esperan el resultado sin retener el GIL, y como
 
-    ''',
+    mucho max_pending esperan a la vez; el resto recibe PasswordPoolBusy.
 
-   
+    Con processes=0 el hash se calcula en el propio hilo (modo single, donde
 
-    'dashboard': '''
+    un único hilo atiende todo y esperar a otro proceso no libera nada).
 
-<div class="dashboard">
+    Los contadores se actualizan bajo el mismo lock que `pending`.
 
-    <div class="dashboard-header">
+    """
 
-        <h1>Mercado P2P</h1>
+    def __init__(self, kdf: str = PASSWORD_KDF, processes: int = KDF_PROCESSES,
 
-       
+                 max_pending: int = kdf_max_pending(SERVER_WORKERS)):
 
-        <div class="user-balance">
+        self.kdf = kdf
 
-            <h3>Tu Billetera</h3>
+        self.processes = processes
 
-            <div class="balance-grid">
+        self.max_pending = max_pending
 
-                {balance_items}
+        self._executor: Optional[ProcessPoolExecutor] = None
 
-            </div>
+        self._lock = threading.Lock()
 
-        </div>
+        self.pending = 0
 
-    </div>
+        self.hashed = 0
 
+        self.verified = 0
 
+        self.rehashed = 0
 
-    <div class="dashboard-content">
+        self.busy = 0
 
-        <div class="orders-section">
+        self._dummy_hash: Optional[str] = None
 
-            <h2>Anuncios del Mercado ({orders_count})</h2>
 
-            {message}
 
-            <div class="orders-grid" id="ordersGrid">
+    def _run(self, fn, *args):
 
-                {orders}
+        with self._lock:
 
-            </div>
+            if self.pending >= self.max_pending:
 
-        </div>
+                self.busy += 1
 
+                raise PasswordPoolBusy()
 
+            self.pending += 1
 
-        <div class="create-order-section">
+            if self._executor is None and self.processes > 0:
 
-            <h2>Crear Anuncio</h2>
+                self._executor = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context('spawn'))
 
-            <form id="createOrderForm" class="order-form">
+        try:
 
-                <div class="form-row">
+            if self._executor is None:
 
-                    <div class="form-group">
+                return fn(*args)
 
-                        <label>Tipo:</label>
+            return self._executor.submit(fn, *args).result()
 
-                        <select name="order_type" required>
+        finally:
 
-                            <option value="BUY">COMPRAR</option>
+            with self._lock:
 
-                            <option value="SELL">VENDER</option>
+                self.pending -= 1
 
-                        </select>
 
-                    </div>
 
-                    <div class="form-group">
+    def hash(self, password: str) -> str:
 
-                        <label>Activo:</label>
+        with self._lock:
 
-                        <select name="asset" required>
+            self.hashed += 1
 
-                            <option value="USDT">USDT</option>
+        return self._run(hash_password, password, self.kdf)
 
-                            <option value="BTC">BTC</option>
 
-                            <option value="ETH">ETH</option>
 
-                        </select>
+    def verify(self, password: str, stored: str) -> Tuple[bool, bool]:
 
-                    </div>
+        with self._lock:
 
-                </div>
+            self.verified += 1
 
+        return self._run(verify_password, password, stored, self.kdf)
 
 
-                <div class="form-row">
 
-                    <div class="form-group">
+    def record_rehash(self, count: int = 1):
 
-                        <label>Moneda:</label>
+        with self._lock:
 
-                        <select name="fiat" required>
+            self.rehashed += count
 
-                            <option value="USD">USD</option>
 
-                            <option value="EUR">EUR</option>
 
-                        </select>
+    def dummy_hash(self) -> str:
 
-                    </div>
+        """Hash de una contraseña aleatoria con el que se compara un login de usuario
 
-                    <div class="form-group">
+        inexistente; se calcula una vez por proceso, en el primer uso"""
 
-                        <label>Precio:</label>
+        if self._dummy_hash is None:
 
-                        <input type="number" step="0.01" name="price" required>
+            # Dos hilos pueden calcularlo a la vez: cualquiera de los dos sirve
 
-                    </div>
+            self._dummy_hash = self._run(hash_password, secrets.token_hex(8), self.kdf)
 
-                </div>
+        return self._dummy_hash
 
-               
 
-                <div class="form-group">
 
-                    <label>Cantidad:</label>
+    def shutdown(self):
 
-                    <input type="number" step="0.01" name="quantity" required>
+        if self._executor is not None:
 
-                </div>
+            self._executor.shutdown(wait=False, cancel_futures=True)
 
+            self._executor = None
 
 
-                <div class="form-group">
 
-                    <label>Mínimo:</label>
+    def stats(self) -> Dict[str, any]:
 
-                    <input type="number" step="0.01" name="min_amount" required>
+        with self._lock:
 
-                </div>
+            return {
 
+                'kdf': self.kdf,
 
+                'processes': self.processes,
 
-                <div class="form-group">
+                'pending': self.pending,
 
-                    <label>Máximo:</label>
+                'max_pending': self.max_pending,
 
-                    <input type="number" step="0.01" name="max_amount" required>
+                'hashed': self.hashed,
 
-                </div>
+                'verified': self.verified,
 
+                'rehashed': self.rehashed,
 
+                'busy_rejections': self.busy
 
-                <button type="submit" class="btn btn-primary">Publicar Anuncio</button>
+            }
 
-            </form>
 
-        </div>
 
-    </div>
+password_pool = PasswordPool()
 
-</div>
 
-    '''
 
-}
+class SessionStore:
 
+    """Tokens de sesión firmados: user_id.username.expira.sid.firma (HMAC-SHA256).
 
 
-class P2PRequestHandler(http.server.SimpleHTTPRequestHandler):
 
-    def do_GET(self):
+    Verificar un token es recalcular un HMAC, sin consultar SQLite; los tokens
 
-        print(f"GET request: {self.path}")
+    ya verificados quedan en un LRU, así que una petición repetida solo cuesta
 
-        try:
+    una búsqueda en un dict. La revocación (logout) mantiene el conjunto de sids
 
-            if self.path == '/':
+    revocados que aún no han caducado; P2PSystem lo recarga cuando cambia.
 
-                self.send_response(302)
+    """
 
-                self.send_header('Location', '/login')
+    def __init__(self, secret: bytes, ttl: int = SESSION_TTL, size: int = SESSION_CACHE_SIZE):
 
-                self.end_headers()
+        self._secret = secret
 
-                return
+        self.ttl = ttl
 
-               
+        self.size = size
 
-            elif self.path == '/login':
+        self._cache: OrderedDict = OrderedDict()
 
-                self.serve_login()
+        self._revoked: Dict[str, float] = {}
 
-            elif self.path == '/register':
+        self.revoked_version = None
 
-                self.serve_register()
+        self._lock = threading.Lock()
 
-            elif self.path == '/dashboard':
+        self.hits = 0
 
-                self.serve_dashboard()
+        self.misses = 0
 
-            elif self.path == '/logout':
+        self.rejected = 0
 
-                self.do_logout()
 
-            elif self.path.startswith('/trade_status/'):
 
-                self.handle_trade_status()
+    def _sign(self, payload: str) -> str:
 
-            else:
+        digest = hmac.new(self._secret, payload.encode('utf-8'), hashlib.sha256).digest()
 
-                self.send_error(404)
+        return base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
 
-        except Exception as e:
 
-            print(f"Error in GET: {e}")
 
-            self.send_error(500)
+    def issue(self, user_id: int, username: str) -> str:
 
-   
+        expires = int(time.time()) + self.ttl
 
-    def do_POST(self):
+        sid = secrets.token_urlsafe(12)
 
-        print(f"POST request: {self.path}")
+        name = base64.urlsafe_b64encode(username.encode('utf-8')).rstrip(b'=').decode('ascii')
 
-        try:
+        payload = f'{user_id}.{name}.{expires}.{sid}'
 
-            if self.path == '/login':
+        token = f'{payload}.{self._sign(payload)}'
 
-                self.handle_login()
+        self._remember(token, {'user_id': str(user_id), 'username': username, 'expires': expires, 'sid': sid})
 
-            elif self.path == '/register':
+        return token
 
-                self.handle_register()
 
-            elif self.path == '/create_order':
 
-                self.handle_create_order()
+    def decode(self, token: str) -> Optional[Dict[str, any]]:
 
-            elif self.path == '/start_trade':
+        """Comprueba la firma y devuelve los datos del token (sin mirar caducidad ni revocación);
 
-                self.handle_start_trade()
+        None para cualquier token mal formado: la cookie la controla el cliente"""
 
-            elif self.path == '/confirm_payment':
+        # compare_digest no admite str con caracteres no ASCII (TypeError)
 
-                self.handle_confirm_payment()
+        if not token.isascii():
 
-            else:
+            return None
 
-                self.send_error(404)
+        parts = token.split('.')
 
-        except Exception as e:
+        if len(parts) != 5:
 
-            print(f"Error in POST: {e}")
+            return None
 
-            self.send_error(500)
+        payload = '.'.join(parts[:4])
 
-   
+        if not hmac.compare_digest(parts[4].encode('ascii'), self._sign(payload).encode('ascii')):
 
-    def get_session(self):
+            return None
 
-        cookies = self.headers.get('Cookie', '')
+        user_id, name, expires, sid = parts[:4]
 
-        session_data = {}
+        try:
 
-        for cookie in cookies.split(';'):
+            username = base64.urlsafe_b64decode(name + '=' * (-len(name) % 4)).decode('utf-8')
 
-            if '=' in cookie:
+            return {'user_id': str(int(user_id)), 'username': username, 'expires': int(expires), 'sid': sid}
 
-                key, value = cookie.strip().split('=', 1)
+        except ValueError:
 
-                session_data[key] = value
+            return None
 
-        return session_data
 
-   
 
-    def set_session(self, key, value):
+    def _remember(self, token: str, claims: Dict[str, any]):
 
-        self.send_header('Set-Cookie', f'{key}={value}; Path=/')
+        with self._lock:
 
-   
+            self._cache[token] = claims
 
-    def serve_login(self, error=None):
+            if len(self._cache) > self.size:
 
-        session = self.get_session()
+                self._cache.popitem(last=False)
 
-        if 'user_id' in session:
 
-            self.send_response(302)
 
-            self.send_header('Location', '/dashboard')
+    def verify(self, token: str) -> Optional[Dict[str, any]]:
 
-            self.end_headers()
+        with self._lock:
 
-            return
+            claims = self._cache.get(token)
 
-       
+            if claims is not None:
 
-        error_html = f'<div class="alert alert-error">{error}</div>' if error else ''
+                self._cache.move_to_end(token)
 
-        content = HTML_TEMPLATES['login'].format(error=error_html)
+                self.hits += 1
 
-        self.serve_page('Login - P2P Trading', content, '')
+            else:
 
-   
+                self.misses += 1
 
-    def serve_register(self, error=None):
+        if claims is None:
 
-        session = self.get_session()
+            # El HMAC se calcula fuera del lock
 
-        if 'user_id' in session:
+            claims = self.decode(token)
 
-            self.send_response(302)
+            if claims is None:
 
-            self.send_header('Location', '/dashboard')
+                with self._lock:
 
-            self.end_headers()
+                    self.rejected += 1
 
-            return
+                return None
 
-       
+            self._remember(token, claims)
 
-        error_html = f'<div class="alert alert-error">{error}</div>' if error else ''
+        with self._lock:
 
-        content = HTML_TEMPLATES['register'].format(error=error_html)
+            if claims['expires'] <= time.time() or claims['sid'] in self._revoked:
 
-        self.serve_page('Register - P2P Trading', content, '')
+                self._cache.pop(token, None)
 
-   
+                return None
 
-    def serve_dashboard(self, message=None):
+        return claims
 
-        session = self.get_session()
 
-        if 'user_id' not in session:
 
-            self.send_response(302)
+    def revoke(self, sid: str, expires: float):
 
-            self.send_header('Location', '/login')
+        with self._lock:
 
-            self.end_headers()
+            self._revoked[sid] = expires
 
-            return
 
-       
 
-        user_id = int(session['user_id'])
+    def load_revoked(self, revoked: Dict[str, float], version: int):
 
-        username = session.get('username', 'Usuario')
+        with self._lock:
 
-       
+            self._revoked = revoked
 
-        # Obtener balance
+            self.revoked_version = version
 
-        balance = p2p_system.get_user_balance(user_id)
 
-        balance_items = ''
 
-        for asset, bal in balance.items():
+    def stats(self) -> Dict[str, any]:
 
-            balance_items += f'''
+        with self._lock:
 
-                <div class="balance-item">
+            return {
 
-                    <strong>{asset}</strong><br>
+                'cached': len(self._cache),
 
-                    Disponible: {bal["available"]:.2f}<br>
+                'revoked': len(self._revoked),
 
-                    Bloqueado: {bal["locked"]:.2f}<br>
+                'hits': self.hits,
 
-                    Total: {bal["total"]:.2f}
+                'misses': self.misses,
 
-                </div>
+                'rejected': self.rejected
 
-            '''
+            }
 
-       
 
-        # Obtener órdenes
 
-        orders = p2p_system.get_orders()
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
 
-        orders_html = ''
+WS_TEXT, WS_CLOSE, WS_PING, WS_PONG = 0x1, 0x8, 0x9, 0xA
 
-       
 
-        for order in orders:
 
-            order_type_class = 'buy' if order.order_type.value == 'BUY' else 'sell'
+class WebSocketError(Exception):
 
-            order_type_text = 'COMPRA' if order.order_type.value == 'BUY' else 'VENTA'
+    """Frame inválido del cliente; la conexión se cierra con `code`"""
 
-           
+    def __init__(self, message: str, code: int = 1002):
 
-            if order.order_type.value == 'BUY':
+        super().__init__(message)
 
-                button_class = 'btn-buy'
+        self.code = code
 
-                button_text = 'Vender'
 
-                action = 'vender'
 
-            else:
+def ws_handshake(key: str) -> bytes:
 
-                button_class = 'btn-sell'
+    accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode('ascii')).digest()).decode('ascii')
 
-                button_text = 'Comprar'
+    return (
 
-                action = 'comprar'
+        'HTTP/1.1 101 Switching Protocols\r\n'
 
-           
+        'Upgrade: websocket\r\n'
 
-            orders_html += f'''
+        'Connection: Upgrade\r\n'
 
-                <div class="order-card {order_type_class}">
+        f'Sec-WebSocket-Accept: {accept}\r\n\r\n'
 
-                    <div class="order-header">
+    ).encode('ascii')
 
-                        <strong>{order.username}</strong>
 
-                        <span>{order_type_text}</span>
 
-                        <strong>{order.price} {order.fiat}</strong>
+def ws_frame(opcode: int, payload: bytes = b'') -> bytes:
 
-                    </div>
+    """Frame del servidor: siempre FIN y sin máscara"""
 
-                    <div>
+    length = len(payload)
 
-                        <p>Cantidad: {order.available_quantity} {order.asset}</p>
+    if length < 126:
 
-                        <p>Límites: {order.min_amount} - {order.max_amount} {order.fiat}</p>
+        head = struct.pack('!BB', 0x80 | opcode, length)
 
-                        <p>Métodos: {", ".join(order.payment_methods)}</p>
+    elif length < 65536:
 
-                    </div>
+        head = struct.pack('!BBH', 0x80 | opcode, 126, length)
 
-                    <form class="trade-form" onsubmit="startTrade(event, {order.id})">
+    else:
 
-                        <input type="number" step="0.01" min="{order.min_amount / order.price}" max="{order.available_quantity}" placeholder="Cantidad a {action}" required>
+        head = struct.pack('!BBQ', 0x80 | opcode, 127, length)
 
-                        <button type="submit" class="btn {button_class}">{button_text}</button>
+    return head + payload
 
-                    </form>
 
-                </div>
 
-            '''
+def ws_close_frame(code: int) -> bytes:
 
-       
+    return ws_frame(WS_CLOSE, struct.pack('!H', code))
 
-        message_html = f'<div class="alert alert-success">{message}</div>' if message else ''
 
-        content = HTML_TEMPLATES['dashboard'].format(
 
-            balance_items=balance_items,
+class WebSocketParser:
 
-            orders=orders_html,
+    """Decodifica los frames del cliente a partir de bytes sueltos, sin hacer E/S.
 
-            message=message_html,
 
-            orders_count=len(orders)
 
-        )
+    Lo comparten el servidor por hilos y el front end asyncio: cada uno lee
 
-       
+    del socket a su manera y pasa aquí lo recibido.
 
-        nav_menu = f'''
+    """
 
-            <span class="nav-user">{username}</span>
+    def __init__(self, max_message: int = WS_MAX_MESSAGE):
 
-            <a href="/dashboard" class="nav-link">Inicio</a>
+        self.max_message = max_message
 
-            <a href="/logout" class="nav-link">Salir</a>
+        self._buffer = bytearray()
 
-        '''
+        self._fragments: List[bytes] = []
 
-       
+        self._opcode = None
 
-        modal = '''
 
-        <div id="tradeModal" class="modal">
 
-            <div class="modal-content">
+    def feed(self, data: bytes) -> List[Tuple[int, bytes]]:
 
-                <h2>Confirmación de Pago</h2>
+        """Devuelve los mensajes completos como (opcode, payload)"""
 
-                <div style="font-size: 2rem; margin: 1rem 0;" id="countdown">15:00</div>
+        self._buffer += data
 
-                <div id="statusMessage">Esperando pago...</div>
+        messages = []
 
-                <button class="btn btn-warning" onclick="simulatePayment()" id="simulateBtn">Simular Pago</button>
+        while len(self._buffer) >= 2:
 
-                <button class="btn btn-primary" onclick="closeModal()" style="margin-top: 1rem; display: none;" id="closeBtn">Finalizar</button>
+            first, second = self._buffer[0], self._buffer[1]
 
-            </div>
+            if not second & 0x80:
 
-        </div>
+                raise WebSocketError("Frame del cliente sin máscara")
 
-        '''
+            length, offset = second & 0x7F, 2
 
-       
+            if length == 126:
 
-        script = '''
+                if len(self._buffer) < 4:
 
-        let currentTradeId = null;
+                    break
 
-        let countdownInterval = null;
+                length, offset = struct.unpack_from('!H', self._buffer, 2)[0], 4
 
+            elif length == 127:
 
+                if len(self._buffer) < 10:
 
-        function startTrade(event, orderId) {
+                    break
 
-            event.preventDefault();
+                length, offset = struct.unpack_from('!Q', self._buffer, 2)[0], 10
 
-            const form = event.target;
+            if length > self.max_message:
 
-            const quantity = parseFloat(form.querySelector('input').value);
+                raise WebSocketError("Mensaje demasiado grande", 1009)
 
-           
+            end = offset + 4 + length
 
-            fetch('/start_trade', {
+            if len(self._buffer) < end:
 
-                method: 'POST',
+                break
 
-                headers: {
+            mask = bytes(self._buffer[offset:offset + 4]) * (length // 4 + 1)
 
-                    'Content-Type': 'application/x-www-form-urlencoded',
+            payload = (int.from_bytes(self._buffer[offset + 4:end], 'big')
 
-                },
+                       ^ int.from_bytes(mask[:length], 'big')).to_bytes(length, 'big')
 
-                body: new URLSearchParams({
+            del self._buffer[:end]
 
-                    'order_id': orderId,
 
-                    'quantity': quantity
 
-                })
+            opcode = first & 0x0F
 
-            })
+            if opcode >= WS_CLOSE:
 
-            .then(response => response.text())
+                # Los frames de control pueden llegar entre fragmentos
 
-            .then(tradeId => {
+                messages.append((opcode, payload))
 
-                if (tradeId) {
+                continue
 
-                    currentTradeId = tradeId;
+            if opcode:
 
-                    showPaymentModal();
+                self._opcode = opcode
 
-                    startCountdown();
+            self._fragments.append(payload)
 
-                } else {
+            if sum(len(fragment) for fragment in self._fragments) > self.max_message:
 
-                    alert('Error al iniciar trade');
+                raise WebSocketError("Mensaje demasiado grande", 1009)
 
-                }
+            if first & 0x80:
 
-            });
+                messages.append((self._opcode, b''.join(self._fragments)))
 
-        }
+                self._fragments = []
 
+        return messages
 
 
-        function showPaymentModal() {
 
-            document.getElementById('tradeModal').style.display = 'block';
+class MarketDataSession:
 
-        }
+    """Suscripciones de un cliente del feed de profundidad, sin E/S.
 
 
 
-        function closeModal() {
+    Al suscribirse a un par se envía un snapshot con los MARKET_DATA_DEPTH
 
-            document.getElementById('tradeModal').style.display = 'none';
+    mejores niveles de cada lado; después, flush() envía un único diff por par
 
-            if (countdownInterval) {
+    con los niveles añadidos, cambiados o eliminados desde el último mensaje.
 
-                clearInterval(countdownInterval);
+    Los cambios solo marcan el par como pendiente, así que una ráfaga (o un
 
-            }
+    cliente lento) se agrupa en un diff en lugar de acumular una cola.
 
-            location.reload();
 
-        }
 
+    `seq` es la versión del libro y `prev_seq` la del mensaje anterior de ese
 
+    par: si no coincide con lo recibido, el cliente debe volver a suscribirse.
 
-        function startCountdown() {
+    """
 
-            let timeLeft = 15 * 60;
+    def __init__(self, system: 'P2PSystem', wake):
 
-            const countdownElement = document.getElementById('countdown');
+        self.system = system
 
-           
+        # Llamado desde el hilo que modificó el libro: solo debe despertar al transporte
 
-            countdownInterval = setInterval(() => {
+        self.wake = wake
 
-                timeLeft--;
+        self._lock = threading.Lock()
 
-                const minutes = Math.floor(timeLeft / 60);
+        self._dirty = set()
 
-                const seconds = timeLeft % 60;
+        self._subscriptions: Dict[Tuple[str, str], Dict[str, any]] = {}
 
-                countdownElement.textContent = `${minutes.toString().padStart(2, '0')}:${seconds.toString().padStart(2, '0')}`;
 
-               
 
-                if (timeLeft <= 0) {
+    @staticmethod
 
-                    clearInterval(countdownInterval);
+    def parse_pair(value) -> Optional[Tuple[str, str]]:
 
-                    document.getElementById('statusMessage').textContent = 'Tiempo agotado';
+        asset, _, fiat = str(value or '').upper().partition('/')
 
-                }
+        if asset in ASSETS and fiat in FIATS:
 
-            }, 1000);
+            return asset, fiat
 
-        }
+        return None
 
 
 
-        function simulatePayment() {
+    def handle(self, text: str) -> List[Dict[str, any]]:
 
-            document.getElementById('simulateBtn').style.display = 'none';
+        """Procesa un mensaje del cliente y devuelve las respuestas"""
 
-            document.getElementById('statusMessage').textContent = 'Procesando pago...';
+        try:
 
-           
+            message = json.loads(text)
 
-            setTimeout(() => {
+            op = message['op']
 
-                fetch('/confirm_payment', {
+            pair = self.parse_pair(message.get('pair'))
 
-                    method: 'POST',
+        except (ValueError, TypeError, KeyError):
 
-                    headers: {
+            return [{'type': 'error', 'error': 'Mensaje inválido'}]
 
-                        'Content-Type': 'application/x-www-form-urlencoded',
+        if pair is None:
 
-                    },
+            return [{'type': 'error', 'error': 'Par no soportado'}]
 
-                    body: new URLSearchParams({
+        if op == 'subscribe':
 
-                        'trade_id': currentTradeId
+            return [self._subscribe(pair)]
 
-                    })
+        if op == 'unsubscribe':
 
-                })
+            state = self._subscriptions.pop(pair, None)
 
-                .then(response => {
+            if state:
 
-                    if (response.ok) {
+                state['unsubscribe']()
 
-                        document.getElementById('statusMessage').textContent = '¡Pago confirmado! Fondos agregados a tu billetera.';
+            return [{'type': 'unsubscribed', 'pair': '/'.join(pair)}]
 
-                        document.getElementById('closeBtn').style.display = 'block';
+        return [{'type': 'error', 'error': f'Operación desconocida: {op}'}]
 
-                        if (countdownInterval) {
 
-                            clearInterval(countdownInterval);
 
-                        }
+    def _subscribe(self, pair: Tuple[str, str]) -> Dict[str, any]:
 
-                    }
+        state = self._subscriptions.get(pair)
 
-                });
+        if state is None:
 
-            }, 2000);
+            state = self._subscriptions[pair] = {
 
-        }
+                'unsubscribe': self.system.events.subscribe(
 
+                    P2PSystem.book_topic(*pair), lambda _version, pair=pair: self._mark(pair)
 
+                )
 
-        document.getElementById('createOrderForm').addEventListener('submit', function(event) {
+            }
 
-            event.preventDefault();
+        return self._snapshot(pair, state)
 
-            const formData = new FormData(this);
 
-           
 
-            fetch('/create_order', {
+    def _snapshot(self, pair: Tuple[str, str], state: Dict[str, any]) -> Dict[str, any]:
 
-                method: 'POST',
+        book = self.system.get_book(*pair)
 
-                body: formData
+        seq, depth = book.snapshot(MARKET_DATA_DEPTH)
 
-            })
+        state.update(book=book, seq=seq, levels=self._levels(depth))
 
-            .then(response => {
+        message = {'type': 'snapshot', 'pair': '/'.join(pair), 'seq': seq}
 
-                if (response.ok) {
+        for side, levels in depth.items():
 
-                    alert('Anuncio creado exitosamente!');
+            message[side.value] = [list(level) for level in levels]
 
-                    location.reload();
+        return message
 
-                } else {
 
-                    alert('Error al crear anuncio');
 
-                }
+    @staticmethod
 
-            });
+    def _levels(depth) -> Dict[OrderType, Dict[float, Tuple[float, int]]]:
 
-        });
+        return {side: {price: (quantity, count) for price, quantity, count in levels}
 
-        '''
+                for side, levels in depth.items()}
 
-       
 
-        self.serve_page('Dashboard - P2P Trading', content, nav_menu, script, modal)
 
-   
+    def _mark(self, pair: Tuple[str, str]):
 
-    def handle_login(self):
+        with self._lock:
 
-        content_length = int(self.headers['Content-Length'])
+            self._dirty.add(pair)
 
-        post_data = self.rfile.read(content_length).decode('utf-8')
+        self.wake()
 
-        params = parse_qs(post_data)
 
-       
 
-        username = params.get('username', [''])[0]
+    def poll(self):
 
-        password = params.get('password', [''])[0]
+        """Prefork: los cambios de otros procesos solo llegan al sincronizar el libro"""
 
-       
+        self.system.sync_order_books()
 
-        user = p2p_system.authenticate_user(username, password)
 
-        if user:
 
-            self.send_response(302)
+    def flush(self) -> List[Dict[str, any]]:
 
-            self.set_session('user_id', str(user.id))
+        with self._lock:
 
-            self.set_session('username', user.username)
+            dirty, self._dirty = self._dirty, set()
 
-            self.send_header('Location', '/dashboard')
+        messages = []
 
-            self.end_headers()
+        for pair in dirty:
 
-        else:
+            state = self._subscriptions.get(pair)
 
-            self.serve_login("Usuario o contraseña incorrectos")
+            if state is None:
 
-   
+                continue
 
-    def handle_register(self):
+            book = self.system.get_book(*pair)
 
-        content_length = int(self.headers['Content-Length'])
+            if book is not state['book']:
 
-        post_data = self.rfile.read(content_length).decode('utf-8')
+                # El libro se recargó entero: su versión empieza de nuevo
 
-        params = parse_qs(post_data)
+                messages.append(self._snapshot(pair, state))
 
-       
+                continue
 
-        username = params.get('username', [''])[0]
+            seq, depth = book.snapshot(MARKET_DATA_DEPTH)
 
-        email = params.get('email', [''])[0]
+            levels = self._levels(depth)
 
-        password = params.get('password', [''])[0]
+            changes = []
 
-       
+            for side, current in levels.items():
 
-        if p2p_system.register_user(username, email, password):
+                previous = state['levels'][side]
 
-            self.send_response(302)
+                for price, (quantity, count) in current.items():
 
-            self.send_header('Location', '/login')
+                    if previous.get(price) != (quantity, count):
 
-            self.end_headers()
+                        changes.append({'side': side.value, 'price': price,
 
-        else:
+                                        'action': 'change' if price in previous else 'add',
 
-            self.serve_register("Usuario o email ya existen")
+                                        'quantity': quantity, 'orders': count})
 
-   
+                for price in previous.keys() - current.keys():
 
-    def handle_create_order(self):
+                    changes.append({'side': side.value, 'price': price, 'action': 'remove'})
 
-        session = self.get_session()
+            state['levels'] = levels
 
-        if 'user_id' not in session:
+            if changes:
 
-            self.send_response(401)
+                messages.append({'type': 'diff', 'pair': '/'.join(pair),
 
-            self.end_headers()
+                                 'prev_seq': state['seq'], 'seq': seq, 'changes': changes})
+
+                state['seq'] = seq
+
+        return messages
+
+
+
+    def close(self):
+
+        for state in self._subscriptions.values():
+
+            state['unsubscribe']()
+
+        self._subscriptions.clear()
+
+
+
+class ConnectionPoolTimeout(Exception):
+
+    """No se liberó ninguna conexión del pool dentro del tiempo de espera"""
+
+
+
+class ConnectionPool:
+
+    """Pool acotado de conexiones SQLite reutilizables.
+
+
+
+    Las conexiones se abren bajo demanda hasta `size` y se devuelven a una
+
+    cola LIFO, de modo que la siguiente petición recibe la conexión más
+
+    "caliente" (páginas y sentencias preparadas ya en caché). Cada conexión
+
+    nueva recibe los PRAGMAs del perfil de almacenamiento activo.
+
+    """
+
+    def __init__(self, db_name: str, size: int = DB_POOL_SIZE, timeout: float = DB_POOL_TIMEOUT,
+
+                 profile: str = STORAGE_PROFILE):
+
+        if profile not in STORAGE_PROFILES:
+
+            raise ValueError(f"Perfil de almacenamiento desconocido: {profile}")
+
+        self.db_name = db_name
+
+        self.size = size
+
+        self.timeout = timeout
+
+        self.profile = profile
+
+        self._idle = queue.LifoQueue(maxsize=size)
+
+        self._lock = threading.Lock()
+
+        self._created = 0
+
+        self._in_use = 0
+
+        self._checkouts = 0
+
+        self._waits = 0
+
+        self._timeouts = 0
+
+        self._wait_time = 0.0
+
+
+
+    def _connect(self) -> sqlite3.Connection:
+
+        pragmas = STORAGE_PROFILES[self.profile]
+
+        conn = sqlite3.connect(
+
+            self.db_name,
+
+            timeout=pragmas['busy_timeout'] / 1000,
+
+            check_same_thread=False,
+
+            cached_statements=DB_STATEMENT_CACHE
+
+        )
+
+        for pragma, value in pragmas.items():
+
+            conn.execute(f'PRAGMA {pragma} = {value}')
+
+        return conn
+
+
+
+    def describe(self) -> Dict[str, any]:
+
+        """PRAGMAs efectivos de una conexión del pool (SQLite puede rechazar alguno, p.ej. WAL en :memory:)"""
+
+        with self.connection() as conn:
+
+            effective = {
+
+                pragma: conn.execute(f'PRAGMA {pragma}').fetchone()[0]
+
+                for pragma in STORAGE_PROFILES[self.profile]
+
+            }
+
+        return {'profile': self.profile, 'pragmas': effective}
+
+
+
+    def acquire(self, timeout: Optional[float] = None) -> sqlite3.Connection:
+
+        try:
+
+            conn = self._idle.get_nowait()
+
+        except queue.Empty:
+
+            with self._lock:
+
+                can_create = self._created < self.size
+
+                if can_create:
+
+                    self._created += 1
+
+            if can_create:
+
+                try:
+
+                    conn = self._connect()
+
+                except Exception:
+
+                    with self._lock:
+
+                        self._created -= 1
+
+                    raise
+
+            else:
+
+                wait = self.timeout if timeout is None else timeout
+
+                started = time.perf_counter()
+
+                try:
+
+                    conn = self._idle.get(timeout=wait)
+
+                except queue.Empty:
+
+                    with self._lock:
+
+                        self._timeouts += 1
+
+                    raise ConnectionPoolTimeout(
+
+                        f"Sin conexiones libres tras {wait:.1f}s (pool de {self.size})"
+
+                    )
+
+                with self._lock:
+
+                    self._waits += 1
+
+                    self._wait_time += time.perf_counter() - started
+
+
+
+        with self._lock:
+
+            self._in_use += 1
+
+            self._checkouts += 1
+
+        return conn
+
+
+
+    def release(self, conn: sqlite3.Connection):
+
+        with self._lock:
+
+            self._in_use -= 1
+
+        try:
+
+            # Nunca devolver al pool una transacción a medias
+
+            if conn.in_transaction:
+
+                conn.rollback()
+
+        except sqlite3.Error:
+
+            conn.close()
+
+            with self._lock:
+
+                self._created -= 1
+
+            return
+
+        self._idle.put_nowait(conn)
+
+
+
+    @contextmanager
+
+    def connection(self):
+
+        conn = self.acquire()
+
+        try:
+
+            yield conn
+
+        finally:
+
+            self.release(conn)
+
+
+
+    def close_all(self):
+
+        """Cierra las conexiones inactivas.
+
+
+
+        Las que están prestadas no se tocan: release() las devuelve a la cola
+
+        como siempre y se cerrarán en el siguiente close_all(). Tras un reset
+
+        el pool sigue siendo utilizable y abre conexiones nuevas bajo demanda.
+
+        """
+
+        while True:
+
+            try:
+
+                conn = self._idle.get_nowait()
+
+            except queue.Empty:
+
+                break
+
+            conn.close()
+
+            with self._lock:
+
+                self._created -= 1
+
+
+
+    def stats(self) -> Dict[str, any]:
+
+        with self._lock:
+
+            return {
+
+                'profile': self.profile,
+
+                'size': self.size,
+
+                'created': self._created,
+
+                'in_use': self._in_use,
+
+                'idle': self._idle.qsize(),
+
+                'checkouts': self._checkouts,
+
+                'waits': self._waits,
+
+                'timeouts': self._timeouts,
+
+                'avg_wait_ms': round(self._wait_time / self._waits * 1000, 3) if self._waits else 0.0
+
+            }
+
+
+
+class QueryPlanError(Exception):
+
+    """Una consulta caliente dejó de usar índices (SCAN o ordenación temporal)"""
+
+
+
+class P2PSystem:
+
+    # Tablas con contador de versión (ver data_version)
+
+    VERSIONED_TABLES = ('p2p_orders', 'wallets', 'revoked_sessions', 'user_stats')
+
+
+
+    # Migraciones de esquema (versión, descripción, método); PRAGMA user_version
+
+    # guarda la última aplicada, así que un arranque en caliente no toca el esquema
+
+    MIGRATIONS = [
+
+        (1, "Tablas base", '_migration_base_tables'),
+
+        (2, "Índices gestionados", '_migration_managed_indexes'),
+
+        (3, "Registro de cambios de órdenes", '_migration_order_events'),
+
+        (4, "Secretos y sesiones revocadas", '_migration_sessions'),
+
+        (5, "Estadísticas de usuario materializadas", '_migration_user_stats'),
+
+        (6, "Índice del libro de órdenes reducido al estado", '_migration_narrow_order_index')
+
+    ]
+
+    SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+
+    def __init__(self, db_name: str = DB_NAME, pool_size: int = DB_POOL_SIZE,
+
+                 pool_timeout: float = DB_POOL_TIMEOUT, storage_profile: str = STORAGE_PROFILE,
+
+                 reset: bool = False, matching: bool = MATCHING_ENGINE):
+
+        self.db_name = db_name
+
+        self.pool = ConnectionPool(db_name, pool_size, pool_timeout, storage_profile)
+
+        self.books: Dict[Tuple[str, str], OrderBook] = {}
+
+        self._books_lock = threading.Lock()
+
+        self.matching = matching
+
+        # Feed de cambios entre procesos (solo en modo pre-fork)
+
+        self.change_feed: Optional[ClusterStats] = None
+
+        self._applied_seq = 0
+
+        # Serializa las escrituras (SQLite + libro en memoria) entre hilos del servidor
+
+        self._write_lock = threading.RLock()
+
+        self.engine_stats = {'orders': 0, 'matches': 0, 'matched_quantity': 0.0}
+
+        # Cambios de estado de los trades para los streams SSE
+
+        self.events = EventBus()
+
+        # Versiones para los ETags; empiezan en el reloj en µs para que, tras
+
+        # un reinicio, ninguna versión repita la de un ETag ya emitido
+
+        start = time.time_ns() // 1000
+
+        self._data_versions = {table: start for table in self.VERSIONED_TABLES}
+
+        self._versions_lock = threading.Lock()
+
+        # Caché de user_stats para las tarjetas de órdenes; válida mientras no cambie su versión
+
+        self._user_stats: Dict[int, UserStats] = {}
+
+        self._user_stats_version = None
+
+        self._user_stats_lock = threading.Lock()
+
+        self.init_database(reset)
+
+        self.sessions = SessionStore(self._load_session_secret())
+
+        self.load_order_books()
+
+   
+
+    def init_database(self, reset: bool = False):
+
+        if reset:
+
+            # Eliminar base de datos existente para forzar recreación
+
+            self.pool.close_all()
+
+            # (en modo WAL también quedan los ficheros -wal y -shm)
+
+            for path in (self.db_name, self.db_name + '-wal', self.db_name + '-shm'):
+
+                if os.path.exists(path):
+
+                    os.remove(path)
+
+
+
+        with self.pool.connection() as conn:
+
+            fresh = conn.execute(
+
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users'"
+
+            ).fetchone() is None
+
+            applied = self._migrate(conn)
+
+            if fresh:
+
+                # Insertar datos de ejemplo
+
+                self._create_sample_data(conn.cursor())
+
+                conn.commit()
+
+
+
+        if fresh:
+
+            print("✅ Base de datos creada correctamente")
+
+        else:
+
+            print(f"✅ Base de datos abierta: {self.db_name} (esquema v{self.SCHEMA_VERSION})")
+
+        self._report_storage_profile()
+
+        # En cada arranque: un plan también cambia con la versión de SQLite o el perfil
+
+        self.check_query_plans()
+
+        print(f"🔎 Planes de consulta verificados ({len(HOT_QUERIES)} consultas calientes)")
+
+
+
+    def _migrate(self, conn: sqlite3.Connection) -> List[int]:
+
+        """Aplica en orden las migraciones posteriores a PRAGMA user_version"""
+
+        applied = []
+
+        for version, description, step in self.MIGRATIONS:
+
+            if conn.execute('PRAGMA user_version').fetchone()[0] >= version:
+
+                continue
+
+            # BEGIN IMMEDIATE: si otro proceso migra a la vez, esperamos y revisamos la versión
+
+            conn.execute('BEGIN IMMEDIATE')
+
+            try:
+
+                if conn.execute('PRAGMA user_version').fetchone()[0] >= version:
+
+                    conn.rollback()
+
+                    continue
+
+                getattr(self, step)(conn.cursor())
+
+                conn.execute(f'PRAGMA user_version = {version}')
+
+                conn.commit()
+
+            except Exception:
+
+                conn.rollback()
+
+                raise
+
+            print(f"🧱 Migración v{version}: {description}")
+
+            applied.append(version)
+
+
+
+        current = conn.execute('PRAGMA user_version').fetchone()[0]
+
+        if current > self.SCHEMA_VERSION:
+
+            raise RuntimeError(
+
+                f"La base de datos {self.db_name} tiene el esquema v{current}, "
+
+                f"más nuevo que el de esta versión (v{self.SCHEMA_VERSION})"
+
+            )
+
+        return applied
+
+
+
+    def load_order_books(self):
+
+        """Carga una vez todas las órdenes abiertas en los libros en memoria"""
+
+        with self.pool.connection() as conn:
+
+            # Misma instantánea para el seq del feed y las órdenes
+
+            conn.execute('BEGIN')
+
+            applied_seq = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM order_events').fetchone()[0]
+
+            rows = conn.execute(OPEN_ORDERS_QUERY, [status.value for status in OrderBook.OPEN_STATUSES]).fetchall()
+
+        # idx_orders_status devuelve cada estado ya ordenado por id: sort() fusiona
+
+        # esas rachas en tiempo lineal, sin el B-tree temporal de un ORDER BY.
+
+        # Cada nivel del libro necesita las órdenes por id (prioridad temporal)
+
+        rows.sort(key=lambda row: row[0])
+
+
+
+        books = {}
+
+        for row in rows:
+
+            order = self._row_to_order(row)
+
+            key = (order.asset, order.fiat)
+
+            if key not in books:
+
+                books[key] = OrderBook(order.asset, order.fiat)
+
+            books[key].add(order)
+
+        with self._books_lock:
+
+            previous = self.books
+
+            self.books = books
+
+            self._applied_seq = applied_seq
+
+        self._notify_books(set(previous) | set(books))
+
+        print(f"📚 Libros de órdenes cargados: {len(rows)} órdenes en {len(books)} pares")
+
+
+
+    def enable_change_feed(self, cluster: ClusterStats):
+
+        """Publica y consume cambios de órdenes vía order_events (workers pre-fork)"""
+
+        self.change_feed = cluster
+
+
+
+    def sync_order_books(self):
+
+        """Aplica los cambios que otros procesos hayan hecho en p2p_orders; O(1) si no hay ninguno"""
+
+        if self.change_feed is None or self.change_feed.order_seq() <= self._applied_seq:
+
+            return
+
+        with self._write_lock:
+
+            with self.pool.connection() as conn:
+
+                self._apply_order_events(conn.cursor())
+
+
+
+    def _apply_order_events(self, cursor):
+
+        oldest = cursor.execute('SELECT MIN(seq) FROM order_events').fetchone()[0]
+
+        if oldest is not None and oldest > self._applied_seq + 1:
+
+            # Nos saltamos eventos ya podados: recarga completa
+
+            self.load_order_books()
+
+            return
+
+        events = cursor.execute(
+
+            'SELECT seq, order_id FROM order_events WHERE seq > ? ORDER BY seq', (self._applied_seq,)
+
+        ).fetchall()
+
+        if not events:
+
+            return
+
+        order_ids = sorted({order_id for _, order_id in events})
+
+        pairs = set()
+
+        rows = cursor.execute(ORDER_ROW_QUERY + 'WHERE po.id IN ({})'.format(', '.join('?' * len(order_ids))),
+
+                              order_ids).fetchall()
+
+        for row in rows:
+
+            order = self._row_to_order(row)
+
+            book = self.get_book(order.asset, order.fiat)
+
+            if order.status in OrderBook.OPEN_STATUSES and order.available_quantity > 0:
+
+                book.add(order)
+
+            else:
+
+                book.remove(order.id)
+
+            pairs.add((order.asset, order.fiat))
+
+        self._applied_seq = events[-1][0]
+
+        self._notify_books(pairs)
+
+
+
+    def _begin_write(self, conn: sqlite3.Connection):
+
+        """Abre la transacción de escritura y pone el libro al día con otros procesos.
+
+
+
+        BEGIN IMMEDIATE toma el cerrojo de escritura de SQLite desde el
+
+        principio, así que leer-validar-actualizar es atómico también entre
+
+        procesos y no hay errores de BUSY al promocionar una lectura.
+
+        """
+
+        conn.execute('BEGIN IMMEDIATE')
+
+        if self.change_feed is not None:
+
+            self._apply_order_events(conn.cursor())
+
+
+
+    def _publish_order_changes(self, cursor, order_ids: List[int]) -> int:
+
+        """Anota las órdenes modificadas dentro de la transacción de escritura en curso"""
+
+        if self.change_feed is None or not order_ids:
+
+            return 0
+
+        for order_id in order_ids:
+
+            cursor.execute('INSERT INTO order_events (order_id) VALUES (?)', (order_id,))
+
+        seq = cursor.lastrowid
+
+        if seq % 1000 < len(order_ids):
+
+            cursor.execute('DELETE FROM order_events WHERE seq <= ?', (seq - ORDER_EVENTS_RETENTION,))
+
+        # Las escrituras están serializadas por BEGIN IMMEDIATE: el seq compartido solo crece
+
+        self.change_feed.set_order_seq(seq)
+
+        return seq
+
+
+
+    def _mark_applied(self, seq: int):
+
+        """Tras el commit, nuestro libro ya incluye los eventos que publicamos"""
+
+        if seq:
+
+            self._applied_seq = max(self._applied_seq, seq)
+
+
+
+    def data_version(self, table: str) -> int:
+
+        """Versión de `table`; cambia cada vez que una escritura confirmada la modifica.
+
+
+
+        Las escrituras la incrementan después del commit y de actualizar el
+
+        libro en memoria, y los lectores la leen antes de consultar: una
+
+        versión nunca se asocia a datos más antiguos que ella.
+
+        """
+
+        if self.change_feed is not None:
+
+            return self.change_feed.data_version(table)
+
+        return self._data_versions[table]
+
+
+
+    def _load_session_secret(self) -> bytes:
+
+        secret = os.environ.get(SESSION_SECRET_ENV)
+
+        if secret:
+
+            return secret.encode('utf-8')
+
+        # INSERT OR IGNORE + SELECT: si varios workers arrancan a la vez, todos leen el mismo
+
+        with self.pool.connection() as conn:
+
+            conn.execute("INSERT OR IGNORE INTO app_secrets (name, value) VALUES ('session_hmac', ?)",
+
+                         (secrets.token_hex(32),))
+
+            conn.commit()
+
+            value = conn.execute("SELECT value FROM app_secrets WHERE name = 'session_hmac'").fetchone()[0]
+
+        return bytes.fromhex(value)
+
+
+
+    def create_session(self, user: User) -> str:
+
+        return self.sessions.issue(user.id, user.username)
+
+
+
+    def verify_session(self, token: str) -> Optional[Dict[str, any]]:
+
+        """Datos de la sesión de `token` o None; solo consulta SQLite si alguien revocó una sesión"""
+
+        version = self.data_version('revoked_sessions')
+
+        if version != self.sessions.revoked_version:
+
+            with self.pool.connection() as conn:
+
+                rows = conn.execute('SELECT sid, expires_at FROM revoked_sessions WHERE expires_at > ?',
+
+                                    (time.time(),)).fetchall()
+
+            self.sessions.load_revoked(dict(rows), version)
+
+        return self.sessions.verify(token)
+
+
+
+    def revoke_session(self, token: str) -> bool:
+
+        claims = self.sessions.decode(token)
+
+        if claims is None:
+
+            return False
+
+        now = time.time()
+
+        with self.pool.connection() as conn:
+
+            conn.execute('INSERT OR IGNORE INTO revoked_sessions (sid, expires_at) VALUES (?, ?)',
+
+                         (claims['sid'], claims['expires']))
+
+            conn.execute('DELETE FROM revoked_sessions WHERE expires_at <= ?', (now,))
+
+            conn.commit()
+
+        self.sessions.revoke(claims['sid'], claims['expires'])
+
+        self._bump_versions('revoked_sessions')
+
+        return True
+
+
+
+    def _bump_versions(self, *tables: str):
+
+        if self.change_feed is not None:
+
+            for table in tables:
+
+                self.change_feed.bump_version(table)
+
+            return
+
+        with self._versions_lock:
+
+            for table in tables:
+
+                self._data_versions[table] += 1
+
+
+
+    @staticmethod
+
+    def book_topic(asset: str, fiat: str) -> str:
+
+        return f'book:{asset}/{fiat}'
+
+
+
+    def _notify_books(self, pairs):
+
+        """Avisa a los suscriptores del feed de market data de los libros modificados"""
+
+        for asset, fiat in pairs:
+
+            self.events.publish(self.book_topic(asset, fiat), self.get_book(asset, fiat).version)
+
+
+
+    def get_book(self, asset: str, fiat: str) -> OrderBook:
+
+        book = self.books.get((asset, fiat))
+
+        if book is None:
+
+            with self._books_lock:
+
+                book = self.books.setdefault((asset, fiat), OrderBook(asset, fiat))
+
+        return book
+
+
+
+    @staticmethod
+
+    def _row_to_order(result) -> P2POrder:
+
+        return P2POrder(
+
+            id=result[0], user_id=result[1], username=result[2],
+
+            order_type=OrderType(result[3]), asset=result[4], fiat=result[5],
+
+            price=result[6], quantity=result[7], available_quantity=result[8],
+
+            payment_methods=json.loads(result[9]), status=OrderStatus(result[10]),
+
+            min_amount=result[11], max_amount=result[12], created_at=result[13]
+
+        )
+
+
+
+    def _report_storage_profile(self):
+
+        info = self.pool.describe()
+
+        pragmas = info['pragmas']
+
+        synchronous = {0: 'OFF', 1: 'NORMAL', 2: 'FULL', 3: 'EXTRA'}.get(pragmas['synchronous'], pragmas['synchronous'])
+
+        print(f"💾 Perfil de almacenamiento: {info['profile']} "
+
+              f"(journal={pragmas['journal_mode']}, synchronous={synchronous}, "
+
+              f"mmap={pragmas['mmap_size'] // (1024 * 1024)}MB, cache={pragmas['cache_size']}, "
+
+              f"busy_timeout={pragmas['busy_timeout']}ms)")
+
+
+
+    def _migration_base_tables(self, cursor):
+
+        # Tabla de usuarios
+
+        cursor.execute('''
+
+            CREATE TABLE IF NOT EXISTS users (
+
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+
+                username TEXT UNIQUE NOT NULL,
+
+                email TEXT UNIQUE NOT NULL,
+
+                password_hash TEXT NOT NULL,
+
+                created_at TEXT NOT NULL,
+
+                reputation INTEGER DEFAULT 100,
+
+                completed_trades INTEGER DEFAULT 0
+
+            )
+
+        ''')
+
+       
+
+        # Tabla de órdenes P2P
+
+        cursor.execute('''
+
+            CREATE TABLE IF NOT EXISTS p2p_orders (
+
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+
+                user_id INTEGER NOT NULL,
+
+                order_type TEXT NOT NULL,
+
+                asset TEXT NOT NULL,
+
+                fiat TEXT NOT NULL,
+
+                price REAL NOT NULL,
+
+                quantity REAL NOT NULL,
+
+                available_quantity REAL NOT NULL,
+
+                payment_methods TEXT NOT NULL,
+
+                status TEXT NOT NULL,
+
+                min_amount REAL NOT NULL,
+
+                max_amount REAL NOT NULL,
+
+                created_at TEXT NOT NULL,
+
+                FOREIGN KEY (user_id) REFERENCES users (id)
+
+            )
+
+        ''')
+
+       
+
+        # Tabla de trades
+
+        cursor.execute('''
+
+            CREATE TABLE IF NOT EXISTS trades (
+
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+
+                buyer_id INTEGER NOT NULL,
+
+                seller_id INTEGER NOT NULL,
+
+                order_id INTEGER NOT NULL,
+
+                asset TEXT NOT NULL,
+
+                fiat TEXT NOT NULL,
+
+                price REAL NOT NULL,
+
+                quantity REAL NOT NULL,
+
+                amount REAL NOT NULL,
+
+                status TEXT NOT NULL,
+
+                created_at TEXT NOT NULL,
+
+                qr_code TEXT,
+
+                payment_deadline TEXT,
+
+                FOREIGN KEY (buyer_id) REFERENCES users (id),
+
+                FOREIGN KEY (seller_id) REFERENCES users (id),
+
+                FOREIGN KEY (order_id) REFERENCES p2p_orders (id)
+
+            )
+
+        ''')
+
+       
+
+        # Tabla de wallets
+
+        cursor.execute('''
+
+            CREATE TABLE IF NOT EXISTS wallets (
+
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+
+                user_id INTEGER NOT NULL,
+
+                asset TEXT NOT NULL,
+
+                balance REAL NOT NULL,
+
+                locked_balance REAL NOT NULL,
+
+                FOREIGN KEY (user_id) REFERENCES users (id)
+
+            )
+
+        ''')
+
+
+
+    def _migration_managed_indexes(self, cursor):
+
+        for ddl in MANAGED_INDEXES.values():
+
+            cursor.execute(ddl)
+
+
+
+    def _migration_order_events(self, cursor):
+
+        # Órdenes tocadas por cada escritura; otros procesos lo leen para
+
+        # mantener sus libros en memoria al día (modo pre-fork)
+
+        cursor.execute('''
+
+            CREATE TABLE IF NOT EXISTS order_events (
+
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+
+                order_id INTEGER NOT NULL
+
+            )
+
+        ''')
+
+
+
+    def _migration_sessions(self, cursor):
+
+        cursor.execute('''
+
+            CREATE TABLE IF NOT EXISTS app_secrets (
+
+                name TEXT PRIMARY KEY,
+
+                value TEXT NOT NULL
+
+            )
+
+        ''')
+
+        # Sesiones cerradas antes de caducar; se purgan al revocar otra
+
+        cursor.execute('''
+
+            CREATE TABLE IF NOT EXISTS revoked_sessions (
+
+                sid TEXT PRIMARY KEY,
+
+                expires_at REAL NOT NULL
+
+            )
+
+        ''')
+
+
+
+    def _migration_user_stats(self, cursor):
+
+        cursor.execute('''
+
+            CREATE TABLE IF NOT EXISTS user_stats (
+
+                user_id INTEGER PRIMARY KEY,
+
+                completed_trades INTEGER NOT NULL DEFAULT 0,
+
+                cancelled_trades INTEGER NOT NULL DEFAULT 0,
+
+                release_seconds REAL NOT NULL DEFAULT 0,
+
+                released_trades INTEGER NOT NULL DEFAULT 0,
+
+                volume TEXT NOT NULL DEFAULT '{}',
+
+                reputation INTEGER NOT NULL DEFAULT 100,
+
+                FOREIGN KEY (user_id) REFERENCES users (id)
+
+            )
+
+        ''')
+
+        cursor.execute('ALTER TABLE trades ADD COLUMN completed_at TEXT')
+
+        # Relleno con el histórico; los trades antiguos no guardaban cuándo se liberaron
+
+        changes = {}
+
+        cursor.execute('SELECT buyer_id, seller_id, asset, fiat, quantity, amount, status FROM trades WHERE status IN (?, ?)',
+
+                       TRADE_FINAL_STATUSES)
+
+        for buyer_id, seller_id, asset, fiat, quantity, amount, status in cursor.fetchall():
+
+            if status == TradeStatus.CANCELLED.value:
+
+                stats_change(changes, buyer_id)['cancelled'] += 1
+
+                continue
+
+            for user_id in (buyer_id, seller_id):
+
+                change = stats_change(changes, user_id)
+
+                change['completed'] += 1
+
+                add_volume(change, asset, quantity)
+
+                add_volume(change, fiat, amount)
+
+        self._update_user_stats(cursor, changes)
+
+
+
+    def _migration_narrow_order_index(self, cursor):
+
+        # El índice cubriente (asset, fiat, status, price, ...) servía a la consulta
+
+        # del libro anterior a los libros en memoria y duplicaba todas las columnas
+
+        cursor.execute('DROP INDEX IF EXISTS idx_orders_book')
+
+        self._migration_managed_indexes(cursor)
+
+
+
+    def check_query_plans(self) -> Dict[str, List[str]]:
+
+        """Ejecuta EXPLAIN QUERY PLAN sobre HOT_QUERIES y falla si alguna escanea"""
+
+        plans = {}
+
+        problems = []
+
+        # Por el pool: mismas conexiones (y PRAGMAs del perfil) que las peticiones
+
+        with self.pool.connection() as conn:
+
+            for name, (sql, params) in HOT_QUERIES.items():
+
+                details = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+
+                plans[name] = details
+
+                for detail in details:
+
+                    if detail.startswith('SCAN') or 'TEMP B-TREE' in detail:
+
+                        problems.append(f"{name}: {detail}")
+
+        if problems:
+
+            raise QueryPlanError("Consultas sin índice: " + "; ".join(problems))
+
+        return plans
+
+   
+
+    def _create_sample_data(self, cursor):
+
+        """Crear datos de ejemplo"""
+
+        users_data = [
+
+            ("trader1", "trader1@example.com", "password123"),
+
+            ("trader2", "trader2@example.com", "password123"),
+
+            ("trader3", "trader3@example.com", "password123")
+
+        ]
+
+       
+
+        for username, email, password in users_data:
+
+            try:
+
+                password_hash = hash_password(password, password_pool.kdf)
+
+                created_at = datetime.datetime.now().isoformat()
+
+                cursor.execute(
+
+                    'INSERT INTO users (username, email, password_hash, created_at) VALUES (?, ?, ?, ?)',
+
+                    (username, email, password_hash, created_at)
+
+                )
+
+                user_id = cursor.lastrowid
+
+                print(f"✅ Usuario creado: {username}")
+
+               
+
+                # Crear wallets
+
+                assets = [
+
+                    ('USDT', 5000.0), ('BTC', 0.5), ('ETH', 3.0),
+
+                    ('USD', 10000.0), ('EUR', 8000.0)
+
+                ]
+
+                for asset, balance in assets:
+
+                    cursor.execute(
+
+                        'INSERT INTO wallets (user_id, asset, balance, locked_balance) VALUES (?, ?, ?, ?)',
+
+                        (user_id, asset, balance, 0.0)
+
+                    )
+
+                   
+
+            except sqlite3.IntegrityError:
+
+                print(f"⚠️ Usuario {username} ya existe")
+
+                continue
+
+       
+
+        # Crear anuncios iniciales
+
+        self._generate_random_orders(cursor, num_orders=8)
+
+   
+
+    def _generate_random_orders(self, cursor, num_orders=8):
+
+        """Genera órdenes aleatorias de compra y venta"""
+
+        for i in range(num_orders):
+
+            try:
+
+                cursor.execute("SELECT id FROM users ORDER BY RANDOM() LIMIT 1")
+
+                user_result = cursor.fetchone()
+
+                if not user_result:
+
+                    continue
+
+                   
+
+                user_id = user_result[0]
+
+                order_type, asset, fiat, price, quantity, payment_methods, min_amount, max_amount = (
+
+                    random_order_params()
+
+                )
+
+               
+
+                created_at = datetime.datetime.now().isoformat()
+
+                payment_json = json.dumps(payment_methods)
+
+               
+
+                cursor.execute('''
+
+                    INSERT INTO p2p_orders
+
+                    (user_id, order_type, asset, fiat, price, quantity, available_quantity,
+
+                     payment_methods, status, min_amount, max_amount, created_at)
+
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+
+                ''', (user_id, order_type, asset, fiat, price, quantity, quantity,
+
+                      payment_json, 'PENDING', min_amount, max_amount, created_at))
+
+               
+
+                print(f"✅ Anuncio {order_type} {asset}/{fiat} a {price}")
+
+               
+
+            except Exception as e:
+
+                print(f"❌ Error creando anuncio: {e}")
+
+   
+
+    def register_user(self, username: str, email: str, password: str) -> bool:
+
+        # El KDF corre fuera de la conexión: no se retiene una conexión del pool mientras tanto
+
+        password_hash = password_pool.hash(password)
+
+        try:
+
+            with self.pool.connection() as conn:
+
+                cursor = conn.cursor()
+
+
+
+                created_at = datetime.datetime.now().isoformat()
+
+
+
+                cursor.execute('''
+
+                    INSERT INTO users (username, email, password_hash, created_at)
+
+                    VALUES (?, ?, ?, ?)
+
+                ''', (username, email, password_hash, created_at))
+
+
+
+                user_id = cursor.lastrowid
+
+                initial_assets = [
+
+                    ('USDT', 1000.0), ('BTC', 0.01), ('ETH', 0.1),
+
+                    ('USD', 2000.0), ('EUR', 1600.0)
+
+                ]
+
+                for asset, balance in initial_assets:
+
+                    cursor.execute('''
+
+                        INSERT INTO wallets (user_id, asset, balance, locked_balance)
+
+                        VALUES (?, ?, ?, ?)
+
+                    ''', (user_id, asset, balance, 0.0))
+
+
+
+                conn.commit()
+
+            self._bump_versions('wallets')
+
+            return True
+
+        except sqlite3.IntegrityError:
+
+            return False
+
+
+
+    def authenticate_user(self, username: str, password: str) -> Optional[User]:
+
+        with self.pool.connection() as conn:
+
+            cursor = conn.cursor()
+
+
+
+            cursor.execute('''
+
+                SELECT id, username, email, created_at, password_hash FROM users
+
+                WHERE username = ?
+
+            ''', (username,))
+
+
+
+            result = cursor.fetchone()
+
+
+
+        if not result:
+
+            # Mismo coste que con un usuario existente: no revela qué usuarios existen
+
+            password_pool.verify(password, password_pool.dummy_hash())
+
+            return None
+
+        matches, rehash = password_pool.verify(password, result[4])
+
+        if not matches:
+
+            return None
+
+        if rehash:
+
+            # Hash heredado o con parámetros antiguos: se actualiza ahora que tenemos la contraseña
+
+            new_hash = password_pool.hash(password)
+
+            with self.pool.connection() as conn:
+
+                # Solo si nadie lo cambió entretanto (logins simultáneos del mismo usuario)
+
+                updated = conn.execute('UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?',
+
+                                       (new_hash, result[0], result[4])).rowcount
+
+                conn.commit()
+
+            password_pool.record_rehash(updated)
+
+        return User(*result[:4])
+
+
+
+    def get_user_stats(self, user_id: int) -> Dict[str, any]:
+
+        return self.user_stats(user_id).to_dict()
+
+
+
+    def user_stats(self, user_id: int) -> UserStats:
+
+        """Agregados de `user_id`; O(1) desde la caché salvo la primera vez tras un cambio"""
+
+        version = self.data_version('user_stats')
+
+        with self._user_stats_lock:
+
+            if version != self._user_stats_version:
+
+                self._user_stats = {}
+
+                self._user_stats_version = version
+
+            stats = self._user_stats.get(user_id)
+
+        if stats is not None:
+
+            return stats
+
+        with self.pool.connection() as conn:
+
+            stats = self._read_user_stats(conn.cursor(), user_id)
+
+        with self._user_stats_lock:
+
+            # Si alguien escribió mientras leíamos, no guardamos un valor que puede ser viejo
+
+            if self._user_stats_version == version:
+
+                self._user_stats.setdefault(user_id, stats)
+
+        return stats
+
+
+
+    @staticmethod
+
+    def _read_user_stats(cursor, user_id: int) -> UserStats:
+
+        cursor.execute('''
+
+            SELECT completed_trades, cancelled_trades, release_seconds, released_trades, volume, reputation
+
+            FROM user_stats WHERE user_id = ?
+
+        ''', (user_id,))
+
+        row = cursor.fetchone()
+
+        if row is None:
+
+            return UserStats(user_id)
+
+        return UserStats(user_id, row[0], row[1], row[2], row[3], json.loads(row[4]), row[5])
+
+
+
+    def _update_user_stats(self, cursor, changes: Dict[int, Dict[str, any]]) -> List[UserStats]:
+
+        """Aplica los incrementos de stats_change() dentro de la transacción en curso"""
+
+        updated = []
+
+        for user_id, change in changes.items():
+
+            stats = self._read_user_stats(cursor, user_id).add(**change)
+
+            cursor.execute('''
+
+                INSERT INTO user_stats (user_id, completed_trades, cancelled_trades, release_seconds,
+
+                                        released_trades, volume, reputation)
+
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+
+                ON CONFLICT(user_id) DO UPDATE SET
+
+                    completed_trades = excluded.completed_trades, cancelled_trades = excluded.cancelled_trades,
+
+                    release_seconds = excluded.release_seconds, released_trades = excluded.released_trades,
+
+                    volume = excluded.volume, reputation = excluded.reputation
+
+            ''', (user_id, stats.completed_trades, stats.cancelled_trades, stats.release_seconds,
+
+                  stats.released_trades, json.dumps(stats.volume), stats.reputation))
+
+            updated.append(stats)
+
+        return updated
+
+
+
+    def _publish_user_stats(self, updated: List[UserStats]):
+
+        """Tras el commit: sube la versión y deja en la caché los valores nuevos.
+
+
+
+        Si la caché ya estaba al día y nadie más ha escrito (la versión avanza
+
+        exactamente en uno) basta con reemplazar esas entradas; si no, se vacía.
+
+        """
+
+        if not updated:
+
+            return
+
+        before = self.data_version('user_stats')
+
+        self._bump_versions('user_stats')
+
+        after = self.data_version('user_stats')
+
+        with self._user_stats_lock:
+
+            if self._user_stats_version == before and after == before + 1:
+
+                for stats in updated:
+
+                    self._user_stats[stats.user_id] = stats
+
+            else:
+
+                self._user_stats = {}
+
+            self._user_stats_version = after
+
+
+
+    def create_order(self, user_id: int, order_type: str, asset: str, fiat: str,
+
+                    price: float, quantity: float, payment_methods: List[str],
+
+                    min_amount: float, max_amount: float) -> Optional[int]:
+
+        """Publica un anuncio y devuelve su id, o None si no hay fondos o falla"""
+
+        # El cruce lee el libro y lo actualiza tras el commit: ambos pasos
+
+        # deben ser atómicos frente a otras escrituras concurrentes
+
+        try:
+
+            with self._write_lock:
+
+                with self.pool.connection() as conn:
+
+                    self._begin_write(conn)
+
+                    cursor = conn.cursor()
+
+
+
+                    # Validar fondos
+
+                    if order_type == 'SELL':
+
+                        cursor.execute('''
+
+                            SELECT balance FROM wallets
+
+                            WHERE user_id = ? AND asset = ?
+
+                        ''', (user_id, asset))
+
+                        result = cursor.fetchone()
+
+                        if not result or result[0] < quantity:
+
+                            return None
+
+                    else:  # BUY
+
+                        cursor.execute('''
+
+                            SELECT balance FROM wallets
+
+                            WHERE user_id = ? AND asset = ?
+
+                        ''', (user_id, fiat))
+
+                        result = cursor.fetchone()
+
+                        total_amount = price * quantity
+
+                        if not result or result[0] < total_amount:
+
+                            return None
+
+
+
+                    created_at = datetime.datetime.now().isoformat()
+
+                    payment_methods_json = json.dumps(payment_methods)
+
+
+
+                    cursor.execute('''
+
+                        INSERT INTO p2p_orders
+
+                        (user_id, order_type, asset, fiat, price, quantity, available_quantity,
+
+                         payment_methods, status, min_amount, max_amount, created_at)
+
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+
+                    ''', (user_id, order_type, asset, fiat, price, quantity, quantity,
+
+                          payment_methods_json, OrderStatus.PENDING.value, min_amount, max_amount, created_at))
+
+                    order_id = cursor.lastrowid
+
+
+
+                    # Bloquear fondos
+
+                    if order_type == 'SELL':
+
+                        cursor.execute('''
+
+                            UPDATE wallets
+
+                            SET balance = balance - ?, locked_balance = locked_balance + ?
+
+                            WHERE user_id = ? AND asset = ?
+
+                        ''', (quantity, quantity, user_id, asset))
+
+                    else:  # BUY
+
+                        total_amount = price * quantity
+
+                        cursor.execute('''
+
+                            UPDATE wallets
+
+                            SET balance = balance - ?, locked_balance = locked_balance + ?
+
+                            WHERE user_id = ? AND asset = ?
+
+                        ''', (total_amount, total_amount, user_id, fiat))
+
+
+
+                    cursor.execute('SELECT username FROM users WHERE id = ?', (user_id,))
+
+                    username = cursor.fetchone()[0]
+
+
+
+                    order = P2POrder(
+
+                        id=order_id, user_id=user_id, username=username,
+
+                        order_type=OrderType(order_type), asset=asset, fiat=fiat,
+
+                        price=price, quantity=quantity, available_quantity=quantity,
+
+                        payment_methods=list(payment_methods), status=OrderStatus.PENDING,
+
+                        created_at=created_at, min_amount=min_amount, max_amount=max_amount
+
+                    )
+
+                    fills, merchant_stats = [], []
+
+                    if self.matching:
+
+                        order, fills, merchant_stats = self._match_order(cursor, order)
+
+                    published = self._publish_order_changes(cursor, [order_id] + [fill[0] for fill in fills])
+
+                    conn.commit()
+
+                self._mark_applied(published)
+
+
+
+                # Write-through: SQLite ya tiene la orden, ahora el libro en memoria
+
+                book = self.get_book(asset, fiat)
+
+                for resting_id, available_quantity, status in fills:
+
+                    book.update(resting_id, available_quantity, status)
+
+                book.add(order)
+
+                self._notify_books([(asset, fiat)])
+
+                self._bump_versions('p2p_orders', 'wallets')
+
+                self._publish_user_stats(merchant_stats)
+
+            return order_id
+
+        except Exception as e:
+
+            request_log.record('ERROR', 'create_order_failed', user_id=user_id, error=repr(e))
+
+            return None
+
+
+
+    def _match_order(self, cursor, order: P2POrder) -> Tuple[P2POrder, List[Tuple[int, float, OrderStatus]],
+
+                                                            List[UserStats]]:
+
+        """Cruza `order` contra el lado opuesto del libro con prioridad precio-tiempo.
+
+
+
+        Se llama con `_write_lock` tomado, así que puede recorrer el libro sin copiarlo.
+
+
+
+        Ambas partes ya tienen sus fondos bloqueados, así que cada cruce se
+
+        liquida en la misma transacción y genera un trade COMPLETED al precio
+
+        de la orden en reposo. Los límites min/max del anuncio solo se aplican
+
+        a los trades manuales de start_trade. Devuelve la orden entrante con su
+
+        cantidad restante, los cambios a aplicar en el libro tras el commit y
+
+        las estadísticas actualizadas de las partes.
+
+        """
+
+        book = self.get_book(order.asset, order.fiat)
+
+        incoming_buy = order.order_type is OrderType.BUY
+
+        opposite = OrderType.SELL if incoming_buy else OrderType.BUY
+
+        remaining = order.available_quantity
+
+        fills = []
+
+        changes = {}
+
+        now = datetime.datetime.now().isoformat()
+
+
+
+        for resting in book.iter_orders(opposite):
+
+            if remaining <= QUANTITY_EPSILON:
+
+                break
+
+            crosses = resting.price <= order.price if incoming_buy else resting.price >= order.price
+
+            if not crosses:
+
+                break
+
+            if resting.user_id == order.user_id:
+
+                continue  # sin auto-cruces
+
+
+
+            quantity = min(remaining, resting.available_quantity)
+
+            price = resting.price
+
+            amount = quantity * price
+
+            buy, sell = (order, resting) if incoming_buy else (resting, order)
+
+
+
+            # Vendedor: entrega el activo bloqueado y cobra el fiat
+
+            cursor.execute('''
+
+                UPDATE wallets SET locked_balance = locked_balance - ?
+
+                WHERE user_id = ? AND asset = ?
+
+            ''', (quantity, sell.user_id, order.asset))
+
+            cursor.execute('''
+
+                UPDATE wallets SET balance = balance + ?
+
+                WHERE user_id = ? AND asset = ?
+
+            ''', (amount, sell.user_id, order.fiat))
+
+            # Comprador: libera el fiat bloqueado a su precio límite y
+
+            # recupera la mejora de precio
+
+            cursor.execute('''
+
+                UPDATE wallets SET locked_balance = locked_balance - ?, balance = balance + ?
+
+                WHERE user_id = ? AND asset = ?
+
+            ''', (quantity * buy.price, quantity * (buy.price - price), buy.user_id, order.fiat))
+
+            cursor.execute('''
+
+                UPDATE wallets SET balance = balance + ?
+
+                WHERE user_id = ? AND asset = ?
+
+            ''', (quantity, buy.user_id, order.asset))
+
+
+
+            cursor.execute('''
+
+                INSERT INTO trades
+
+                (buyer_id, seller_id, order_id, asset, fiat, price, quantity, amount,
+
+                 status, created_at, completed_at)
+
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+
+            ''', (buy.user_id, sell.user_id, resting.id, order.asset, order.fiat, price,
+
+                  quantity, amount, TradeStatus.COMPLETED.value, now, now))
+
+            # Cruce automático: cuenta como completado pero no como tiempo de liberación
+
+            for user_id in (buy.user_id, sell.user_id):
+
+                change = stats_change(changes, user_id)
+
+                change['completed'] += 1
+
+                add_volume(change, order.asset, quantity)
+
+                add_volume(change, order.fiat, amount)
+
+
+
+            resting_available = round(resting.available_quantity - quantity, 8)
+
+            resting_status = OrderStatus.FILLED if resting_available <= QUANTITY_EPSILON else OrderStatus.PARTIALLY_FILLED
+
+            cursor.execute('''
+
+                UPDATE p2p_orders SET available_quantity = ?, status = ? WHERE id = ?
+
+            ''', (resting_available, resting_status.value, resting.id))
+
+            fills.append((resting.id, resting_available, resting_status))
+
+            remaining = round(remaining - quantity, 8)
+
+
+
+        if fills:
+
+            status = OrderStatus.FILLED if remaining <= QUANTITY_EPSILON else OrderStatus.PARTIALLY_FILLED
+
+            cursor.execute('''
+
+                UPDATE p2p_orders SET available_quantity = ?, status = ? WHERE id = ?
+
+            ''', (remaining, status.value, order.id))
+
+            order = dataclasses.replace(order, available_quantity=remaining, status=status)
+
+            self.engine_stats['matches'] += len(fills)
+
+            self.engine_stats['matched_quantity'] += order.quantity - remaining
+
+        self.engine_stats['orders'] += 1
+
+        return order, fills, self._update_user_stats(cursor, changes)
+
+
+
+    def get_orders(self, asset: str = "USDT", fiat: str = "USD", order_type: str = None,
+
+                   payment_method: Optional[str] = None, after: Optional[Tuple[float, int]] = None,
+
+                   limit: Optional[int] = None) -> List[P2POrder]:
+
+        """Órdenes abiertas por (precio, id) ascendente; `after` es el cursor de la página anterior"""
+
+        # Lectura servida desde el libro en memoria, sin tocar SQLite
+
+        self.sync_order_books()
+
+        return self.get_book(asset, fiat).page(
+
+            OrderType(order_type) if order_type else None, after, limit, payment_method
+
+        )
+
+
+
+    def start_trade(self, buyer_id: int, order_id: int, quantity: float) -> Optional[int]:
+
+        # Leer disponible, validar y descontar debe ser atómico entre hilos
+
+        with self._write_lock:
+
+            trade_id = self._start_trade(buyer_id, order_id, quantity)
+
+            if trade_id:
+
+                self.events.publish(self.trade_topic(trade_id), TradeStatus.PENDING_PAYMENT.value)
+
+            return trade_id
+
+
+
+    def _start_trade(self, buyer_id: int, order_id: int, quantity: float) -> Optional[int]:
+
+        try:
+
+            with self.pool.connection() as conn:
+
+                self._begin_write(conn)
+
+                cursor = conn.cursor()
+
+
+
+                cursor.execute('''
+
+                    SELECT user_id, order_type, asset, fiat, price, available_quantity,
+
+                           min_amount, max_amount
+
+                    FROM p2p_orders WHERE id = ? AND status IN (?, ?)
+
+                ''', (order_id, OrderStatus.PENDING.value, OrderStatus.PARTIALLY_FILLED.value))
+
+
+
+                order_data = cursor.fetchone()
+
+                if not order_data:
+
+                    return None
+
+
+
+                seller_id, order_type, asset, fiat, price, available_quantity, min_amount, max_amount = order_data
+
+
+
+                amount = price * quantity
+
+
+
+                if quantity > available_quantity:
+
+                    return None
+
+                if amount < min_amount or amount > max_amount:
+
+                    return None
+
+
+
+                # Validar fondos
+
+                if order_type == 'SELL':
+
+                    cursor.execute('''
+
+                        SELECT balance FROM wallets WHERE user_id = ? AND asset = ?
+
+                    ''', (buyer_id, fiat))
+
+                    buyer_balance = cursor.fetchone()
+
+                    if not buyer_balance or buyer_balance[0] < amount:
+
+                        return None
+
+                else:
+
+                    cursor.execute('''
+
+                        SELECT balance FROM wallets WHERE user_id = ? AND asset = ?
+
+                    ''', (buyer_id, asset))
+
+                    buyer_balance = cursor.fetchone()
+
+                    if not buyer_balance or buyer_balance[0] < quantity:
+
+                        return None
+
+
+
+                # Bloquear fondos
+
+                if order_type == 'SELL':
+
+                    cursor.execute('''
+
+                        UPDATE wallets SET balance = balance - ?, locked_balance = locked_balance + ?
+
+                        WHERE user_id = ? AND asset = ?
+
+                    ''', (amount, amount, buyer_id, fiat))
+
+                else:
+
+                    cursor.execute('''
+
+                        UPDATE wallets SET balance = balance - ?, locked_balance = locked_balance + ?
+
+                        WHERE user_id = ? AND asset = ?
+
+                    ''', (quantity, quantity, buyer_id, asset))
+
+
+
+                # Actualizar orden
+
+                new_available_quantity = available_quantity - quantity
+
+                new_status = OrderStatus.FILLED.value if new_available_quantity == 0 else OrderStatus.PARTIALLY_FILLED.value
+
+
+
+                cursor.execute('''
+
+                    UPDATE p2p_orders
+
+                    SET available_quantity = ?, status = ?
+
+                    WHERE id = ?
+
+                ''', (new_available_quantity, new_status, order_id))
+
+
+
+                # Crear trade
+
+                created_at = datetime.datetime.now().isoformat()
+
+                deadline = (datetime.datetime.now() + datetime.timedelta(seconds=TRADE_PAYMENT_WINDOW)).isoformat()
+
+
+
+                cursor.execute('''
+
+                    INSERT INTO trades
+
+                    (buyer_id, seller_id, order_id, asset, fiat, price, quantity, amount,
+
+                     status, created_at, payment_deadline)
+
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+
+                ''', (buyer_id, seller_id, order_id, asset, fiat, price, quantity, amount,
+
+                      TradeStatus.PENDING_PAYMENT.value, created_at, deadline))
+
+
+
+                trade_id = cursor.lastrowid
+
+                published = self._publish_order_changes(cursor, [order_id])
+
+                conn.commit()
+
+
+
+            self.get_book(asset, fiat).update(order_id, new_available_quantity, OrderStatus(new_status))
+
+            self._notify_books([(asset, fiat)])
+
+            self._mark_applied(published)
+
+            self._bump_versions('p2p_orders', 'wallets')
+
+            return trade_id
+
+
+
+        except Exception as e:
+
+            request_log.record('ERROR', 'start_trade_failed', user_id=buyer_id, order_id=order_id, error=repr(e))
+
+            return None
+
+
+
+    def confirm_payment(self, trade_id: int) -> bool:
+
+        with self._write_lock:
+
+            confirmed = self._confirm_payment(trade_id)
+
+            if confirmed:
+
+                self.events.publish(self.trade_topic(trade_id), TradeStatus.COMPLETED.value)
+
+            return confirmed
+
+
+
+    def _confirm_payment(self, trade_id: int) -> bool:
+
+        try:
+
+            with self.pool.connection() as conn:
+
+                self._begin_write(conn)
+
+                cursor = conn.cursor()
+
+
+
+                cursor.execute('''
+
+                    SELECT buyer_id, seller_id, order_id, asset, fiat, price, quantity, amount, status, created_at
+
+                    FROM trades WHERE id = ? AND status = ?
+
+                ''', (trade_id, TradeStatus.PENDING_PAYMENT.value))
+
+
+
+                trade_data = cursor.fetchone()
+
+                if not trade_data:
+
+                    return False
+
+
+
+                buyer_id, seller_id, order_id, asset, fiat, price, quantity, amount, status, created_at = trade_data
+
+
+
+                cursor.execute('SELECT order_type FROM p2p_orders WHERE id = ?', (order_id,))
+
+                order_type_result = cursor.fetchone()
+
+                if not order_type_result:
+
+                    return False
+
+
+
+                order_type = order_type_result[0]
+
+
+
+                if order_type == 'SELL':
+
+                    # Liberar fondos y transferir
+
+                    cursor.execute('''
+
+                        UPDATE wallets SET locked_balance = locked_balance - ?
+
+                        WHERE user_id = ? AND asset = ?
+
+                    ''', (amount, buyer_id, fiat))
+
+
+
+                    cursor.execute('''
+
+                        UPDATE wallets SET balance = balance + ?
+
+                        WHERE user_id = ? AND asset = ?
+
+                    ''', (amount, seller_id, fiat))
+
+
+
+                    cursor.execute('''
+
+                        UPDATE wallets SET locked_balance = locked_balance - ?
+
+                        WHERE user_id = ? AND asset = ?
+
+                    ''', (quantity, seller_id, asset))
+
+
+
+                    cursor.execute('''
+
+                        UPDATE wallets SET balance = balance + ?
+
+                        WHERE user_id = ? AND asset = ?
+
+                    ''', (quantity, buyer_id, asset))
+
+
+
+                else:
+
+                    cursor.execute('''
+
+                        UPDATE wallets SET locked_balance = locked_balance - ?
+
+                        WHERE user_id = ? AND asset = ?
+
+                    ''', (quantity, buyer_id, asset))
+
+
+
+                    cursor.execute('''
+
+                        UPDATE wallets SET balance = balance + ?
+
+                        WHERE user_id = ? AND asset = ?
+
+                    ''', (quantity, seller_id, asset))
+
+
+
+                    cursor.execute('''
+
+                        UPDATE wallets SET locked_balance = locked_balance - ?
+
+                        WHERE user_id = ? AND asset = ?
+
+                    ''', (amount, seller_id, fiat))
+
+
+
+                    cursor.execute('''
+
+                        UPDATE wallets SET balance = balance + ?
+
+                        WHERE user_id = ? AND asset = ?
+
+                    ''', (amount, buyer_id, fiat))
+
+
+
+                # Actualizar trade
+
+                completed_at = datetime.datetime.now()
+
+                cursor.execute('''
+
+                    UPDATE trades SET status = ?, completed_at = ? WHERE id = ?
+
+                ''', (TradeStatus.COMPLETED.value, completed_at.isoformat(), trade_id))
+
+
+
+                # Estadísticas: el tiempo de liberación se atribuye al dueño del anuncio
+
+                changes = {}
+
+                for user_id in (buyer_id, seller_id):
+
+                    change = stats_change(changes, user_id)
+
+                    change['completed'] += 1
+
+                    add_volume(change, asset, quantity)
+
+                    add_volume(change, fiat, amount)
+
+                release = stats_change(changes, seller_id)
+
+                release['release_seconds'] = (completed_at - datetime.datetime.fromisoformat(created_at)).total_seconds()
+
+                release['released'] = 1
+
+                updated = self._update_user_stats(cursor, changes)
+
+
+
+                conn.commit()
+
+            self._bump_versions('wallets')
+
+            self._publish_user_stats(updated)
+
+            return True
+
+
+
+        except Exception as e:
+
+            request_log.record('ERROR', 'confirm_payment_failed', trade_id=trade_id, error=repr(e))
+
+            return False
+
+
+
+    def cancel_trade(self, trade_id: int, user_id: int) -> bool:
+
+        """El comprador cancela un trade pendiente de pago: recupera sus fondos y la orden su cantidad"""
+
+        with self._write_lock:
+
+            cancelled = self._cancel_trade(trade_id, user_id)
+
+            if cancelled:
+
+                self.events.publish(self.trade_topic(trade_id), TradeStatus.CANCELLED.value)
+
+            return cancelled
+
+
+
+    def _cancel_trade(self, trade_id: int, user_id: int) -> bool:
+
+        try:
+
+            with self.pool.connection() as conn:
+
+                self._begin_write(conn)
+
+                cursor = conn.cursor()
+
+
+
+                cursor.execute('''
+
+                    SELECT buyer_id, order_id, asset, fiat, quantity, amount
+
+                    FROM trades WHERE id = ? AND status = ?
+
+                ''', (trade_id, TradeStatus.PENDING_PAYMENT.value))
+
+                trade_data = cursor.fetchone()
+
+                if not trade_data or trade_data[0] != user_id:
+
+                    return False
+
+                buyer_id, order_id, asset, fiat, quantity, amount = trade_data
+
+
+
+                cursor.execute('''
+
+                    SELECT order_type, quantity, available_quantity, status FROM p2p_orders WHERE id = ?
+
+                ''', (order_id,))
+
+                order_type, order_quantity, available_quantity, order_status = cursor.fetchone()
+
+
+
+                # Devolver lo que start_trade bloqueó al comprador
+
+                if order_type == 'SELL':
+
+                    cursor.execute('''
+
+                        UPDATE wallets SET balance = balance + ?, locked_balance = locked_balance - ?
+
+                        WHERE user_id = ? AND asset = ?
+
+                    ''', (amount, amount, buyer_id, fiat))
+
+                else:
+
+                    cursor.execute('''
+
+                        UPDATE wallets SET balance = balance + ?, locked_balance = locked_balance - ?
+
+                        WHERE user_id = ? AND asset = ?
+
+                    ''', (quantity, quantity, buyer_id, asset))
+
+
+
+                # La cantidad vuelve al anuncio, que sigue con sus fondos bloqueados
+
+                if order_status in (OrderStatus.PENDING.value, OrderStatus.PARTIALLY_FILLED.value,
+
+                                    OrderStatus.FILLED.value):
+
+                    available_quantity = round(available_quantity + quantity, 8)
+
+                    order_status = (OrderStatus.PENDING.value if available_quantity >= order_quantity
+
+                                    else OrderStatus.PARTIALLY_FILLED.value)
+
+                    cursor.execute('''
+
+                        UPDATE p2p_orders SET available_quantity = ?, status = ? WHERE id = ?
+
+                    ''', (available_quantity, order_status, order_id))
+
+
+
+                cursor.execute('''
+
+                    UPDATE trades SET status = ?, completed_at = ? WHERE id = ?
+
+                ''', (TradeStatus.CANCELLED.value, datetime.datetime.now().isoformat(), trade_id))
+
+
+
+                changes = {}
+
+                stats_change(changes, buyer_id)['cancelled'] += 1
+
+                updated = self._update_user_stats(cursor, changes)
+
+
+
+                cursor.execute(ORDER_ROW_QUERY + 'WHERE po.id = ?', (order_id,))
+
+                order = self._row_to_order(cursor.fetchone())
+
+                published = self._publish_order_changes(cursor, [order_id])
+
+                conn.commit()
+
+
+
+            # Una orden FILLED ya no estaba en el libro: add() la vuelve a insertar
+
+            self.get_book(asset, fiat).add(order)
+
+            self._notify_books([(asset, fiat)])
+
+            self._mark_applied(published)
+
+            self._bump_versions('p2p_orders', 'wallets')
+
+            self._publish_user_stats(updated)
+
+            return True
+
+
+
+        except Exception as e:
+
+            request_log.record('ERROR', 'cancel_trade_failed', trade_id=trade_id, error=repr(e))
+
+            return False
+
+
+
+    @staticmethod
+
+    def trade_topic(trade_id: int) -> str:
+
+        return f'trade:{trade_id}'
+
+
+
+    def cached_trade_status(self, trade_id: int) -> Optional[str]:
+
+        """Último estado publicado en el bus, o None si hay que leerlo de SQLite.
+
+
+
+        En modo prefork otro proceso puede haber cambiado el trade, así que el
+
+        valor del bus local no es fiable y siempre se consulta la base de datos.
+
+        """
+
+        if self.change_feed is not None:
+
+            return None
+
+        return self.events.last(self.trade_topic(trade_id))
+
+
+
+    def get_trade_status(self, trade_id: int) -> Optional[str]:
+
+        cached = self.cached_trade_status(trade_id)
+
+        if cached is not None:
+
+            return cached
+
+        with self.pool.connection() as conn:
+
+            cursor = conn.cursor()
+
+
+
+            cursor.execute('SELECT status FROM trades WHERE id = ?', (trade_id,))
+
+            result = cursor.fetchone()
+
+
+
+        return result[0] if result else None
+
+
+
+    def get_trade(self, trade_id: int) -> Optional[Dict[str, any]]:
+
+        with self.pool.connection() as conn:
+
+            cursor = conn.cursor()
+
+
+
+            cursor.execute('''
+
+                SELECT id, buyer_id, seller_id, order_id, asset, fiat, price, quantity,
+
+                       amount, status, created_at, payment_deadline
+
+                FROM trades WHERE id = ?
+
+            ''', (trade_id,))
+
+            result = cursor.fetchone()
+
+
+
+        if not result:
+
+            return None
+
+        return dict(zip(TRADE_FIELDS, result))
+
+
+
+    def get_user_balance(self, user_id: int) -> Dict[str, Dict[str, float]]:
+
+        with self.pool.connection() as conn:
+
+            cursor = conn.cursor()
+
+
+
+            cursor.execute('''
+
+                SELECT asset, balance, locked_balance FROM wallets WHERE user_id = ?
+
+            ''', (user_id,))
+
+
+
+            results = cursor.fetchall()
+
+
+
+        balance = {}
+
+        for asset, bal, locked in results:
+
+            balance[asset] = {
+
+                'available': bal,
+
+                'locked': locked,
+
+                'total': bal + locked
+
+            }
+
+
+
+        return balance
+
+
+
+# Sistema P2P global (se crea en main)
+
+p2p_system: Optional[P2PSystem] = None
+
+
+
+# Columnas de un trade tal como las devuelve get_trade y la API
+
+TRADE_FIELDS = ('id', 'buyer_id', 'seller_id', 'order_id', 'asset', 'fiat', 'price',
+
+                'quantity', 'amount', 'status', 'created_at', 'payment_deadline')
+
+
+
+def dump_json(data) -> bytes:
+
+    """Serializa una respuesta de la API: orjson si está instalado, si no json compacto"""
+
+    if orjson is not None:
+
+        return orjson.dumps(data)
+
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+
+SSE_HEADERS = (
+
+    ('Content-Type', 'text/event-stream; charset=utf-8'),
+
+    ('Cache-Control', 'no-cache'),
+
+    ('X-Accel-Buffering', 'no')
+
+)
+
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+
+    """Comparación débil de If-None-Match: W/"x" y "x" son el mismo validador"""
+
+    if not if_none_match:
+
+        return False
+
+    tag = etag.removeprefix('W/')
+
+    return any(candidate.strip() == '*' or candidate.strip().removeprefix('W/') == tag
+
+               for candidate in if_none_match.split(','))
+
+
+
+def sse_event(event: str, data) -> bytes:
+
+    return b'event: ' + event.encode('utf-8') + b'\ndata: ' + dump_json(data) + b'\n\n'
+
+
+
+class CompressionCache:
+
+    """Cuerpos comprimidos indexados por un digest del cuerpo sin comprimir.
+
+
+
+    Una página que no ha cambiado produce exactamente los mismos bytes, así
+
+    que se comprime una vez y las siguientes peticiones solo pagan un BLAKE2b.
+
+    La clave es el digest de 16 bytes, no el cuerpo: el LRU (acotado a `size`
+
+    entradas) no retiene las páginas sin comprimir ni las compara enteras.
+
+    """
+
+    ENCODINGS = ('gzip', 'deflate')
+
+
+
+    def __init__(self, level: int = COMPRESSION_LEVEL, min_size: int = COMPRESSION_MIN_SIZE,
+
+                 size: int = COMPRESSION_CACHE_SIZE):
+
+        self.level = level
+
+        self.min_size = min_size
+
+        self.size = size
+
+        self.hits = 0
+
+        self.misses = 0
+
+        self.bytes_in = 0
+
+        self.bytes_out = 0
+
+        self._lock = threading.Lock()
+
+        self._entries: OrderedDict = OrderedDict()
+
+
+
+    def negotiate(self, accept_encoding: str) -> Optional[str]:
+
+        """Mejor codificación admitida por el cliente según los q-values de Accept-Encoding.
+
+
+
+        q=0 excluye la codificación, `*` vale para las no nombradas y, si el cliente
+
+        da a identity (explícitamente o vía `*`) más peso que a cualquier codificación,
+
+        se envía sin comprimir. Sin ninguna aceptable se responde sin comprimir, también
+
+        con identity;q=0.
+
+        """
+
+        weights: Dict[str, float] = {}
+
+        for item in accept_encoding.split(','):
+
+            name, *params = item.split(';')
+
+            name = name.strip().lower()
+
+            if not name:
+
+                continue
+
+            q = 1.0
+
+            for param in params:
+
+                key, _, value = param.partition('=')
+
+                if key.strip().lower() == 'q':
+
+                    try:
+
+                        q = float(value)
+
+                    except ValueError:
+
+                        q = -1.0
+
+            # q fuera de [0, 1] (o NaN): la entrada se ignora
+
+            if not 0.0 <= q <= 1.0:
+
+                continue
+
+            weights[name] = q
+
+        wildcard = weights.get('*')
+
+        identity_q = weights.get('identity', 0.0 if wildcard is None else wildcard)
+
+
+
+        def weight(name: str) -> float:
+
+            return weights.get(name, 0.0 if wildcard is None else wildcard)
+
+
+
+        # A igual q, gzip antes que deflate (max conserva el primero de ENCODINGS)
+
+        best = max(self.ENCODINGS, key=weight)
+
+        q = weight(best)
+
+        if q <= 0.0 or q < identity_q:
+
+            return None
+
+        return best
+
+
+
+    def compressible(self, body: bytes, content_type: str) -> bool:
+
+        return self.level > 0 and len(body) >= self.min_size and content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+
+    def compress(self, body: bytes, encoding: str) -> bytes:
+
+        key = (encoding, hashlib.blake2b(body, digest_size=16).digest())
+
+        with self._lock:
+
+            compressed = self._entries.get(key)
+
+            if compressed is not None:
+
+                self._entries.move_to_end(key)
+
+                self.hits += 1
+
+                return compressed
+
+            self.misses += 1
+
+        if encoding == 'gzip':
+
+            # mtime=0: mismo cuerpo, mismos bytes (y mismo ETag aguas abajo)
+
+            compressed = gzip.compress(body, compresslevel=self.level, mtime=0)
+
+        else:
+
+            compressed = zlib.compress(body, self.level)
+
+        with self._lock:
+
+            self._entries[key] = compressed
+
+            if len(self._entries) > self.size:
+
+                self._entries.popitem(last=False)
+
+            self.bytes_in += len(body)
+
+            self.bytes_out += len(compressed)
+
+        return compressed
+
+
+
+    def stats(self) -> Dict[str, any]:
+
+        with self._lock:
+
+            return {
+
+                'level': self.level,
+
+                'min_size': self.min_size,
+
+                'entries': len(self._entries),
+
+                'hits': self.hits,
+
+                'misses': self.misses,
+
+                'ratio': round(self.bytes_out / self.bytes_in, 3) if self.bytes_in else None
+
+            }
+
+
+
+response_cache = CompressionCache()
+
+
+
+def encode_cursor(order: P2POrder) -> str:
+
+    """Cursor de paginación por clave (precio, id); repr conserva el float exacto"""
+
+    return f'{order.price!r}:{order.id}'
+
+
+
+def decode_cursor(value: Optional[str]) -> Optional[Tuple[float, int]]:
+
+    if not value:
+
+        return None
+
+    price, _, order_id = value.partition(':')
+
+    return float(price), int(order_id)
+
+
+
+def query_digest(*parts) -> str:
+
+    """Resumen de la consulta ya normalizada (filtros, cursor, límite) para el ETag:
+
+    páginas o filtros distintos sobre los mismos datos no comparten validador"""
+
+    return hashlib.blake2s(repr(parts).encode('utf-8'), digest_size=6).hexdigest()
+
+
+
+def order_to_dict(order: P2POrder, merchant: Optional[UserStats] = None) -> Dict[str, any]:
+
+    data = {
+
+        'id': order.id,
+
+        'user_id': order.user_id,
+
+        'username': order.username,
+
+        'order_type': order.order_type.value,
+
+        'asset': order.asset,
+
+        'fiat': order.fiat,
+
+        'price': order.price,
+
+        'quantity': order.quantity,
+
+        'available_quantity': order.available_quantity,
+
+        'payment_methods': order.payment_methods,
+
+        'status': order.status.value,
+
+        'min_amount': order.min_amount,
+
+        'max_amount': order.max_amount,
+
+        'created_at': order.created_at
+
+    }
+
+    if merchant is not None:
+
+        data['merchant'] = merchant.to_dict()
+
+    return data
+
+
+
+# HTML Templates simplificados
+
+HTML_TEMPLATES = {
+
+    'base': '''
+
+<!DOCTYPE html>
+
+<html lang="es">
+
+<head>
+
+    <meta charset="UTF-8">
+
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+
+    <title>{title}</title>
+
+    <link rel="stylesheet" href="{stylesheet}">
+
+</head>
+
+<body>
+
+    <nav class="navbar">
+
+        <div class="nav-container">
+
+            <div class="nav-logo">
+
+                <h2>P2P TRADING</h2>
+
+            </div>
+
+            <div class="nav-menu">
+
+                {nav_menu}
+
+            </div>
+
+        </div>
+
+    </nav>
+
+    <div class="container">
+
+        {content}
+
+    </div>
+
+    {modal}
+
+    {scripts}
+
+</body>
+
+</html>
+
+    ''',
+
+   
+
+    'login': '''
+
+<div class="auth-container">
+
+    <div class="auth-card">
+
+        <h2>Iniciar Sesión</h2>
+
+        {error}
+
+        <form method="POST" class="auth-form">
+
+            <div class="form-group">
+
+                <label>Usuario:</label>
+
+                <input type="text" name="username" required>
+
+            </div>
+
+            <div class="form-group">
+
+                <label>Contraseña:</label>
+
+                <input type="password" name="password" required>
+
+            </div>
+
+            <button type="submit" class="btn btn-primary">Iniciar Sesión</button>
+
+        </form>
+
+        <p style="text-align: center; margin-top: 1rem;">
+
+            ¿No tienes cuenta? <a href="/register" style="color: #00ff88;">Regístrate aquí</a>
+
+        </p>
+
+        <div class="test-users">
+
+            <h4>Usuarios de Prueba:</h4>
+
+            <p><strong>Usuario: trader1 / Contraseña: password123</strong></p>
+
+            <p><strong>Usuario: trader2 / Contraseña: password123</strong></p>
+
+            <p><strong>Usuario: trader3 / Contraseña: password123</strong></p>
+
+        </div>
+
+    </div>
+
+</div>
+
+    ''',
+
+   
+
+    'register': '''
+
+<div class="auth-container">
+
+    <div class="auth-card">
+
+        <h2>Crear Cuenta</h2>
+
+        {error}
+
+        <form method="POST" class="auth-form">
+
+            <div class="form-group">
+
+                <label>Usuario:</label>
+
+                <input type="text" name="username" required>
+
+            </div>
+
+            <div class="form-group">
+
+                <label>Email:</label>
+
+                <input type="email" name="email" required>
+
+            </div>
+
+            <div class="form-group">
+
+                <label>Contraseña:</label>
+
+                <input type="password" name="password" required>
+
+            </div>
+
+            <button type="submit" class="btn btn-primary">Registrarse</button>
+
+        </form>
+
+        <p style="text-align: center; margin-top: 1rem;">
+
+            ¿Ya tienes cuenta? <a href="/login" style="color: #00ff88;">Inicia sesión aquí</a>
+
+        </p>
+
+    </div>
+
+</div>
+
+    ''',
+
+   
+
+    'dashboard': '''
+
+<div class="dashboard">
+
+    <div class="dashboard-header">
+
+        <h1>Mercado P2P</h1>
+
+       
+
+        <div class="user-balance">
+
+            <h3>Tu Billetera</h3>
+
+            <div class="balance-grid">
+
+                {balance_items}
+
+            </div>
+
+        </div>
+
+    </div>
+
+
+
+    <div class="dashboard-content">
+
+        <div class="orders-section">
+
+            <h2>Anuncios del Mercado ({orders_count})</h2>
+
+            {message}
+
+            {filters}
+
+            <div class="orders-grid" id="ordersGrid">
+
+                {orders}
+
+            </div>
+
+            {pagination}
+
+        </div>
+
+
+
+        <div class="create-order-section">
+
+            <h2>Crear Anuncio</h2>
+
+            <form id="createOrderForm" class="order-form">
+
+                <div class="form-row">
+
+                    <div class="form-group">
+
+                        <label>Tipo:</label>
+
+                        <select name="order_type" required>
+
+                            <option value="BUY">COMPRAR</option>
+
+                            <option value="SELL">VENDER</option>
+
+                        </select>
+
+                    </div>
+
+                    <div class="form-group">
+
+                        <label>Activo:</label>
+
+                        <select name="asset" required>
+
+                            <option value="USDT">USDT</option>
+
+                            <option value="BTC">BTC</option>
+
+                            <option value="ETH">ETH</option>
+
+                        </select>
+
+                    </div>
+
+                </div>
+
+
+
+                <div class="form-row">
+
+                    <div class="form-group">
+
+                        <label>Moneda:</label>
+
+                        <select name="fiat" required>
+
+                            <option value="USD">USD</option>
+
+                            <option value="EUR">EUR</option>
+
+                        </select>
+
+                    </div>
+
+                    <div class="form-group">
+
+                        <label>Precio:</label>
+
+                        <input type="number" step="0.01" name="price" required>
+
+                    </div>
+
+                </div>
+
+               
+
+                <div class="form-group">
+
+                    <label>Cantidad:</label>
+
+                    <input type="number" step="0.01" name="quantity" required>
+
+                </div>
+
+
+
+                <div class="form-group">
+
+                    <label>Mínimo:</label>
+
+                    <input type="number" step="0.01" name="min_amount" required>
+
+                </div>
+
+
+
+                <div class="form-group">
+
+                    <label>Máximo:</label>
+
+                    <input type="number" step="0.01" name="max_amount" required>
+
+                </div>
+
+
+
+                <button type="submit" class="btn btn-primary">Publicar Anuncio</button>
+
+            </form>
+
+        </div>
+
+    </div>
+
+</div>
+
+    ''',
+
+
+
+    'balance_item': '''
+
+                <div class="balance-item">
+
+                    <strong>{asset}</strong><br>
+
+                    Disponible: {available:.2f}<br>
+
+                    Bloqueado: {locked:.2f}<br>
+
+                    Total: {total:.2f}
+
+                </div>
+
+            ''',
+
+
+
+    'order_card': '''
+
+                <div class="order-card {order_type_class}">
+
+                    <div class="order-header">
+
+                        <strong>{username}</strong>
+
+                        <span>{order_type_text}</span>
+
+                        <strong>{price} {fiat}</strong>
+
+                    </div>
+
+                    <div class="merchant-stats">{trust_level} · {completed_trades} trades · {completion_rate}% completados</div>
+
+                    <div>
+
+                        <p>Cantidad: {available_quantity} {asset}</p>
+
+                        <p>Límites: {min_amount} - {max_amount} {fiat}</p>
+
+                        <p>Métodos: {payment_methods}</p>
+
+                    </div>
+
+                    <form class="trade-form" onsubmit="startTrade(event, {order_id})">
+
+                        <input type="number" step="0.01" min="{min_quantity}" max="{available_quantity}" placeholder="Cantidad a {action}" required>
+
+                        <button type="submit" class="btn {button_class}">{button_text}</button>
+
+                    </form>
+
+                </div>
+
+            ''',
+
+
+
+    'order_filters': '''
+
+            <form method="GET" action="/dashboard" class="order-filters">
+
+                <select name="asset">{asset_options}</select>
+
+                <select name="fiat">{fiat_options}</select>
+
+                <select name="order_type">{side_options}</select>
+
+                <select name="payment_method">{method_options}</select>
+
+                <button type="submit" class="btn btn-primary">Filtrar</button>
+
+            </form>
+
+        ''',
+
+
+
+    'pagination': '''
+
+            <div class="pagination">
+
+                <a href="{href}" class="btn btn-primary">Siguiente página</a>
+
+            </div>
+
+        ''',
+
+
+
+    'nav_user': '''
+
+            <span class="nav-user">{username}</span>
+
+            <a href="/dashboard" class="nav-link">Inicio</a>
+
+            <a href="/logout" class="nav-link">Salir</a>
+
+        ''',
+
+
+
+    'trade_modal': '''
+
+        <div id="tradeModal" class="modal">
+
+            <div class="modal-content">
+
+                <h2>Confirmación de Pago</h2>
+
+                <div style="font-size: 2rem; margin: 1rem 0;" id="countdown">15:00</div>
+
+                <div id="statusMessage">Esperando pago...</div>
+
+                <button class="btn btn-warning" onclick="simulatePayment()" id="simulateBtn">Simular Pago</button>
+
+                <button class="btn btn-primary" onclick="closeModal()" style="margin-top: 1rem; display: none;" id="closeBtn">Finalizar</button>
+
+            </div>
+
+        </div>
+
+        '''
+
+}
+
+
+
+class Template:
+
+    """Plantilla de HTML_TEMPLATES (sintaxis str.format) compilada una sola vez.
+
+
+
+    render_into() añade los trozos a una lista en lugar de concatenar
+
+    cadenas; un valor que ya es una lista (otra plantilla renderizada) se
+
+    inserta sin unirlo, así que anidar plantillas no copia su contenido.
+
+    """
+
+    _formatter = string.Formatter()
+
+
+
+    def __init__(self, source: str):
+
+        self._parts: List[Tuple[str, Optional[str], str]] = []
+
+        for literal, field, spec, conversion in self._formatter.parse(source):
+
+            if field is not None and (not field.isidentifier() or conversion):
+
+                raise ValueError(f"Campo de plantilla no soportado: {{{field}}}")
+
+            self._parts.append((literal, field, spec))
+
+
+
+    def render_into(self, out: List[str], **values) -> List[str]:
+
+        for literal, field, spec in self._parts:
+
+            if literal:
+
+                out.append(literal)
+
+            if field is None:
+
+                continue
+
+            value = values[field]
+
+            if isinstance(value, list):
+
+                out.extend(value)
+
+            else:
+
+                out.append(format(value, spec))
+
+        return out
+
+
+
+    def render(self, **values) -> str:
+
+        return ''.join(self.render_into([], **values))
+
+
+
+TEMPLATES = {name: Template(source) for name, source in HTML_TEMPLATES.items()}
+
+
+
+class FragmentCache:
+
+    """LRU de fragmentos HTML ya renderizados"""
+
+    def __init__(self, size: int = FRAGMENT_CACHE_SIZE):
+
+        self.size = size
+
+        self.hits = 0
+
+        self.misses = 0
+
+        self._lock = threading.Lock()
+
+        self._entries: OrderedDict = OrderedDict()
+
+
+
+    def get(self, key) -> Optional[str]:
+
+        with self._lock:
+
+            fragment = self._entries.get(key)
+
+            if fragment is None:
+
+                self.misses += 1
+
+                return None
+
+            self._entries.move_to_end(key)
+
+            self.hits += 1
+
+            return fragment
+
+
+
+    def put(self, key, fragment: str):
+
+        with self._lock:
+
+            self._entries[key] = fragment
+
+            if len(self._entries) > self.size:
+
+                self._entries.popitem(last=False)
+
+
+
+    def stats(self) -> Dict[str, int]:
+
+        with self._lock:
+
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+
+order_card_cache = FragmentCache()
+
+
+
+def render_order_card(order: P2POrder, merchant: UserStats) -> str:
+
+    """Tarjeta de una orden; solo se renderiza de nuevo si cambia su cantidad, estado o las
+
+    estadísticas del anunciante"""
+
+    key = (order.id, order.available_quantity, order.status, merchant.completed_trades,
+
+           merchant.cancelled_trades, merchant.reputation)
+
+    card = order_card_cache.get(key)
+
+    if card is None:
+
+        buy = order.order_type is OrderType.BUY
+
+        card = TEMPLATES['order_card'].render(
+
+            order_type_class='buy' if buy else 'sell',
+
+            order_type_text='COMPRA' if buy else 'VENTA',
+
+            username=order.username,
+
+            trust_level=merchant.trust_level,
+
+            completed_trades=merchant.completed_trades,
+
+            completion_rate=round(100 * (1 - merchant.cancellation_rate)),
+
+            price=order.price,
+
+            fiat=order.fiat,
+
+            available_quantity=order.available_quantity,
+
+            asset=order.asset,
+
+            min_amount=order.min_amount,
+
+            max_amount=order.max_amount,
+
+            payment_methods=", ".join(order.payment_methods),
+
+            order_id=order.id,
+
+            min_quantity=order.min_amount / order.price,
+
+            action='vender' if buy else 'comprar',
+
+            button_class='btn-buy' if buy else 'btn-sell',
+
+            button_text='Vender' if buy else 'Comprar'
+
+        )
+
+        order_card_cache.put(key, card)
+
+    return card
+
+
+
+# Fuentes de los assets estáticos; StaticAssets las minifica y les pone huella al arrancar
+
+STATIC_SOURCES = {
+
+    'app.css': '''
+
+        * {
+
+            margin: 0;
+
+            padding: 0;
+
+            box-sizing: border-box;
+
+        }
+
+
+
+        body {
+
+            font-family: Arial, sans-serif;
+
+            background: #0a0a0a;
+
+            color: #ffffff;
+
+            line-height: 1.6;
+
+        }
+
+
+
+        .navbar {
+
+            background: #111;
+
+            padding: 1rem 0;
+
+            border-bottom: 1px solid #333;
+
+        }
+
+
+
+        .nav-container {
+
+            max-width: 1200px;
+
+            margin: 0 auto;
+
+            display: flex;
+
+            justify-content: space-between;
+
+            align-items: center;
+
+            padding: 0 2rem;
+
+        }
+
+
+
+        .nav-logo h2 {
+
+            color: #00ff88;
+
+            font-weight: bold;
+
+        }
+
+
+
+        .nav-menu {
+
+            display: flex;
+
+            align-items: center;
+
+            gap: 1rem;
+
+        }
+
+
+
+        .nav-user {
+
+            background: #222;
+
+            padding: 0.5rem 1rem;
+
+            border-radius: 5px;
+
+        }
+
+
+
+        .nav-link {
+
+            color: #fff;
+
+            text-decoration: none;
+
+            padding: 0.5rem 1rem;
+
+            border-radius: 5px;
+
+        }
+
+
+
+        .nav-link:hover {
+
+            background: #333;
+
+        }
+
+
+
+        .container {
+
+            max-width: 1200px;
+
+            margin: 0 auto;
+
+            padding: 2rem;
+
+        }
+
+
+
+        .auth-container {
+
+            display: flex;
+
+            justify-content: center;
+
+            align-items: center;
+
+            min-height: 80vh;
+
+        }
+
+
+
+        .auth-card {
+
+            background: #111;
+
+            border: 1px solid #333;
+
+            padding: 2rem;
+
+            border-radius: 10px;
+
+            width: 100%;
+
+            max-width: 400px;
+
+        }
+
+
+
+        .auth-card h2 {
+
+            text-align: center;
+
+            margin-bottom: 1.5rem;
+
+            color: #00ff88;
+
+        }
+
+
+
+        .auth-form {
+
+            display: flex;
+
+            flex-direction: column;
+
+            gap: 1rem;
+
+        }
+
+
+
+        .form-group {
+
+            display: flex;
+
+            flex-direction: column;
+
+        }
+
+
+
+        .form-group label {
+
+            margin-bottom: 0.5rem;
+
+            color: #ccc;
+
+        }
+
+
+
+        .form-group input {
+
+            padding: 0.75rem;
+
+            background: #222;
+
+            border: 1px solid #333;
+
+            border-radius: 5px;
+
+            color: #fff;
+
+        }
+
+
+
+        .btn {
+
+            padding: 0.75rem 1.5rem;
+
+            border: none;
+
+            border-radius: 5px;
+
+            font-weight: bold;
+
+            cursor: pointer;
+
+            text-decoration: none;
+
+            display: inline-block;
+
+            text-align: center;
+
+        }
+
+
+
+        .btn-primary {
+
+            background: #00ff88;
+
+            color: #000;
+
+        }
+
+
+
+        .btn-success {
+
+            background: #00ff88;
+
+            color: #000;
+
+        }
+
+
+
+        .btn-warning {
+
+            background: #ffb800;
+
+            color: #000;
+
+        }
+
+
+
+        .btn-buy {
+
+            background: #00ff88;
+
+            color: #000;
+
+        }
+
+
+
+        .btn-sell {
+
+            background: #ff4757;
+
+            color: #fff;
+
+        }
+
+
+
+        .alert {
+
+            padding: 1rem;
+
+            border-radius: 5px;
+
+            margin-bottom: 1rem;
+
+        }
+
+
+
+        .alert-error {
+
+            background: #ff4757;
+
+            color: #fff;
+
+        }
+
+
+
+        .alert-success {
+
+            background: #00ff88;
+
+            color: #000;
+
+        }
+
+
+
+        .test-users {
+
+            margin-top: 1.5rem;
+
+            padding: 1rem;
+
+            background: #222;
+
+            border-radius: 5px;
+
+            font-size: 0.9rem;
+
+        }
+
+
+
+        .dashboard-header {
+
+            margin-bottom: 2rem;
+
+        }
+
+
+
+        .dashboard-header h1 {
+
+            color: #00ff88;
+
+            margin-bottom: 1rem;
+
+        }
+
+
+
+        .user-balance {
+
+            background: #111;
+
+            border: 1px solid #333;
+
+            padding: 1.5rem;
+
+            border-radius: 10px;
+
+            margin-bottom: 2rem;
+
+        }
+
+
+
+        .balance-grid {
+
+            display: grid;
+
+            grid-template-columns: repeat(auto-fit, minmax(200px, 1fr));
+
+            gap: 1rem;
+
+            margin-top: 1rem;
+
+        }
+
+
+
+        .balance-item {
+
+            background: #222;
+
+            padding: 1rem;
+
+            border-radius: 5px;
+
+            border-left: 4px solid #00ff88;
+
+        }
+
+
+
+        .dashboard-content {
+
+            display: grid;
+
+            grid-template-columns: 2fr 1fr;
+
+            gap: 2rem;
+
+        }
+
+
+
+        .order-filters {
+
+            display: flex;
+
+            gap: 0.5rem;
+
+            margin-bottom: 1rem;
+
+        }
+
+
+
+        .order-filters select {
+
+            padding: 0.5rem;
+
+            background: #222;
+
+            border: 1px solid #444;
+
+            border-radius: 5px;
+
+            color: #fff;
+
+        }
+
+
+
+        .pagination {
+
+            margin-top: 1rem;
+
+            text-align: center;
+
+        }
+
+
+
+        .orders-grid {
+
+            display: flex;
+
+            flex-direction: column;
+
+            gap: 1rem;
+
+            max-height: 600px;
+
+            overflow-y: auto;
+
+        }
+
+
+
+        .order-card {
+
+            background: #111;
+
+            border: 1px solid #333;
+
+            padding: 1.5rem;
+
+            border-radius: 10px;
+
+        }
+
+
+
+        .order-card.buy {
+
+            border-left: 4px solid #00ff88;
+
+        }
+
+
+
+        .order-card.sell {
+
+            border-left: 4px solid #ff4757;
+
+        }
+
+
+
+        .order-header {
+
+            display: flex;
+
+            justify-content: space-between;
+
+            align-items: center;
+
+            margin-bottom: 1rem;
+
+        }
+
+
+
+        .merchant-stats {
+
+            font-size: 0.85rem;
+
+            opacity: 0.8;
+
+            margin-bottom: 0.5rem;
+
+        }
+
+
+
+        .trade-form {
+
+            display: flex;
+
+            gap: 0.5rem;
+
+            margin-top: 1rem;
+
+        }
+
+
+
+        .trade-form input {
+
+            flex: 1;
+
+            padding: 0.5rem;
+
+            background: #222;
+
+            border: 1px solid #333;
+
+            border-radius: 5px;
+
+            color: #fff;
+
+        }
+
+
+
+        .create-order-section {
+
+            background: #111;
+
+            border: 1px solid #333;
+
+            padding: 1.5rem;
+
+            border-radius: 10px;
+
+            height: fit-content;
+
+        }
+
+
+
+        .order-form {
+
+            display: flex;
+
+            flex-direction: column;
+
+            gap: 1rem;
+
+        }
+
+
+
+        .form-row {
+
+            display: grid;
+
+            grid-template-columns: 1fr 1fr;
+
+            gap: 1rem;
+
+        }
+
+
+
+        .modal {
+
+            display: none;
+
+            position: fixed;
+
+            z-index: 1000;
+
+            left: 0;
+
+            top: 0;
+
+            width: 100%;
+
+            height: 100%;
+
+            background: rgba(0,0,0,0.8);
+
+        }
+
+
+
+        .modal-content {
+
+            background: #111;
+
+            border: 1px solid #333;
+
+            border-radius: 10px;
+
+            padding: 2rem;
+
+            width: 90%;
+
+            max-width: 400px;
+
+            position: absolute;
+
+            top: 50%;
+
+            left: 50%;
+
+            transform: translate(-50%, -50%);
+
+            text-align: center;
+
+        }
+
+    ''',
+
+
+
+    'dashboard.js': '''
+
+        let currentTradeId = null;
+
+        let countdownInterval = null;
+
+
+
+        function startTrade(event, orderId) {
+
+            event.preventDefault();
+
+            const form = event.target;
+
+            const quantity = parseFloat(form.querySelector('input').value);
+
+           
+
+            fetch('/start_trade', {
+
+                method: 'POST',
+
+                headers: {
+
+                    'Content-Type': 'application/x-www-form-urlencoded',
+
+                },
+
+                body: new URLSearchParams({
+
+                    'order_id': orderId,
+
+                    'quantity': quantity
+
+                })
+
+            })
+
+            .then(response => response.text())
+
+            .then(tradeId => {
+
+                if (tradeId) {
+
+                    currentTradeId = tradeId;
+
+                    showPaymentModal();
+
+                    startCountdown();
+
+                    watchTradeStatus(tradeId);
+
+                } else {
+
+                    alert('Error al iniciar trade');
+
+                }
+
+            });
+
+        }
+
+
+
+        function watchTradeStatus(tradeId) {
+
+            const source = new EventSource(`/trade_status/${tradeId}/stream`);
+
+            source.addEventListener('status', event => {
+
+                const data = JSON.parse(event.data);
+
+                if (data.status === 'COMPLETED') {
+
+                    source.close();
+
+                    document.getElementById('statusMessage').textContent = '¡Pago confirmado! Fondos agregados a tu billetera.';
+
+                    document.getElementById('closeBtn').style.display = 'block';
+
+                    if (countdownInterval) {
+
+                        clearInterval(countdownInterval);
+
+                    }
+
+                } else if (data.status === 'CANCELLED') {
+
+                    source.close();
+
+                    document.getElementById('statusMessage').textContent = 'Trade cancelado';
+
+                    document.getElementById('closeBtn').style.display = 'block';
+
+                }
+
+            });
+
+        }
+
+
+
+        function showPaymentModal() {
+
+            document.getElementById('tradeModal').style.display = 'block';
+
+        }
+
+
+
+        function closeModal() {
+
+            document.getElementById('tradeModal').style.display = 'none';
+
+            if (countdownInterval) {
+
+                clearInterval(countdownInterval);
+
+            }
+
+            location.reload();
+
+        }
+
+
+
+        function startCountdown() {
+
+            let timeLeft = 15 * 60;
+
+            const countdownElement = document.getElementById('countdown');
+
+           
+
+            countdownInterval = setInterval(() => {
+
+                timeLeft--;
+
+                const minutes = Math.floor(timeLeft / 60);
+
+                const seconds = timeLeft % 60;
+
+                countdownElement.textContent = `${minutes.toString().padStart(2, '0')}:${seconds.toString().padStart(2, '0')}`;
+
+               
+
+                if (timeLeft <= 0) {
+
+                    clearInterval(countdownInterval);
+
+                    document.getElementById('statusMessage').textContent = 'Tiempo agotado';
+
+                }
+
+            }, 1000);
+
+        }
+
+
+
+        function simulatePayment() {
+
+            document.getElementById('simulateBtn').style.display = 'none';
+
+            document.getElementById('statusMessage').textContent = 'Procesando pago...';
+
+           
+
+            setTimeout(() => {
+
+                fetch('/confirm_payment', {
+
+                    method: 'POST',
+
+                    headers: {
+
+                        'Content-Type': 'application/x-www-form-urlencoded',
+
+                    },
+
+                    body: new URLSearchParams({
+
+                        'trade_id': currentTradeId
+
+                    })
+
+                })
+
+                .then(response => {
+
+                    if (response.ok) {
+
+                        document.getElementById('statusMessage').textContent = '¡Pago confirmado! Fondos agregados a tu billetera.';
+
+                        document.getElementById('closeBtn').style.display = 'block';
+
+                        if (countdownInterval) {
+
+                            clearInterval(countdownInterval);
+
+                        }
+
+                    }
+
+                });
+
+            }, 2000);
+
+        }
+
+
+
+        document.getElementById('createOrderForm').addEventListener('submit', function(event) {
+
+            event.preventDefault();
+
+            fetch('/create_order', {
+
+                method: 'POST',
+
+                body: new URLSearchParams(new FormData(this))
+
+            })
+
+            .then(response => {
+
+                if (response.ok) {
+
+                    alert('Anuncio creado exitosamente!');
+
+                    location.reload();
+
+                } else {
+
+                    alert('Error al crear anuncio');
+
+                }
+
+            });
+
+        });
+
+        '''
+
+}
+
+
+
+def minify_css(source: str) -> str:
+
+    source = re.sub(r'/\*.*?\*/', '', source, flags=re.S)
+
+    source = re.sub(r'\s+', ' ', source)
+
+    source = re.sub(r'\s*([{}:;,>])\s*', r'\1', source)
+
+    return source.replace(';}', '}').strip()
+
+
+
+def minify_js(source: str) -> str:
+
+    """Minificado conservador: sin comentarios de línea completa ni sangría.
+
+
+
+    No reescribe dentro de las líneas para no tocar cadenas ni plantillas.
+
+    """
+
+    lines = (line.strip() for line in source.splitlines())
+
+    return '\n'.join(line for line in lines if line and not line.startswith('//'))
+
+
+
+class StaticAssets:
+
+    """Assets minificados al arrancar y servidos bajo URLs con la huella de su contenido.
+
+
+
+    La URL cambia con el contenido, así que el navegador puede guardarlos
+
+    como immutable: nunca vuelve a pedirlos ni a revalidarlos.
+
+    """
+
+    MINIFIERS = {'.css': minify_css, '.js': minify_js}
+
+    CONTENT_TYPES = {'.css': 'text/css; charset=utf-8', '.js': 'application/javascript; charset=utf-8'}
+
+
+
+    def __init__(self, sources: Dict[str, str], prefix: str = STATIC_PREFIX):
+
+        self._urls: Dict[str, str] = {}
+
+        self._files: Dict[str, Tuple[bytes, str]] = {}
+
+        for name, source in sources.items():
+
+            stem, ext = os.path.splitext(name)
+
+            body = self.MINIFIERS[ext](source).encode('utf-8')
+
+            filename = f'{stem}.{hashlib.sha256(body).hexdigest()[:12]}{ext}'
+
+            self._urls[name] = f'{prefix}/{filename}'
+
+            self._files[filename] = (body, self.CONTENT_TYPES[ext])
+
+
+
+    def url(self, name: str) -> str:
+
+        return self._urls[name]
+
+
+
+    def get(self, filename: str) -> Optional[Tuple[bytes, str]]:
+
+        return self._files.get(filename)
+
+
+
+static_assets = StaticAssets(STATIC_SOURCES)
+
+
+
+class Router:
+
+    """Tabla de rutas compilada: (método, patrón) → nombre del método del handler.
+
+
+
+    Las rutas estáticas se resuelven con un dict. Las que tienen parámetros
+
+    tipados (`/trade_status/<int:trade_id>`) se compilan a regex y se agrupan
+
+    por (método, primer segmento), así cada petición prueba solo su grupo.
+
+    """
+
+    CONVERTERS = {
+
+        'int': (r'\d+', int),
+
+        'float': (r'\d+(?:\.\d+)?', float),
+
+        'str': (r'[^/]+', str)
+
+    }
+
+    PARAM = re.compile(r'<(?:(\w+):)?(\w+)>')
+
+
+
+    def __init__(self):
+
+        self._static: Dict[Tuple[str, str], str] = {}
+
+        self._dynamic: Dict[Tuple[str, str], List[Tuple[re.Pattern, str, Dict[str, any]]]] = {}
+
+
+
+    @staticmethod
+
+    def _first_segment(path: str) -> str:
+
+        return path.lstrip('/').split('/', 1)[0]
+
+
+
+    def add(self, method: str, pattern: str, handler: str):
+
+        if '<' not in pattern:
+
+            self._static[(method, pattern)] = handler
+
+            return
+
+
+
+        converters = {}
+
+        regex = ''
+
+        position = 0
+
+        for param in self.PARAM.finditer(pattern):
+
+            kind, name = param.group(1) or 'str', param.group(2)
+
+            expression, converters[name] = self.CONVERTERS[kind]
+
+            regex += re.escape(pattern[position:param.start()]) + f'(?P<{name}>{expression})'
+
+            position = param.end()
+
+        regex += re.escape(pattern[position:])
+
+        bucket = self._dynamic.setdefault((method, self._first_segment(pattern)), [])
+
+        bucket.append((re.compile(regex + '$'), handler, converters))
+
+
+
+    def match(self, method: str, path: str) -> Optional[Tuple[str, Dict[str, any]]]:
+
+        handler = self._static.get((method, path))
+
+        if handler is not None:
+
+            return handler, {}
+
+        for regex, handler, converters in self._dynamic.get((method, self._first_segment(path)), ()):
+
+            found = regex.match(path)
+
+            if found:
+
+                return handler, {name: converters[name](value) for name, value in found.groupdict().items()}
+
+        return None
+
+
+
+    def allowed_methods(self, path: str) -> List[str]:
+
+        return [method for method in ('GET', 'POST') if self.match(method, path) is not None]
+
+
+
+ROUTES = Router()
+
+ROUTES.add('GET', '/', 'serve_root')
+
+ROUTES.add('GET', '/login', 'serve_login')
+
+ROUTES.add('GET', '/register', 'serve_register')
+
+ROUTES.add('GET', '/dashboard', 'serve_dashboard')
+
+ROUTES.add('GET', '/logout', 'do_logout')
+
+ROUTES.add('GET', '/trade_status/<int:trade_id>', 'handle_trade_status')
+
+ROUTES.add('GET', '/trade_status/<int:trade_id>/stream', 'stream_trade_status')
+
+ROUTES.add('GET', '/ws/market', 'stream_market_data')
+
+ROUTES.add('GET', '/stats', 'serve_stats')
+
+ROUTES.add('GET', '/admin/logging', 'serve_logging_config')
+
+ROUTES.add('POST', '/admin/logging', 'handle_logging_config')
+
+ROUTES.add('GET', STATIC_PREFIX + '/<str:filename>', 'serve_static')
+
+ROUTES.add('POST', '/login', 'handle_login')
+
+ROUTES.add('POST', '/register', 'handle_register')
+
+ROUTES.add('POST', '/create_order', 'handle_create_order')
+
+ROUTES.add('POST', '/start_trade', 'handle_start_trade')
+
+ROUTES.add('POST', '/confirm_payment', 'handle_confirm_payment')
+
+ROUTES.add('GET', API_PREFIX + '/orders', 'api_list_orders')
+
+ROUTES.add('POST', API_PREFIX + '/orders', 'api_create_order')
+
+ROUTES.add('GET', API_PREFIX + '/balance', 'api_balance')
+
+ROUTES.add('POST', API_PREFIX + '/trades', 'api_start_trade')
+
+ROUTES.add('GET', API_PREFIX + '/trades/<int:trade_id>', 'api_get_trade')
+
+ROUTES.add('POST', API_PREFIX + '/trades/<int:trade_id>/confirm', 'api_confirm_trade')
+
+ROUTES.add('POST', API_PREFIX + '/trades/<int:trade_id>/cancel', 'api_cancel_trade')
+
+ROUTES.add('GET', API_PREFIX + '/users/<int:user_id>/stats', 'api_user_stats')
+
+
+
+# Rutas que escriben en SQLite: pasan por los token buckets de AdmissionControl
+
+WRITE_ROUTES = frozenset({
+
+    'handle_login', 'handle_register', 'handle_create_order', 'handle_start_trade',
+
+    'handle_confirm_payment', 'api_create_order', 'api_start_trade', 'api_confirm_trade',
+
+    'api_cancel_trade'
+
+})
+
+
+
+class RequestBodyError(Exception):
+
+    """Content-Length inválido (400) o mayor que MAX_REQUEST_BODY (413); la conexión se cierra"""
+
+    def __init__(self, message: str, status: int = 400):
+
+        super().__init__(message)
+
+        self.status = status
+
+
+
+def parse_content_length(value: Optional[str]) -> int:
+
+    """Valida Content-Length para los dos frontends: solo dígitos y como mucho MAX_REQUEST_BODY"""
+
+    value = (value or '').strip()
+
+    if not value:
+
+        return 0
+
+    if not (value.isascii() and value.isdigit()):
+
+        raise RequestBodyError(f'Content-Length inválido: {value[:32]!r}')
+
+    length = int(value)
+
+    if length > MAX_REQUEST_BODY:
+
+        raise RequestBodyError(f'Cuerpo demasiado grande ({length} > {MAX_REQUEST_BODY} bytes)', 413)
+
+    return length
+
+
+
+class P2PRequestHandler(http.server.SimpleHTTPRequestHandler):
+
+    # Conexiones persistentes: toda respuesta lleva Content-Length (ver end_headers)
+
+    protocol_version = 'HTTP/1.1'
+
+    timeout = KEEPALIVE_TIMEOUT
+
+    requests_served = 0
+
+    _body = None
+
+    _body_length = 0
+
+    _form = None
+
+    _content_length_sent = False
+
+    _connection_sent = False
+
+    _streaming = False
+
+    _status = None
+
+    _etag = None
+
+    _session = None
+
+    log_fields: Dict[str, any] = {}
+
+
+
+    def handle_one_request(self):
+
+        self.requests_served += 1
+
+        self._body = None
+
+        self._body_length = 0
+
+        self._form = None
+
+        self._streaming = False
+
+        self._status = None
+
+        self._etag = None
+
+        self._session = None
+
+        self.log_fields = {}
+
+        super().handle_one_request()
+
+
+
+    def send_response(self, code, message=None):
+
+        self._status = code
+
+        self._content_length_sent = False
+
+        self._connection_sent = False
+
+        super().send_response(code, message)
+
+
+
+    def send_header(self, keyword, value):
+
+        keyword_lower = keyword.lower()
+
+        if keyword_lower == 'content-length':
+
+            self._content_length_sent = True
+
+        elif keyword_lower == 'connection':
+
+            # send_error() y reject_body() ya envían Connection: close; no se repite
+
+            if self._connection_sent:
+
+                return
+
+            self._connection_sent = True
+
+        super().send_header(keyword, value)
+
+
+
+    def end_headers(self):
+
+        if not self._content_length_sent and not self._streaming and self._status != 304:
+
+            # Respuestas sin cuerpo (redirecciones, 400/401...): el cliente no debe esperar más bytes
+
+            self.send_header('Content-Length', '0')
+
+        if self._streaming or not getattr(self.server, 'keep_alive', False):
+
+            # Servidor de un solo hilo: una conexión inactiva bloquearía a todos los demás
+
+            self.send_header('Connection', 'close')
+
+        elif self.close_connection or self.requests_served >= MAX_KEEPALIVE_REQUESTS:
+
+            self.send_header('Connection', 'close')
+
+        elif not self._connection_sent:
+
+            self.send_header('Keep-Alive', f'timeout={int(self.timeout)}, max={MAX_KEEPALIVE_REQUESTS}')
+
+        super().end_headers()
+
+
+
+    def send_body(self, status: int, body: bytes, content_type: str, cache_control: Optional[str] = None):
+
+        encoding = None
+
+        compressible = response_cache.compressible(body, content_type)
+
+        if compressible:
+
+            encoding = response_cache.negotiate(self.headers.get('Accept-Encoding', ''))
+
+            if encoding:
+
+                body = response_cache.compress(body, encoding)
+
+        self.send_response(status)
+
+        self.send_header('Content-type', content_type)
+
+        if self._etag and status == 200:
+
+            self.send_header('ETag', self._etag)
+
+            cache_control = cache_control or 'private, no-cache'
+
+        if cache_control:
+
+            self.send_header('Cache-Control', cache_control)
+
+        if compressible:
+
+            self.send_header('Vary', 'Accept-Encoding')
+
+        if encoding:
+
+            self.send_header('Content-Encoding', encoding)
+
+        self.send_header('Content-Length', str(len(body)))
+
+        self.end_headers()
+
+        self.wfile.write(body)
+
+
+
+    def not_modified(self, etag: str) -> bool:
+
+        """Responde 304 si el cliente ya tiene `etag`; si no, send_body lo enviará con la respuesta.
+
+
+
+        Se llama antes de consultar nada: el camino del 304 no toca SQLite ni renderiza.
+
+        """
+
+        self._etag = etag
+
+        if not etag_matches(self.headers.get('If-None-Match'), etag):
+
+            return False
+
+        self.send_response(304)
+
+        self.send_header('ETag', etag)
+
+        self.send_header('Cache-Control', 'private, no-cache')
+
+        self.end_headers()
+
+        return True
+
+
+
+    def read_body(self) -> bytes:
+
+        """Lee una sola vez el cuerpo de la petición; do_POST lo consume siempre para
+
+        no dejar bytes sin leer en una conexión persistente"""
+
+        if self._body is None:
+
+            self._body = self.rfile.read(self._body_length)
+
+        return self._body
+
+
+
+    def read_form(self) -> Dict[str, List[str]]:
+
+        if self._form is None:
+
+            self._form = parse_qs(self.read_body().decode('utf-8'))
+
+        return self._form
+
+
+
+    def read_json(self) -> Dict[str, any]:
+
+        """Cuerpo de una escritura de la API: JSON, o urlencoded como los formularios"""
+
+        content_type = self.headers.get('Content-Type', '')
+
+        if content_type.startswith('application/json'):
+
+            data = json.loads(self.read_body() or b'{}')
+
+            if not isinstance(data, dict):
+
+                raise ValueError("se esperaba un objeto JSON")
+
+            return data
+
+        return {key: values[0] for key, values in self.read_form().items()}
+
+
+
+    def send_json(self, status: int, data):
+
+        self.send_body(status, dump_json(data), 'application/json')
+
+
+
+    def send_rejection(self, status: int, retry_after: float, reason: str):
+
+        """429/503 con Retry-After; en JSON para la API y en texto para los formularios"""
+
+        self.log_fields['rejected'] = reason
+
+        message = ('Demasiadas peticiones, inténtalo más tarde' if status == 429
+
+                   else 'Servidor ocupado, inténtalo más tarde')
+
+        if self.route_path.startswith(API_PREFIX):
+
+            body, content_type = dump_json({'error': message}), 'application/json'
+
+        else:
+
+            body, content_type = message.encode('utf-8'), 'text/plain; charset=utf-8'
+
+        self.send_response(status)
+
+        self.send_header('Content-type', content_type)
+
+        self.send_header('Retry-After', str(max(1, math.ceil(retry_after))))
+
+        self.send_header('Content-Length', str(len(body)))
+
+        self.end_headers()
+
+        self.wfile.write(body)
+
+
+
+    def reject_body(self, error: RequestBodyError):
+
+        """400/413 antes de enrutar; el cuerpo no se lee, así que la conexión no puede reutilizarse"""
+
+        self.log_fields['rejected'] = 'body'
+
+        self.close_connection = True
+
+        body = str(error).encode('utf-8')
+
+        self.send_response(error.status)
+
+        self.send_header('Content-type', 'text/plain; charset=utf-8')
+
+        self.send_header('Connection', 'close')
+
+        self.send_header('Content-Length', str(len(body)))
+
+        self.end_headers()
+
+        self.wfile.write(body)
+
+
+
+    def log_request(self, code='-', size='-'):
+
+        # Cada petición se registra una vez, con su latencia, al final de dispatch()
+
+        pass
+
+
+
+    def log_message(self, format, *args):
+
+        request_log.record('WARNING', 'http', client=self.client_address[0], message=format % args)
+
+
+
+    def do_GET(self):
+
+        self.dispatch('GET')
+
+   
+
+    def do_POST(self):
+
+        self.dispatch('POST')
+
+
+
+    def dispatch(self, method: str):
+
+        started = time.perf_counter()
+
+        url = urlparse(self.path)
+
+        self.route_path = url.path
+
+        self.query = parse_qs(url.query)
+
+        handler_name = None
+
+        admitted = False
+
+        body_ok = False
+
+        try:
+
+            try:
+
+                self._body_length = parse_content_length(self.headers.get('Content-Length'))
+
+            except RequestBodyError as e:
+
+                self.reject_body(e)
+
+                return
+
+            body_ok = True
+
+            match = ROUTES.match(method, url.path)
+
+            if match is None:
+
+                if ROUTES.allowed_methods(url.path):
+
+                    self.send_response(405)
+
+                    self.send_header('Allow', ', '.join(ROUTES.allowed_methods(url.path)))
+
+                    self.end_headers()
+
+                else:
+
+                    self.send_error(404)
+
+                return
+
+            handler_name, params = match
+
+            self.log_fields.update(params)
+
+            # Los streams son de larga duración: tienen su propio cupo (enter_stream)
+
+            if not handler_name.startswith('stream_'):
+
+                waiting = self.server.queued() if hasattr(self.server, 'queued') else 0
+
+                if not admission.enter(waiting):
+
+                    self.send_rejection(503, OVERLOAD_RETRY_AFTER, 'overload')
+
+                    return
+
+                admitted = True
+
+            if handler_name in WRITE_ROUTES:
+
+                # Bucket por sesión (sid), no por usuario: cada login tiene el suyo
+
+                reason, retry_after = admission.throttle(self.get_session().get('sid'),
+
+                                                         self.client_address[0])
+
+                if reason is not None:
+
+                    self.send_rejection(429, retry_after, reason)
+
+                    return
+
+            getattr(self, handler_name)(**params)
+
+        except Exception as e:
+
+            request_log.record('ERROR', 'handler_error', method=method, path=url.path,
+
+                               route=handler_name, error=repr(e))
+
+            if self._status is None:
+
+                self.send_error(500)
+
+            else:
+
+                # La respuesta ya había empezado: otra línea de estado corrompería la conexión
+
+                self.close_connection = True
+
+        finally:
+
+            if admitted:
+
+                admission.leave()
+
+            if method == 'POST' and body_ok:
+
+                self.read_body()
+
+            if request_log.enabled('INFO'):
+
+                user_id = self.get_session().get('user_id')
+
+                # Los campos de la petición prevalecen sobre parámetros de ruta homónimos (user_id)
+
+                fields = dict(
+
+                    self.log_fields, method=method, path=url.path, route=handler_name,
+
+                    status=self._status, latency_ms=round((time.perf_counter() - started) * 1000, 3),
+
+                    user_id=int(user_id) if user_id and user_id.isdigit() else None
+
+                )
+
+                request_log.record('INFO', 'request', **fields)
+
+
+
+    def serve_root(self):
+
+        self.send_response(302)
+
+        self.send_header('Location', '/login')
+
+        self.end_headers()
+
+   
+
+    def get_cookies(self) -> Dict[str, str]:
+
+        cookies = {}
+
+        for cookie in self.headers.get('Cookie', '').split(';'):
+
+            if '=' in cookie:
+
+                key, value = cookie.strip().split('=', 1)
+
+                cookies[key] = value
+
+        return cookies
+
+
+
+    def get_session(self) -> Dict[str, any]:
+
+        """user_id/username del token firmado; {} si falta, no es válido, caducó o se revocó"""
+
+        if self._session is None:
+
+            token = self.get_cookies().get(SESSION_COOKIE)
+
+            self._session = (p2p_system.verify_session(token) if token else None) or {}
+
+        return self._session
+
+   
+
+    def set_session(self, token: str):
+
+        self.send_header('Set-Cookie', f'{SESSION_COOKIE}={token}; Path=/; Max-Age={SESSION_TTL}; '
+
+                                       f'HttpOnly; SameSite=Lax')
+
+   
+
+    def serve_login(self, error=None):
+
+        session = self.get_session()
+
+        if 'user_id' in session:
+
+            self.send_response(302)
+
+            self.send_header('Location', '/dashboard')
+
+            self.end_headers()
+
+            return
+
+       
+
+        error_html = f'<div class="alert alert-error">{error}</div>' if error else ''
+
+        content = TEMPLATES['login'].render(error=error_html)
+
+        self.serve_page('Login - P2P Trading', content, '')
+
+   
+
+    def serve_register(self, error=None):
+
+        session = self.get_session()
+
+        if 'user_id' in session:
+
+            self.send_response(302)
+
+            self.send_header('Location', '/dashboard')
+
+            self.end_headers()
+
+            return
+
+       
+
+        error_html = f'<div class="alert alert-error">{error}</div>' if error else ''
+
+        content = TEMPLATES['register'].render(error=error_html)
+
+        self.serve_page('Register - P2P Trading', content, '')
+
+   
+
+    def serve_dashboard(self, message=None):
+
+        session = self.get_session()
+
+        if 'user_id' not in session:
+
+            self.send_response(302)
+
+            self.send_header('Location', '/login')
+
+            self.end_headers()
+
+            return
+
+       
+
+        user_id = int(session['user_id'])
+
+        username = session.get('username', 'Usuario')
+
+        filters = self.dashboard_filters()
+
+        try:
+
+            after = decode_cursor(self.query.get('after', [None])[0])
+
+        except ValueError:
+
+            after = None
+
+        if message is None:
+
+            etag = (f'W/"d{user_id}-{p2p_system.data_version("p2p_orders")}'
+
+                    f'-{p2p_system.data_version("wallets")}-{p2p_system.data_version("user_stats")}'
+
+                    f'-{query_digest(sorted(filters.items()), after)}"')
+
+            if self.not_modified(etag):
+
+                return
+
+       
+
+        # Obtener balance
+
+        balance = p2p_system.get_user_balance(user_id)
+
+        balance_items = []
+
+        for asset, bal in balance.items():
+
+            TEMPLATES['balance_item'].render_into(
+
+                balance_items, asset=asset, available=bal['available'], locked=bal['locked'], total=bal['total']
+
+            )
+
+       
+
+        # Obtener órdenes: una página por cursor; cada tarjeta sale de la caché de fragmentos
+
+        orders = p2p_system.get_orders(
+
+            filters['asset'], filters['fiat'], filters['order_type'] or None,
+
+            filters['payment_method'] or None, after, DASHBOARD_PAGE_SIZE + 1
+
+        )
+
+        page = orders[:DASHBOARD_PAGE_SIZE]
+
+        orders_html = [render_order_card(order, p2p_system.user_stats(order.user_id)) for order in page]
+
+        pagination = ''
+
+        if len(orders) > DASHBOARD_PAGE_SIZE:
+
+            next_query = urlencode({**filters, 'after': encode_cursor(page[-1])})
+
+            pagination = TEMPLATES['pagination'].render(href=f'/dashboard?{next_query}')
+
+       
+
+        message_html = f'<div class="alert alert-success">{message}</div>' if message else ''
+
+        content = TEMPLATES['dashboard'].render_into(
+
+            [],
+
+            balance_items=balance_items,
+
+            filters=self.render_order_filters(filters),
+
+            orders=orders_html,
+
+            pagination=pagination,
+
+            message=message_html,
+
+            orders_count=len(page)
+
+        )
+
+        nav_menu = TEMPLATES['nav_user'].render(username=username)
+
+       
+
+        self.serve_page('Dashboard - P2P Trading', content, nav_menu, ['dashboard.js'], HTML_TEMPLATES['trade_modal'])
+
+   
+
+    def dashboard_filters(self) -> Dict[str, str]:
+
+        """Filtros del dashboard tomados de la query; los valores desconocidos se ignoran"""
+
+        def pick(name: str, allowed, default: str = '') -> str:
+
+            value = self.query.get(name, [default])[0]
+
+            return value if value in allowed else default
+
+
+
+        return {
+
+            'asset': pick('asset', ASSETS, 'USDT'),
+
+            'fiat': pick('fiat', FIATS, 'USD'),
+
+            'order_type': pick('order_type', ('BUY', 'SELL')),
+
+            'payment_method': pick('payment_method', PAYMENT_METHODS)
+
+        }
+
+
+
+    @staticmethod
+
+    def render_order_filters(filters: Dict[str, str]) -> str:
+
+        def options(name: str, choices: List[Tuple[str, str]]) -> str:
+
+            return ''.join(
+
+                f'<option value="{value}"{" selected" if filters[name] == value else ""}>{label}</option>'
+
+                for value, label in choices
+
+            )
+
+
+
+        return TEMPLATES['order_filters'].render(
+
+            asset_options=options('asset', [(asset, asset) for asset in ASSETS]),
+
+            fiat_options=options('fiat', [(fiat, fiat) for fiat in FIATS]),
+
+            side_options=options('order_type', [('', 'Todas'), ('BUY', 'COMPRA'), ('SELL', 'VENTA')]),
+
+            method_options=options('payment_method', [('', 'Todos')] + [(method, method) for method in PAYMENT_METHODS])
+
+        )
+
+
+
+    def handle_login(self):
+
+        params = self.read_form()
+
+       
+
+        username = params.get('username', [''])[0]
+
+        password = params.get('password', [''])[0]
+
+       
+
+        try:
+
+            user = p2p_system.authenticate_user(username, password)
+
+        except PasswordPoolBusy:
+
+            self.send_rejection(503, OVERLOAD_RETRY_AFTER, 'kdf')
+
+            return
+
+        if user:
+
+            self.send_response(302)
+
+            self.set_session(p2p_system.create_session(user))
+
+            self.send_header('Location', '/dashboard')
+
+            self.end_headers()
+
+        else:
+
+            self.serve_login("Usuario o contraseña incorrectos")
+
+   
+
+    def handle_register(self):
+
+        params = self.read_form()
+
+       
+
+        username = params.get('username', [''])[0]
+
+        email = params.get('email', [''])[0]
+
+        password = params.get('password', [''])[0]
+
+       
+
+        try:
+
+            registered = p2p_system.register_user(username, email, password)
+
+        except PasswordPoolBusy:
+
+            self.send_rejection(503, OVERLOAD_RETRY_AFTER, 'kdf')
+
+            return
+
+        if registered:
+
+            self.send_response(302)
+
+            self.send_header('Location', '/login')
+
+            self.end_headers()
+
+        else:
+
+            self.serve_register("Usuario o email ya existen")
+
+   
+
+    def handle_create_order(self):
+
+        session = self.get_session()
+
+        if 'user_id' not in session:
+
+            self.send_response(401)
+
+            self.end_headers()
+
+            return
+
+       
+
+        params = self.read_form()
+
+       
+
+        user_id = int(session['user_id'])
+
+        order_type = params.get('order_type', [''])[0]
+
+        asset = params.get('asset', [''])[0]
+
+        fiat = params.get('fiat', ['USD'])[0]
+
+        price = float(params.get('price', ['0'])[0])
+
+        quantity = float(params.get('quantity', ['0'])[0])
+
+        min_amount = float(params.get('min_amount', ['0'])[0])
+
+        max_amount = float(params.get('max_amount', ['0'])[0])
+
+       
+
+        success = p2p_system.create_order(
+
+            user_id, order_type, asset, fiat, price, quantity,
+
+            [], min_amount, max_amount
+
+        )
+
+        self.log_fields['order_id'] = success
+
+       
+
+        if success:
+
+            self.send_response(200)
+
+            self.end_headers()
+
+        else:
+
+            self.send_response(400)
+
+            self.end_headers()
+
+   
+
+    def handle_start_trade(self):
+
+        session = self.get_session()
+
+        if 'user_id' not in session:
+
+            self.send_response(401)
+
+            self.end_headers()
+
+            return
+
+       
+
+        params = self.read_form()
+
+       
+
+        buyer_id = int(session['user_id'])
+
+        order_id = int(params.get('order_id', ['0'])[0])
+
+        quantity = float(params.get('quantity', ['0'])[0])
+
+       
+
+        trade_id = p2p_system.start_trade(buyer_id, order_id, quantity)
+
+        self.log_fields.update(order_id=order_id, trade_id=trade_id)
+
+       
+
+        if trade_id:
+
+            self.send_body(200, str(trade_id).encode('utf-8'), 'text/plain')
+
+        else:
+
+            self.send_response(400)
+
+            self.end_headers()
+
+   
+
+    def handle_confirm_payment(self):
+
+        session = self.get_session()
+
+        if 'user_id' not in session:
+
+            self.send_response(401)
+
+            self.end_headers()
+
+            return
+
+       
+
+        params = self.read_form()
+
+       
+
+        trade_id = int(params.get('trade_id', ['0'])[0])
+
+        self.log_fields['trade_id'] = trade_id
+
+       
+
+        success = p2p_system.confirm_payment(trade_id)
+
+       
+
+        if success:
+
+            self.send_response(200)
+
+            self.end_headers()
+
+        else:
+
+            self.send_response(400)
+
+            self.end_headers()
+
+   
+
+    def handle_trade_status(self, trade_id: int):
+
+        status = p2p_system.get_trade_status(trade_id)
+
+       
+
+        if status:
+
+            self.send_body(200, status.encode('utf-8'), 'text/plain')
+
+        else:
+
+            self.send_response(404)
+
+            self.end_headers()
+
+   
+
+    def stream_trade_status(self, trade_id: int):
+
+        """Stream SSE con el estado del trade; no consulta SQLite hasta que cambia.
+
+
+
+        El servidor de un solo hilo no puede dedicar la conexión: envía el estado
+
+        actual y cierra, y EventSource reconecta pasados SSE_RETRY_MS. Lo mismo
+
+        ocurre con el cupo de streams lleno, en vez de retener otro hilo del pool.
+
+        """
+
+        updates = queue.Queue()
+
+        unsubscribe = p2p_system.events.subscribe(P2PSystem.trade_topic(trade_id), updates.put)
+
+        follow = getattr(self.server, 'keep_alive', False) and admission.enter_stream('sse')
+
+        try:
+
+            status = p2p_system.get_trade_status(trade_id)
+
+            if status is None:
+
+                self.send_json(404, {'error': 'Trade no encontrado'})
+
+                return
+
+            self._streaming = True
+
+            self.send_response(200)
+
+            for key, value in SSE_HEADERS:
+
+                self.send_header(key, value)
+
+            self.end_headers()
+
+            self.wfile.write(f'retry: {SSE_RETRY_MS}\n\n'.encode('utf-8'))
+
+
+
+            while True:
+
+                self.wfile.write(sse_event('status', {'trade_id': trade_id, 'status': status}))
+
+                self.wfile.flush()
+
+                if status in TRADE_FINAL_STATUSES or not follow:
+
+                    return
+
+                status = self._next_trade_status(updates, trade_id, status)
+
+        except (BrokenPipeError, ConnectionResetError):
+
+            pass
+
+        finally:
+
+            if follow:
+
+                admission.leave_stream('sse')
+
+            unsubscribe()
+
+
+
+    def stream_market_data(self):
+
+        """Feed de profundidad por WebSocket (ver MarketDataSession).
+
+
+
+        Ocupa un hilo por conexión, así que el servidor de un solo hilo lo rechaza.
+
+        """
+
+        key = self.headers.get('Sec-WebSocket-Key')
+
+        if self.headers.get('Upgrade', '').lower() != 'websocket' or not key:
+
+            self.send_json(426, {'error': 'Se requiere una conexión WebSocket'})
+
+            return
+
+        if not getattr(self.server, 'keep_alive', False):
+
+            self.send_json(501, {'error': 'El feed de market data requiere --server threaded, asyncio o prefork'})
+
+            return
+
+        # Mismo cupo que los streams SSE: sin él, unos pocos clientes agotan el pool
+
+        if not admission.enter_stream('ws'):
+
+            # Tampoco se queda con el hilo esperando otra petición en la misma conexión
+
+            self.close_connection = True
+
+            self.send_rejection(503, SSE_RETRY_MS / 1000, 'streams')
+
+            return
+
+        try:
+
+            self._serve_market_feed(key)
+
+        finally:
+
+            admission.leave_stream('ws')
+
+
+
+    def _serve_market_feed(self, key: str):
+
+        # El handshake se escribe en bruto; el 101 queda en el registro de dispatch()
+
+        self._status = 101
+
+        self.wfile.write(ws_handshake(key))
+
+        self.close_connection = True
+
+
+
+        wake_reader, wake_writer = socket.socketpair()
+
+        wake_writer.setblocking(False)
+
+
+
+        def wake():
+
+            try:
+
+                wake_writer.send(b'\0')
+
+            except BlockingIOError:
+
+                pass  # ya hay un aviso pendiente
+
+
+
+        session = MarketDataSession(p2p_system, wake)
+
+        parser = WebSocketParser()
+
+        poll = MARKET_DATA_POLL if p2p_system.change_feed is not None else SSE_HEARTBEAT
+
+
+
+        def handle(data: bytes) -> bool:
+
+            """Responde a los frames recibidos; False si el cliente cierra"""
+
+            for opcode, payload in parser.feed(data):
+
+                if opcode == WS_CLOSE:
+
+                    self.wfile.write(ws_close_frame(1000))
+
+                    return False
+
+                if opcode == WS_PING:
+
+                    self.wfile.write(ws_frame(WS_PONG, payload))
+
+                elif opcode == WS_TEXT:
+
+                    for message in session.handle(payload.decode('utf-8', 'replace')):
+
+                        self.wfile.write(ws_frame(WS_TEXT, dump_json(message)))
+
+            return True
+
+
+
+        try:
+
+            # Lo que el cliente envió junto al handshake puede estar ya en el buffer
+
+            # de rfile, donde select() no lo ve: pasa al parser antes que el socket
+
+            if not handle(self._buffered_input()):
+
+                return
+
+            while True:
+
+                readable, _, _ = select.select([self.connection, wake_reader], [], [], poll)
+
+                if not readable:
+
+                    self.wfile.write(ws_frame(WS_PING))
+
+                    if p2p_system.change_feed is not None:
+
+                        session.poll()
+
+                if self.connection in readable:
+
+                    data = self.connection.recv(WS_MAX_MESSAGE)
+
+                    if not data or not handle(data):
+
+                        return
+
+                if wake_reader in readable:
+
+                    # Deja que la ráfaga termine y la envía como un solo diff por par
+
+                    time.sleep(MARKET_DATA_INTERVAL)
+
+                    wake_reader.recv(4096)
+
+                    for message in session.flush():
+
+                        self.wfile.write(ws_frame(WS_TEXT, dump_json(message)))
+
+        except WebSocketError as e:
+
+            self.wfile.write(ws_close_frame(e.code))
+
+        except (BrokenPipeError, ConnectionResetError):
+
+            pass
+
+        finally:
+
+            session.close()
+
+            wake_reader.close()
+
+            wake_writer.close()
+
+
+
+    def _buffered_input(self) -> bytes:
+
+        """Bytes que rfile ya leyó del socket y nadie ha consumido, sin bloquear"""
+
+        self.connection.settimeout(0)
+
+        try:
+
+            return self.rfile.read1(WS_MAX_MESSAGE) or b''
+
+        finally:
+
+            self.connection.settimeout(self.timeout)
+
+
+
+    def _next_trade_status(self, updates: queue.Queue, trade_id: int, status: str) -> str:
+
+        while True:
+
+            try:
+
+                new_status = updates.get(timeout=SSE_HEARTBEAT)
+
+            except queue.Empty:
+
+                # Heartbeat: detecta clientes desconectados
+
+                self.wfile.write(b': ping\n\n')
+
+                self.wfile.flush()
+
+                if p2p_system.change_feed is None:
+
+                    continue
+
+                # Prefork: el bus local no ve los trades de otros procesos
+
+                new_status = p2p_system.get_trade_status(trade_id)
+
+            if new_status != status:
+
+                return new_status
+
+
+
+    def serve_stats(self):
+
+        """Métricas internas (pool, colas, sesiones, cluster): solo desde localhost, como /admin/logging"""
+
+        if not self.is_local_client():
+
+            self.send_json(403, {'error': 'Solo desde localhost'})
+
+            return
+
+        server_stats = getattr(self.server, 'stats', None)
+
+        stats = {
+
+            'server': server_stats() if server_stats else {'mode': 'single'},
+
+            'db_pool': p2p_system.pool.stats(),
+
+            'engine': p2p_system.engine_stats,
+
+            'events': p2p_system.events.stats(),
+
+            'compression': response_cache.stats(),
+
+            'order_cards': order_card_cache.stats(),
+
+            'log': request_log.stats(),
+
+            'admission': admission.stats(),
+
+            'sessions': p2p_system.sessions.stats(),
+
+            'passwords': password_pool.stats()
+
+        }
+
+        if cluster_stats is not None:
+
+            stats['cluster'] = cluster_stats.snapshot()
+
+        self.send_body(200, json.dumps(stats).encode('utf-8'), 'application/json')
+
+
+
+    def api_user_id(self) -> Optional[int]:
+
+        """Usuario de la sesión o None tras responder 401 en JSON"""
+
+        session = self.get_session()
+
+        if 'user_id' not in session:
+
+            self.send_json(401, {'error': 'Sesión requerida'})
+
+            return None
+
+        return int(session['user_id'])
+
+
+
+    def api_list_orders(self):
+
+        asset = self.query.get('asset', ['USDT'])[0]
+
+        fiat = self.query.get('fiat', ['USD'])[0]
+
+        order_type = self.query.get('order_type', [None])[0]
+
+        if asset not in ASSETS or fiat not in FIATS:
+
+            self.send_json(400, {'error': 'Par no soportado'})
+
+            return
+
+        if order_type not in (None, 'BUY', 'SELL'):
+
+            self.send_json(400, {'error': 'order_type debe ser BUY o SELL'})
+
+            return
+
+        payment_method = self.query.get('payment_method', [None])[0]
+
+        try:
+
+            limit = int(self.query.get('limit', [API_ORDERS_LIMIT])[0])
+
+            after = decode_cursor(self.query.get('after', [None])[0])
+
+        except ValueError:
+
+            self.send_json(400, {'error': 'limit debe ser un entero y after un cursor precio:id'})
+
+            return
+
+        limit = max(1, min(limit, API_ORDERS_MAX_LIMIT))
+
+        etag = (f'W/"o{p2p_system.data_version("p2p_orders")}-{p2p_system.data_version("user_stats")}'
+
+                f'-{query_digest(asset, fiat, order_type, payment_method, after, limit)}"')
+
+        if self.not_modified(etag):
+
+            return
+
+
+
+        # Una orden de más para saber si hay página siguiente
+
+        orders = p2p_system.get_orders(asset, fiat, order_type, payment_method, after, limit + 1)
+
+        page = orders[:limit]
+
+        self.send_json(200, {
+
+            'asset': asset,
+
+            'fiat': fiat,
+
+            'count': len(page),
+
+            'next': encode_cursor(page[-1]) if len(orders) > limit else None,
+
+            'orders': [order_to_dict(order, p2p_system.user_stats(order.user_id)) for order in page]
+
+        })
+
+
+
+    def api_create_order(self):
+
+        user_id = self.api_user_id()
+
+        if user_id is None:
+
+            return
+
+        try:
+
+            data = self.read_json()
+
+            order_type = str(data['order_type'])
+
+            asset = str(data['asset'])
+
+            fiat = str(data.get('fiat', 'USD'))
+
+            price = float(data['price'])
+
+            quantity = float(data['quantity'])
+
+            min_amount = float(data.get('min_amount', 0))
+
+            max_amount = float(data.get('max_amount', price * quantity))
+
+            payment_methods = data.get('payment_methods') or []
+
+        except (KeyError, TypeError, ValueError):
+
+            self.send_json(400, {'error': 'Datos de la orden inválidos'})
+
+            return
+
+        if (order_type not in ('BUY', 'SELL') or asset not in ASSETS or fiat not in FIATS
+
+                or price <= 0 or quantity <= 0 or not isinstance(payment_methods, list)):
+
+            self.send_json(400, {'error': 'Datos de la orden inválidos'})
+
+            return
+
+
+
+        order_id = p2p_system.create_order(
+
+            user_id, order_type, asset, fiat, price, quantity,
+
+            [str(method) for method in payment_methods], min_amount, max_amount
+
+        )
+
+        self.log_fields['order_id'] = order_id
+
+        if order_id is None:
+
+            self.send_json(400, {'error': 'Fondos insuficientes'})
+
+            return
+
+        order = p2p_system.get_book(asset, fiat).get(order_id)
+
+        self.send_json(201, {'id': order_id, 'order': order_to_dict(order) if order else None})
+
+
+
+    def api_balance(self):
+
+        user_id = self.api_user_id()
+
+        if user_id is None:
+
+            return
+
+        if self.not_modified(f'W/"b{user_id}-{p2p_system.data_version("wallets")}"'):
+
+            return
+
+        self.send_json(200, {'user_id': user_id, 'balance': p2p_system.get_user_balance(user_id)})
+
+
+
+    def api_start_trade(self):
+
+        user_id = self.api_user_id()
+
+        if user_id is None:
+
+            return
+
+        try:
+
+            data = self.read_json()
+
+            order_id = int(data['order_id'])
+
+            quantity = float(data['quantity'])
+
+        except (KeyError, TypeError, ValueError):
+
+            self.send_json(400, {'error': 'Se requieren order_id y quantity'})
+
+            return
+
+
+
+        trade_id = p2p_system.start_trade(user_id, order_id, quantity)
+
+        self.log_fields.update(order_id=order_id, trade_id=trade_id)
+
+        if not trade_id:
+
+            self.send_json(400, {'error': 'No se pudo iniciar el trade'})
+
+            return
+
+        self.send_json(201, p2p_system.get_trade(trade_id))
+
+
+
+    def api_trade_for_user(self, trade_id: int) -> Optional[Dict[str, any]]:
+
+        """Trade visible para el usuario de la sesión; responde 401/404 si no lo es"""
+
+        user_id = self.api_user_id()
+
+        if user_id is None:
+
+            return None
+
+        trade = p2p_system.get_trade(trade_id)
+
+        if trade is None or user_id not in (trade['buyer_id'], trade['seller_id']):
+
+            self.send_json(404, {'error': 'Trade no encontrado'})
+
+            return None
+
+        return trade
+
+
+
+    def api_get_trade(self, trade_id: int):
+
+        trade = self.api_trade_for_user(trade_id)
+
+        if trade is not None:
+
+            self.send_json(200, trade)
+
+
+
+    def api_confirm_trade(self, trade_id: int):
+
+        trade = self.api_trade_for_user(trade_id)
+
+        if trade is None:
+
+            return
+
+        if not p2p_system.confirm_payment(trade_id):
+
+            self.send_json(409, {'error': f"El trade está en estado {trade['status']}"})
+
+            return
+
+        self.send_json(200, p2p_system.get_trade(trade_id))
+
+
+
+    def api_cancel_trade(self, trade_id: int):
+
+        trade = self.api_trade_for_user(trade_id)
+
+        if trade is None:
+
+            return
+
+        if trade['buyer_id'] != self.api_user_id():
+
+            self.send_json(403, {'error': 'Solo el comprador puede cancelar el trade'})
+
+            return
+
+        if not p2p_system.cancel_trade(trade_id, trade['buyer_id']):
+
+            self.send_json(409, {'error': f"El trade está en estado {trade['status']}"})
+
+            return
+
+        self.send_json(200, p2p_system.get_trade(trade_id))
+
+
+
+    def api_user_stats(self, user_id: int):
+
+        if self.not_modified(f'W/"u{user_id}-{p2p_system.data_version("user_stats")}"'):
+
+            return
+
+        self.send_json(200, dict(user_id=user_id, **p2p_system.get_user_stats(user_id)))
+
+
+
+    def is_local_client(self) -> bool:
+
+        return self.client_address[0] in ('127.0.0.1', '::1')
+
+
+
+    def serve_logging_config(self):
+
+        if not self.is_local_client():
+
+            self.send_json(403, {'error': 'Solo desde localhost'})
+
+            return
+
+        self.send_json(200, request_log.stats())
+
+
+
+    def handle_logging_config(self):
+
+        """Cambia nivel y muestreo en caliente (en pre-fork, solo del worker que atiende)"""
+
+        if not self.is_local_client():
+
+            self.send_json(403, {'error': 'Solo desde localhost'})
+
+            return
+
+        try:
+
+            data = self.read_json()
+
+            sample_rate = data.get('sample_rate')
+
+            request_log.configure(data.get('level'), float(sample_rate) if sample_rate is not None else None)
+
+        except (KeyError, TypeError, ValueError, AttributeError):
+
+            self.send_json(400, {'error': f"level debe ser uno de {', '.join(RequestLog.LEVELS)} y sample_rate un número"})
+
+            return
+
+        self.send_json(200, request_log.stats())
+
+
+
+    def serve_static(self, filename: str):
+
+        asset = static_assets.get(filename)
+
+        if asset is None:
+
+            self.send_error(404)
+
+            return
+
+        body, content_type = asset
+
+        self.send_body(200, body, content_type, STATIC_CACHE_CONTROL)
+
+
+
+    def do_logout(self):
+
+        token = self.get_cookies().get(SESSION_COOKIE)
+
+        if token:
+
+            # Revocada: aunque alguien conserve la cookie, el token ya no vale
+
+            p2p_system.revoke_session(token)
+
+        self.send_response(302)
+
+        self.send_header('Set-Cookie', f'{SESSION_COOKIE}=; expires=Thu, 01 Jan 1970 00:00:00 GMT; Path=/')
+
+        self.send_header('Location', '/login')
+
+        self.end_headers()
+
+   
+
+    def serve_page(self, title, content, nav_menu, scripts=(), modal=''):
+
+        full_html = TEMPLATES['base'].render(
+
+            title=title,
+
+            stylesheet=static_assets.url('app.css'),
+
+            content=content,
+
+            nav_menu=nav_menu,
+
+            scripts=''.join(f'<script src="{static_assets.url(name)}"></script>' for name in scripts),
+
+            modal=modal
+
+        )
+
+       
+
+        self.send_body(200, full_html.encode('utf-8'), 'text/html; charset=utf-8')
+
+
+
+class WorkerPoolHTTPServer(socketserver.TCPServer):
+
+    """TCPServer que reparte las conexiones aceptadas entre un pool acotado de hilos.
+
+
+
+    El hilo de serve_forever solo acepta y encola; si la cola se llena deja de
+
+    aceptar y las conexiones nuevas esperan en el backlog del kernel.
+
+    """
+
+    allow_reuse_address = True
+
+    keep_alive = True
+
+
+
+    def __init__(self, server_address, handler_class, workers: int = SERVER_WORKERS,
+
+                 backlog: int = SERVER_BACKLOG):
+
+        self.request_queue_size = backlog
+
+        self.workers = workers
+
+        self._queue = queue.Queue(maxsize=backlog)
+
+        self._lock = threading.Lock()
+
+        self._busy = 0
+
+        self._handled = 0
+
+        self._started = time.time()
+
+        super().__init__(server_address, handler_class)
+
+        self._threads = [
+
+            threading.Thread(target=self._work, name=f"p2p-worker-{i}", daemon=True)
+
+            for i in range(workers)
+
+        ]
+
+        for thread in self._threads:
+
+            thread.start()
+
+
+
+    def process_request(self, request, client_address):
+
+        self._queue.put((request, client_address))
+
+
+
+    def queued(self) -> int:
+
+        return self._queue.qsize()
+
+
+
+    def _work(self):
+
+        while True:
+
+            item = self._queue.get()
+
+            if item is None:
+
+                return
+
+            request, client_address = item
+
+            with self._lock:
+
+                self._busy += 1
+
+            try:
+
+                self.finish_request(request, client_address)
+
+            except Exception:
+
+                self.handle_error(request, client_address)
+
+            finally:
+
+                self.shutdown_request(request)
+
+                with self._lock:
+
+                    self._busy -= 1
+
+                    self._handled += 1
+
+
+
+    def server_close(self):
+
+        super().server_close()
+
+        for _ in self._threads:
+
+            self._queue.put(None)
+
+
+
+    def stats(self) -> Dict[str, any]:
+
+        with self._lock:
+
+            busy = self._busy
+
+            handled = self._handled
+
+        return {
+
+            'mode': 'threaded',
+
+            'workers': self.workers,
+
+            'busy_workers': busy,
+
+            'utilisation': round(busy / self.workers, 3),
+
+            'queue_depth': self._queue.qsize(),
+
+            'backlog': self.request_queue_size,
+
+            'handled': handled,
+
+            'uptime_s': round(time.time() - self._started, 1)
+
+        }
+
+
+
+class BufferedRequestHandler(P2PRequestHandler):
+
+    """Ejecuta P2PRequestHandler sobre una petición ya leída en memoria.
+
+
+
+    Lo usa el front end asyncio: la lectura del socket ocurre en el bucle de
+
+    eventos y aquí solo se despachan las rutas existentes dentro del executor.
+
+    """
+
+    def __init__(self, raw_request: bytes, client_address, server):
+
+        self.request = None
+
+        self.requests_served = 0
+
+        self.client_address = client_address
+
+        self.server = server
+
+        self.rfile = io.BytesIO(raw_request)
+
+        self.wfile = io.BytesIO()
+
+        self.close_connection = True
+
+        self.handle_one_request()
+
+
+
+class AsyncHTTPFrontend:
+
+    """Front end HTTP/1.1 sobre asyncio que reutiliza las rutas de P2PRequestHandler.
+
+
+
+    Las conexiones inactivas (keep-alive o sondeo de /trade_status) solo cuestan
+
+    una corrutina; cada petición completa se despacha a un executor dedicado,
+
+    que es quien llama a P2PSystem.
+
+    """
+
+    keep_alive = True
+
+
+
+    def __init__(self, port: int = PORT, workers: int = SERVER_WORKERS, backlog: int = SERVER_BACKLOG,
+
+                 keepalive_timeout: float = KEEPALIVE_TIMEOUT):
+
+        self.port = port
+
+        self.workers = workers
+
+        self.backlog = backlog
+
+        self.keepalive_timeout = keepalive_timeout
+
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='p2p-db')
+
+        self._open_connections = 0
+
+        self._open_streams = 0
+
+        self._in_flight = 0
+
+        self._queued = 0
+
+        self._queue_lock = threading.Lock()
+
+        self._handled = 0
+
+        self._started = time.time()
+
+
+
+    async def serve(self):
+
+        server = await asyncio.start_server(
+
+            self._handle_connection, '', self.port, backlog=self.backlog, limit=MAX_REQUEST_HEAD
+
+        )
+
+        async with server:
+
+            await server.serve_forever()
+
+
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+
+        self._open_connections += 1
+
+        client_address = writer.get_extra_info('peername')
+
+        served = 0
+
+        try:
+
+            while True:
+
+                try:
+
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.keepalive_timeout)
+
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+
+                        ConnectionError):
+
+                    return
+
+                request_line, headers = self._parse_head(head)
+
+                # Sin un tamaño fiable no se sabe dónde empieza la siguiente petición:
+
+                # se responde 400/413 y se cierra la conexión
+
+                try:
+
+                    length = parse_content_length(headers.get('content-length'))
+
+                except RequestBodyError as e:
+
+                    request_log.record('WARNING', 'bad_request', client=client_address[0] if client_address else None,
+
+                                       status=e.status, error=str(e))
+
+                    writer.write(self._frame_response(self._body_error_response(e), False))
+
+                    await writer.drain()
+
+                    return
+
+                body = await reader.readexactly(length) if length else b''
+
+                served += 1
+
+                keep_alive = self._wants_keep_alive(request_line, headers) and served < MAX_KEEPALIVE_REQUESTS
+
+
+
+                # Los streams se sirven en el bucle: una conexión abierta no ocupa un hilo del executor
+
+                stream = self._match_stream(request_line)
+
+                if stream is not None:
+
+                    handler, params = stream
+
+                    if await handler(reader, writer, headers, keep_alive, **params):
+
+                        continue
+
+                    return
+
+
+
+                # Lo que espera en la cola del executor también está "en curso": se
+
+                # rechaza aquí, antes de encolar, para no acumular trabajo sin límite
+
+                if self._in_flight >= admission.max_in_flight:
+
+                    admission.shed()
+
+                    writer.write(self._frame_response(self._overload_response(), keep_alive))
+
+                    await writer.drain()
+
+                    if not keep_alive:
+
+                        return
+
+                    continue
+
+
+
+                self._in_flight += 1
+
+                try:
+
+                    response = await self._in_executor(self._dispatch, head + body, client_address)
+
+                finally:
+
+                    self._in_flight -= 1
+
+                    self._handled += 1
+
+
+
+                writer.write(self._frame_response(response, keep_alive))
+
+                await writer.drain()
+
+                if not keep_alive:
+
+                    return
+
+        except (ConnectionError, asyncio.IncompleteReadError):
+
+            pass
+
+        finally:
+
+            self._open_connections -= 1
+
+            writer.close()
+
+
+
+    def _match_stream(self, request_line: str):
+
+        parts = request_line.split(' ')
+
+        if len(parts) != 3:
+
+            return None
+
+        match = ROUTES.match(parts[0], urlparse(parts[1]).path)
+
+        if match is None or not match[0].startswith('stream_'):
+
+            return None
+
+        return getattr(self, match[0]), match[1]
+
+
+
+    async def stream_trade_status(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+
+                                  headers: Dict[str, str], keep_alive: bool, trade_id: int) -> bool:
+
+        """Versión asyncio del stream SSE de P2PRequestHandler.
+
+
+
+        Devuelve True si la conexión puede seguir atendiendo peticiones (404).
+
+        """
+
+        loop = asyncio.get_running_loop()
+
+        updates = asyncio.Queue()
+
+        unsubscribe = p2p_system.events.subscribe(
+
+            P2PSystem.trade_topic(trade_id),
+
+            lambda value: loop.call_soon_threadsafe(updates.put_nowait, value)
+
+        )
+
+        self._open_streams += 1
+
+        try:
+
+            status = p2p_system.cached_trade_status(trade_id)
+
+            if status is None:
+
+                status = await self._in_executor(p2p_system.get_trade_status, trade_id)
+
+            if status is None:
+
+                await self.send_json(writer, 404, {'error': 'Trade no encontrado'}, keep_alive)
+
+                return keep_alive
+
+
+
+            head = [b'HTTP/1.1 200 OK'] + [f'{key}: {value}'.encode('utf-8') for key, value in SSE_HEADERS]
+
+            head.append(b'Connection: close')
+
+            writer.write(b'\r\n'.join(head) + f'\r\n\r\nretry: {SSE_RETRY_MS}\n\n'.encode('utf-8'))
+
+            while True:
+
+                writer.write(sse_event('status', {'trade_id': trade_id, 'status': status}))
+
+                await writer.drain()
+
+                if status in TRADE_FINAL_STATUSES:
+
+                    return False
+
+                new_status = status
+
+                while new_status == status:
+
+                    try:
+
+                        new_status = await asyncio.wait_for(updates.get(), SSE_HEARTBEAT)
+
+                    except asyncio.TimeoutError:
+
+                        writer.write(b': ping\n\n')
+
+                        await writer.drain()
+
+                        if p2p_system.change_feed is not None:
+
+                            new_status = await self._in_executor(p2p_system.get_trade_status, trade_id)
+
+                status = new_status
+
+        finally:
+
+            self._open_streams -= 1
+
+            unsubscribe()
+
+
+
+    async def stream_market_data(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+
+                                 headers: Dict[str, str], keep_alive: bool) -> bool:
+
+        """Versión asyncio del feed de market data de P2PRequestHandler"""
+
+        key = headers.get('sec-websocket-key')
+
+        if headers.get('upgrade', '').lower() != 'websocket' or not key:
+
+            await self.send_json(writer, 426, {'error': 'Se requiere una conexión WebSocket'}, keep_alive)
+
+            return keep_alive
+
+        writer.write(ws_handshake(key))
+
+
+
+        loop = asyncio.get_running_loop()
+
+        pending = asyncio.Event()
+
+        session = MarketDataSession(p2p_system, lambda: loop.call_soon_threadsafe(pending.set))
+
+        parser = WebSocketParser()
+
+        poll = MARKET_DATA_POLL if p2p_system.change_feed is not None else SSE_HEARTBEAT
+
+        read_task = None
+
+        self._open_streams += 1
+
+        try:
+
+            while True:
+
+                if read_task is None:
+
+                    read_task = asyncio.ensure_future(reader.read(WS_MAX_MESSAGE))
+
+                wake_task = asyncio.ensure_future(pending.wait())
+
+                done, _ = await asyncio.wait({read_task, wake_task}, timeout=poll,
+
+                                             return_when=asyncio.FIRST_COMPLETED)
+
+                wake_task.cancel()
+
+                if not done:
+
+                    writer.write(ws_frame(WS_PING))
+
+                    if p2p_system.change_feed is not None:
+
+                        await self._in_executor(session.poll)
+
+                if read_task in done:
+
+                    data = read_task.result()
+
+                    read_task = None
+
+                    if not data:
+
+                        return False
+
+                    for opcode, payload in parser.feed(data):
+
+                        if opcode == WS_CLOSE:
+
+                            writer.write(ws_close_frame(1000))
+
+                            await writer.drain()
+
+                            return False
+
+                        if opcode == WS_PING:
+
+                            writer.write(ws_frame(WS_PONG, payload))
+
+                        elif opcode == WS_TEXT:
+
+                            for message in session.handle(payload.decode('utf-8', 'replace')):
+
+                                writer.write(ws_frame(WS_TEXT, dump_json(message)))
+
+                if pending.is_set():
+
+                    # Deja que la ráfaga termine y la envía como un solo diff por par
+
+                    await asyncio.sleep(MARKET_DATA_INTERVAL)
+
+                    pending.clear()
+
+                    for message in session.flush():
+
+                        writer.write(ws_frame(WS_TEXT, dump_json(message)))
+
+                # Un cliente lento frena solo su bucle; mientras, los cambios se agrupan en flush()
+
+                await writer.drain()
+
+        except WebSocketError as e:
+
+            writer.write(ws_close_frame(e.code))
+
+            return False
+
+        finally:
+
+            self._open_streams -= 1
+
+            session.close()
+
+            if read_task is not None:
+
+                read_task.cancel()
+
+
+
+    @staticmethod
+
+    def _parse_head(head: bytes):
+
+        lines = head.decode('iso-8859-1').split('\r\n')
+
+        headers = {}
+
+        for line in lines[1:]:
+
+            if ':' in line:
+
+                key, value = line.split(':', 1)
+
+                headers[key.strip().lower()] = value.strip()
+
+        return lines[0], headers
+
+
+
+    @staticmethod
+
+    def _wants_keep_alive(request_line: str, headers: Dict[str, str]) -> bool:
+
+        connection = headers.get('connection', '').lower()
+
+        if request_line.endswith('HTTP/1.0'):
+
+            return connection == 'keep-alive'
+
+        return connection != 'close'
+
+
+
+    def _dispatch(self, raw_request: bytes, client_address) -> bytes:
+
+        handler = BufferedRequestHandler(raw_request, client_address, self)
+
+        return handler.wfile.getvalue()
+
+
+
+    async def _in_executor(self, fn, *args):
+
+        """run_in_executor contando lo que espera un hilo libre (executor_queue en /stats)"""
+
+        waiting = True
+
+
+
+        def dequeue():
+
+            nonlocal waiting
+
+            with self._queue_lock:
+
+                if waiting:
+
+                    waiting = False
+
+                    self._queued -= 1
+
+
+
+        def run():
+
+            dequeue()
+
+            return fn(*args)
+
+
+
+        with self._queue_lock:
+
+            self._queued += 1
+
+        try:
+
+            return await asyncio.get_running_loop().run_in_executor(self.executor, run)
+
+        finally:
+
+            # Si se canceló antes de llegar a un hilo, run() no llegará a ejecutarse
+
+            dequeue()
+
+
+
+    async def send_json(self, writer: asyncio.StreamWriter, status: int, data, keep_alive: bool):
+
+        """Como P2PRequestHandler.send_json, para las respuestas que se generan en el bucle"""
+
+        writer.write(self._frame_response(self._response(status, dump_json(data), 'application/json'),
+
+                                          keep_alive))
+
+        await writer.drain()
+
+
+
+    @staticmethod
+
+    def _response(status: int, body: bytes, content_type: str, headers: Tuple[str, ...] = ()) -> bytes:
+
+        """Respuesta completa salvo Content-Length y Connection, que añade _frame_response"""
+
+        head = [f'HTTP/1.1 {status} {http.HTTPStatus(status).phrase}', f'Content-Type: {content_type}']
+
+        head.extend(headers)
+
+        return '\r\n'.join(head).encode('utf-8') + b'\r\n\r\n' + body
+
+
+
+    @classmethod
+
+    def _overload_response(cls) -> bytes:
+
+        return cls._response(503, 'Servidor ocupado, inténtalo más tarde'.encode('utf-8'),
+
+                             'text/plain; charset=utf-8', (f'Retry-After: {OVERLOAD_RETRY_AFTER}',))
+
+
+
+    @classmethod
+
+    def _body_error_response(cls, error: RequestBodyError) -> bytes:
+
+        return cls._response(error.status, str(error).encode('utf-8'), 'text/plain; charset=utf-8')
+
+
+
+    @staticmethod
+
+    def _frame_response(response: bytes, keep_alive: bool) -> bytes:
+
+        """Reescribe la cabecera para poder reutilizar la conexión (Content-Length + Connection)"""
+
+        head, _, body = response.partition(b'\r\n\r\n')
+
+        lines = head.split(b'\r\n')
+
+        status = lines[0].split(b' ', 1)
+
+        headers = [
+
+            line for line in lines[1:]
+
+            if not line.lower().startswith((b'connection:', b'content-length:', b'keep-alive:'))
+
+        ]
+
+        if not status[1].startswith(b'304'):
+
+            headers.append(b'Content-Length: ' + str(len(body)).encode())
+
+        headers.append(b'Connection: ' + (b'keep-alive' if keep_alive else b'close'))
+
+        return b'\r\n'.join([b'HTTP/1.1 ' + status[1]] + headers) + b'\r\n\r\n' + body
+
+
+
+    def stats(self) -> Dict[str, any]:
+
+        return {
+
+            'mode': 'asyncio',
+
+            'executor_workers': self.workers,
+
+            'open_connections': self._open_connections,
+
+            'open_streams': self._open_streams,
+
+            'in_flight': self._in_flight,
+
+            'executor_queue': self._queued,
+
+            'handled': self._handled,
+
+            'uptime_s': round(time.time() - self._started, 1)
+
+        }
+
+
+
+class ReusePortHTTPServer(WorkerPoolHTTPServer):
+
+    """WorkerPoolHTTPServer con SO_REUSEPORT: varios procesos escuchan el mismo puerto"""
+
+    def server_bind(self):
+
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        super().server_bind()
+
+
+
+# Estadísticas compartidas del clúster pre-fork (None fuera de ese modo)
+
+cluster_stats: Optional[ClusterStats] = None
+
+
+
+class PreforkSupervisor:
+
+    """Arranca N procesos worker sobre el mismo puerto y reinicia los que mueran.
+
+
+
+    Cada worker abre su propio P2PSystem sobre el mismo fichero SQLite en WAL
+
+    (las conexiones no sobreviven a un fork) y publica sus contadores en el
+
+    ClusterStats compartido, que el supervisor agrega.
+
+    """
+
+    def __init__(self, args, processes: int = PREFORK_PROCESSES):
+
+        self.args = args
+
+        self.processes = processes
+
+        self.cluster = ClusterStats(processes)
+
+        self.children: Dict[int, int] = {}
+
+        self.stopping = False
+
+
+
+    def run(self, on_started=None):
+
+        """Arranca los workers y los vigila; on_started se llama en el padre tras el primer fork"""
+
+        global cluster_stats
+
+        cluster_stats = self.cluster
+
+        for slot in range(self.processes):
+
+            self._spawn(slot)
+
+        if on_started is not None:
+
+            on_started()
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+
+
+
+        last_report = time.time()
+
+        try:
+
+            while not self.stopping:
+
+                pid, status = os.waitpid(-1, os.WNOHANG)
+
+                if pid == 0:
+
+                    time.sleep(0.5)
+
+                    if time.time() - last_report >= PREFORK_STATS_INTERVAL:
+
+                        self.report()
+
+                        last_report = time.time()
+
+                    continue
+
+                slot = self.children.pop(pid, None)
+
+                if slot is not None and not self.stopping:
+
+                    print(f"💀 Worker {pid} (slot {slot}) terminó con estado {status}; reiniciando")
+
+                    self.cluster.add_restart()
+
+                    self._spawn(slot)
+
+        except KeyboardInterrupt:
+
+            pass
+
+        finally:
+
+            self.stop()
+
+            self.report()
+
+
+
+    def _spawn(self, slot: int):
+
+        # Lo que siga en el buffer de stdout se heredaría y cada worker lo volvería a escribir
+
+        sys.stdout.flush()
+
+        pid = os.fork()
+
+        if pid == 0:
+
+            code = 0
+
+            try:
+
+                self._worker(slot)
+
+            except KeyboardInterrupt:
+
+                pass
+
+            except Exception as e:
+
+                print(f"❌ Worker {os.getpid()} caído: {e}")
+
+                code = 1
+
+            finally:
+
+                os._exit(code)
+
+        self.children[pid] = slot
+
+
+
+    def _worker(self, slot: int):
+
+        global p2p_system
+
+        # Al parar, vuelca lo que quede en el anillo del registro antes de salir
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: (request_log.close(), password_pool.shutdown(),
+
+                                                             os._exit(0)))
+
+        # Un fichero por slot: varios procesos rotando el mismo fichero se pisarían
+
+        base, ext = os.path.splitext(self.args.log_file)
+
+        request_log.start(f'{base}.{slot}{ext}')
+
+        # El padre ya mostró el arranque: N copias de los mismos mensajes no aportan nada
+
+        with redirect_stdout(io.StringIO()):
+
+            p2p_system = P2PSystem(self.args.db, storage_profile=self.args.storage_profile,
+
+                                   matching=self.args.matching)
+
+        p2p_system.enable_change_feed(self.cluster)
+
+        with ReusePortHTTPServer(("", self.args.port), P2PRequestHandler,
+
+                                 self.args.workers, self.args.backlog) as httpd:
+
+            def publish():
+
+                while True:
+
+                    stats = httpd.stats()
+
+                    self.cluster.update_slot(slot, os.getpid(), stats['handled'],
+
+                                             stats['busy_workers'], stats['queue_depth'])
+
+                    time.sleep(1.0)
+
+
+
+            threading.Thread(target=publish, name="p2p-stats", daemon=True).start()
+
+            httpd.serve_forever()
+
+
+
+    def stop(self):
+
+        if self.stopping:
 
             return
 
-       
+        self.stopping = True
+
+        for pid in list(self.children):
+
+            try:
+
+                os.kill(pid, signal.SIGTERM)
+
+            except ProcessLookupError:
+
+                pass
+
+        for pid in list(self.children):
+
+            try:
+
+                os.waitpid(pid, 0)
+
+            except ChildProcessError:
+
+                pass
+
+        self.children.clear()
+
+
+
+    def report(self):
+
+        snapshot = self.cluster.snapshot()
+
+        print(f"📊 Clúster: {snapshot['processes']} procesos, {snapshot['handled']} peticiones, "
+
+              f"{snapshot['busy_workers']} hilos ocupados, cola {snapshot['queue_depth']}, "
+
+              f"{snapshot['restarts']} reinicios")
+
+
+
+def make_server(mode: str = SERVER_MODE, port: int = PORT, workers: int = SERVER_WORKERS,
+
+                backlog: int = SERVER_BACKLOG) -> socketserver.TCPServer:
+
+    if mode == 'threaded':
+
+        return WorkerPoolHTTPServer(("", port), P2PRequestHandler, workers, backlog)
+
+    return socketserver.TCPServer(("", port), P2PRequestHandler)
+
+
+
+def benchmark_matching(resting_sizes=(10_000, 100_000), incoming: int = 2_000):
+
+    """Mide cruces por segundo del motor con N órdenes en reposo (BD temporal)"""
+
+    import tempfile
+
+
+
+    results = []
+
+    for resting in resting_sizes:
+
+        with tempfile.TemporaryDirectory() as tmp:
+
+            system = P2PSystem(os.path.join(tmp, 'bench.db'), matching=True)
+
+            with system.pool.connection() as conn:
+
+                now = datetime.datetime.now().isoformat()
+
+                user_ids = []
+
+                for i in range(101):
+
+                    cursor = conn.execute(
+
+                        'INSERT INTO users (username, email, password_hash, created_at) VALUES (?, ?, ?, ?)',
+
+                        (f'bench{i}', f'bench{i}@example.com', '', now)
+
+                    )
+
+                    user_ids.append(cursor.lastrowid)
+
+                conn.executemany(
+
+                    'INSERT INTO wallets (user_id, asset, balance, locked_balance) VALUES (?, ?, ?, ?)',
+
+                    [(uid, asset, 1e12, 1e12) for uid in user_ids for asset in ('USDT', 'USD')]
+
+                )
+
+                # El último usuario solo compra: sin órdenes propias en el libro
+
+                sellers = user_ids[:-1]
+
+                conn.executemany('''
+
+                    INSERT INTO p2p_orders
+
+                    (user_id, order_type, asset, fiat, price, quantity, available_quantity,
+
+                     payment_methods, status, min_amount, max_amount, created_at)
+
+                    VALUES (?, 'SELL', 'USDT', 'USD', ?, ?, ?, '[]', 'PENDING', 0, 1e12, ?)
+
+                ''', [
+
+                    (random.choice(sellers), round(1.0 + random.randint(0, 500) / 10000, 4), qty, qty, now)
+
+                    for qty in (round(random.uniform(10, 100), 2) for _ in range(resting))
+
+                ])
+
+                conn.commit()
+
+            system.load_order_books()
+
+
+
+            buyer = user_ids.pop()
+
+            started = time.perf_counter()
+
+            for _ in range(incoming):
+
+                best = system.get_book('USDT', 'USD').depth(OrderType.SELL, 1)
+
+                system.create_order(buyer, 'BUY', 'USDT', 'USD', round(best[0][0] + 0.001, 4),
+
+                                    round(random.uniform(50, 250), 2), [], 0, 1e12)
+
+            elapsed = time.perf_counter() - started
+
+            system.pool.close_all()
+
+
+
+        matches = system.engine_stats['matches']
+
+        results.append({
+
+            'resting_orders': resting,
+
+            'incoming_orders': incoming,
+
+            'matches': matches,
+
+            'seconds': round(elapsed, 3),
+
+            'matches_per_sec': round(matches / elapsed, 1),
+
+            'orders_per_sec': round(incoming / elapsed, 1)
+
+        })
+
+        print(f"⚡ {resting:>7} en reposo: {matches} cruces en {elapsed:.2f}s "
+
+              f"→ {matches / elapsed:,.0f} cruces/s ({incoming / elapsed:,.0f} órdenes/s)")
+
+    return results
+
+
+
+def latency_summary(samples_ns: List[int]) -> Dict[str, float]:
+
+    """ops/s y percentiles (µs) de una lista de latencias en nanosegundos"""
+
+    ordered = sorted(samples_ns)
+
+    def percentile(fraction: float) -> float:
+
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] / 1000, 1)
+
+    return {
+
+        'samples': len(ordered),
+
+        'ops_per_sec': round(len(ordered) / (sum(ordered) / 1e9), 1),
+
+        'p50_us': percentile(0.50),
+
+        'p99_us': percentile(0.99)
+
+    }
+
+
+
+def seed_benchmark_data(system: P2PSystem, orders: int, rng: random.Random) -> List[int]:
+
+    """Usuarios con saldo de sobra y `orders` órdenes abiertas según random_order_params"""
+
+    users = max(100, orders // 100)
+
+    now = datetime.datetime.now().isoformat()
+
+    with system.pool.connection() as conn:
+
+        first_user = conn.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM users').fetchone()[0]
+
+        user_ids = list(range(first_user, first_user + users))
+
+        conn.executemany(
+
+            'INSERT INTO users (id, username, email, password_hash, created_at) VALUES (?, ?, ?, ?, ?)',
+
+            [(uid, f'bench{uid}', f'bench{uid}@example.com', '', now) for uid in user_ids]
+
+        )
+
+        conn.executemany(
+
+            'INSERT INTO wallets (user_id, asset, balance, locked_balance) VALUES (?, ?, ?, ?)',
+
+            [(uid, asset, 1e12, 1e12) for uid in user_ids for asset in ASSETS + FIATS]
+
+        )
+
+        # Por lotes: no materializar 1M de tuplas de golpe
+
+        for offset in range(0, orders, 50_000):
 
-        content_length = int(self.headers['Content-Length'])
+            rows = []
 
-        post_data = self.rfile.read(content_length).decode('utf-8')
+            for _ in range(min(50_000, orders - offset)):
 
-        params = parse_qs(post_data)
+                order_type, asset, fiat, price, quantity, methods, min_amount, max_amount = random_order_params(rng)
 
-       
+                rows.append((rng.choice(user_ids), order_type, asset, fiat, price, quantity, quantity,
 
-        user_id = int(session['user_id'])
+                             json.dumps(methods), min_amount, max_amount, now))
 
-        order_type = params.get('order_type', [''])[0]
+            conn.executemany('''
 
-        asset = params.get('asset', [''])[0]
+                INSERT INTO p2p_orders
 
-        fiat = params.get('fiat', ['USD'])[0]
+                (user_id, order_type, asset, fiat, price, quantity, available_quantity,
 
-        price = float(params.get('price', ['0'])[0])
+                 payment_methods, status, min_amount, max_amount, created_at)
 
-        quantity = float(params.get('quantity', ['0'])[0])
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'PENDING', ?, ?, ?)
 
-        min_amount = float(params.get('min_amount', ['0'])[0])
+            ''', rows)
 
-        max_amount = float(params.get('max_amount', ['0'])[0])
+        conn.commit()
 
-       
+    system.load_order_books()
 
-        success = p2p_system.create_order(
+    return user_ids
 
-            user_id, order_type, asset, fiat, price, quantity,
 
-            [], min_amount, max_amount
 
-        )
+def benchmark_operations(scales=('1k', '100k'), samples: int = BENCH_SAMPLES, seed: int = 42) -> Dict[str, any]:
 
-       
+    """Latencia de create_order, get_orders, start_trade, confirm_payment y get_user_balance.
 
-        if success:
 
-            self.send_response(200)
 
-            self.end_headers()
+    Para cada escala crea una BD temporal con N órdenes abiertas y mide
 
-        else:
+    `samples` llamadas a cada operación. Sin motor de cruce: se mide el camino
 
-            self.send_response(400)
+    de cada operación, no los cruces (para eso está benchmark_matching).
 
-            self.end_headers()
+    """
 
-   
+    import tempfile
 
-    def handle_start_trade(self):
 
-        session = self.get_session()
 
-        if 'user_id' not in session:
+    results = {
 
-            self.send_response(401)
+        'generated_at': datetime.datetime.now().isoformat(),
 
-            self.end_headers()
+        'python': platform.python_version(),
 
-            return
+        'sqlite': sqlite3.sqlite_version,
 
-       
+        'samples': samples,
 
-        content_length = int(self.headers['Content-Length'])
+        'scales': {}
 
-        post_data = self.rfile.read(content_length).decode('utf-8')
+    }
 
-        params = parse_qs(post_data)
+    for scale in scales:
 
-       
+        rng = random.Random(seed)
 
-        buyer_id = int(session['user_id'])
+        with tempfile.TemporaryDirectory() as tmp:
 
-        order_id = int(params.get('order_id', ['0'])[0])
+            system = P2PSystem(os.path.join(tmp, 'bench.db'), matching=False)
 
-        quantity = float(params.get('quantity', ['0'])[0])
+            started = time.perf_counter()
 
-       
+            user_ids = seed_benchmark_data(system, BENCH_SCALES[scale], rng)
 
-        trade_id = p2p_system.start_trade(buyer_id, order_id, quantity)
+            seed_seconds = time.perf_counter() - started
 
-       
 
-        if trade_id:
 
-            self.send_response(200)
+            timings = {name: [] for name in ('create_order', 'get_orders', 'start_trade',
 
-            self.send_header('Content-type', 'text/plain')
+                                             'confirm_payment', 'get_user_balance')}
 
-            self.end_headers()
 
-            self.wfile.write(str(trade_id).encode('utf-8'))
 
-        else:
+            def timed(name, fn, *args):
 
-            self.send_response(400)
+                began = time.perf_counter_ns()
 
-            self.end_headers()
+                result = fn(*args)
 
-   
+                timings[name].append(time.perf_counter_ns() - began)
 
-    def handle_confirm_payment(self):
+                return result
 
-        session = self.get_session()
 
-        if 'user_id' not in session:
 
-            self.send_response(401)
+            for _ in range(samples):
 
-            self.end_headers()
+                order_type, asset, fiat, price, quantity, methods, min_amount, max_amount = random_order_params(rng)
 
-            return
+                timed('create_order', system.create_order, rng.choice(user_ids), order_type, asset, fiat,
 
-       
+                      price, quantity, methods, min_amount, max_amount)
 
-        content_length = int(self.headers['Content-Length'])
+                timed('get_orders', system.get_orders, rng.choice(ASSETS), rng.choice(FIATS),
 
-        post_data = self.rfile.read(content_length).decode('utf-8')
+                      rng.choice(['BUY', 'SELL']), None, None, DASHBOARD_PAGE_SIZE)
 
-        params = parse_qs(post_data)
+                timed('get_user_balance', system.get_user_balance, rng.choice(user_ids))
 
-       
 
-        trade_id = int(params.get('trade_id', ['0'])[0])
 
-       
+            # Trades sobre órdenes abiertas al azar, por el importe mínimo que admiten
 
-        success = p2p_system.confirm_payment(trade_id)
+            with system.pool.connection() as conn:
 
-       
+                max_order = conn.execute('SELECT MAX(id) FROM p2p_orders').fetchone()[0]
 
-        if success:
+            trade_ids = []
 
-            self.send_response(200)
+            attempts = 0
 
-            self.end_headers()
+            while len(trade_ids) < samples and attempts < samples * 20:
 
-        else:
+                attempts += 1
 
-            self.send_response(400)
+                order = None
 
-            self.end_headers()
+                for book in system.books.values():
 
-   
+                    order = book.get(rng.randint(1, max_order))
 
-    def handle_trade_status(self):
+                    if order is not None:
 
-        trade_id = int(self.path.split('/')[-1])
+                        break
 
-        status = p2p_system.get_trade_status(trade_id)
+                if order is None:
 
-       
+                    continue
 
-        if status:
+                quantity = round(order.min_amount / order.price * 1.001, 8)
 
-            self.send_response(200)
+                if quantity > order.available_quantity or quantity * order.price > order.max_amount:
 
-            self.send_header('Content-type', 'text/plain')
+                    continue
 
-            self.end_headers()
+                buyer = rng.choice(user_ids)
 
-            self.wfile.write(status.encode('utf-8'))
+                if buyer == order.user_id:
 
-        else:
+                    continue
 
-            self.send_response(404)
+                trade_id = timed('start_trade', system.start_trade, buyer, order.id, quantity)
 
-            self.end_headers()
+                if trade_id:
 
-   
+                    trade_ids.append(trade_id)
 
-    def do_logout(self):
+            for trade_id in trade_ids:
 
-        self.send_response(302)
+                timed('confirm_payment', system.confirm_payment, trade_id)
 
-        self.send_header('Set-Cookie', 'user_id=; expires=Thu, 01 Jan 1970 00:00:00 GMT; Path=/')
+            system.pool.close_all()
 
-        self.send_header('Set-Cookie', 'username=; expires=Thu, 01 Jan 1970 00:00:00 GMT; Path=/')
 
-        self.send_header('Location', '/login')
 
-        self.end_headers()
+        operations = {name: latency_summary(values) for name, values in timings.items() if values}
 
-   
+        results['scales'][scale] = {
 
-    def serve_page(self, title, content, nav_menu, script='', modal=''):
+            'orders': BENCH_SCALES[scale],
 
-        full_html = HTML_TEMPLATES['base'].format(
+            'users': len(user_ids),
 
-            title=title,
+            'seed_seconds': round(seed_seconds, 2),
 
-            content=content,
+            'operations': operations
 
-            nav_menu=nav_menu,
+        }
 
-            script=script,
+        print(f"\n📏 Escala {scale}: {BENCH_SCALES[scale]:,} órdenes, {len(user_ids):,} usuarios "
 
-            modal=modal
+              f"(sembrado en {seed_seconds:.1f}s)")
 
-        )
+        for name, summary in operations.items():
 
-       
+            print(f"   {name:<18} {summary['ops_per_sec']:>12,.1f} ops/s   "
 
-        self.send_response(200)
+                  f"p50 {summary['p50_us']:>10,.1f} µs   p99 {summary['p99_us']:>10,.1f} µs")
 
-        self.send_header('Content-type', 'text/html; charset=utf-8')
+    return results
 
-        self.end_headers()
 
-        self.wfile.write(full_html.encode('utf-8'))
+
+def compare_benchmarks(results: Dict[str, any], baseline: Dict[str, any],
+
+                       threshold: float = BENCH_REGRESSION_THRESHOLD) -> List[str]:
+
+    """Imprime la variación frente a la línea base y devuelve las regresiones (> threshold)"""
+
+    regressions = []
+
+    print(f"\n📊 Comparación con la línea base del {baseline.get('generated_at', '?')}")
+
+    for scale, current in results['scales'].items():
+
+        previous = baseline.get('scales', {}).get(scale)
+
+        if previous is None:
+
+            print(f"   {scale}: sin datos en la línea base")
+
+            continue
+
+        for name, summary in current['operations'].items():
+
+            before = previous['operations'].get(name)
+
+            if before is None:
+
+                continue
+
+            ops_change = summary['ops_per_sec'] / before['ops_per_sec'] - 1
+
+            p99_change = summary['p99_us'] / before['p99_us'] - 1 if before['p99_us'] else 0.0
+
+            regressed = ops_change < -threshold or p99_change > threshold
+
+            marker = "⚠️ " if regressed else "  "
+
+            print(f" {marker}{scale:>5} {name:<18} ops/s {ops_change:+7.1%}   p99 {p99_change:+7.1%}")
+
+            if regressed:
+
+                regressions.append(f"{scale}/{name}: ops/s {ops_change:+.1%}, p99 {p99_change:+.1%}")
+
+    return regressions
+
+
+
+def run_benchmarks(args):
+
+    results = benchmark_operations(args.bench, args.bench_samples)
+
+    with open(args.bench_output, 'w') as output:
+
+        json.dump(results, output, indent=2)
+
+    print(f"\n💾 Resultados guardados en {args.bench_output}")
+
+    if not args.bench_baseline:
+
+        return
+
+    if not os.path.exists(args.bench_baseline):
+
+        with open(args.bench_baseline, 'w') as output:
+
+            json.dump(results, output, indent=2)
+
+        print(f"📌 No había línea base: se guardan estos resultados en {args.bench_baseline}")
+
+        return
+
+    with open(args.bench_baseline) as baseline_file:
+
+        regressions = compare_benchmarks(results, json.load(baseline_file), args.bench_threshold)
+
+    if regressions:
+
+        print(f"❌ {len(regressions)} regresiones de más del {args.bench_threshold:.0%}")
+
+        raise SystemExit(1)
+
+    print("✅ Sin regresiones frente a la línea base")
+
+
+
+def parse_args(argv=None):
+
+    parser = argparse.ArgumentParser(description="Sistema P2P Trading")
+
+    parser.add_argument('--reset', action='store_true',
+
+                        help="borra la base de datos y la recrea con datos de ejemplo")
+
+    parser.add_argument('--db', default=DB_NAME, help="fichero SQLite")
+
+    parser.add_argument('--storage-profile', choices=sorted(STORAGE_PROFILES), default=STORAGE_PROFILE,
+
+                        help="perfil de PRAGMAs de SQLite")
+
+    parser.add_argument('--matching', action='store_true', default=MATCHING_ENGINE,
+
+                        help="cruza automáticamente órdenes BUY/SELL con precios que se cruzan")
+
+    parser.add_argument('--bench-matching', action='store_true',
+
+                        help="mide el motor de cruce con 10k/100k órdenes en reposo y sale")
+
+    parser.add_argument('--bench', nargs='+', choices=list(BENCH_SCALES), metavar='ESCALA',
+
+                        help=f"mide las operaciones de P2PSystem a estas escalas ({', '.join(BENCH_SCALES)}) y sale")
+
+    parser.add_argument('--bench-samples', type=int, default=BENCH_SAMPLES,
+
+                        help="llamadas medidas por operación y escala")
+
+    parser.add_argument('--bench-output', default=BENCH_OUTPUT, help="fichero JSON con los resultados")
+
+    parser.add_argument('--bench-baseline',
+
+                        help="JSON de referencia: compara y sale con 1 si hay regresiones (si no existe, lo crea)")
+
+    parser.add_argument('--bench-threshold', type=float, default=BENCH_REGRESSION_THRESHOLD,
+
+                        help="empeoramiento relativo de ops/s o p99 que cuenta como regresión")
+
+    parser.add_argument('--server', choices=SERVER_MODES, default=SERVER_MODE,
+
+                        help="modelo de concurrencia del servidor HTTP")
+
+    parser.add_argument('--port', type=int, default=PORT)
+
+    parser.add_argument('--workers', type=int, default=SERVER_WORKERS,
+
+                        help="hilos del pool (threaded) o del executor de BD (asyncio)")
+
+    parser.add_argument('--backlog', type=int, default=SERVER_BACKLOG,
+
+                        help="backlog de accept y tamaño de la cola de conexiones")
+
+    parser.add_argument('--processes', type=int, default=PREFORK_PROCESSES,
+
+                        help="procesos worker en modo prefork")
+
+    parser.add_argument('--compression-level', type=int, choices=range(0, 10), default=COMPRESSION_LEVEL,
+
+                        metavar='0-9', help="nivel de gzip/deflate de las respuestas (0 desactiva)")
+
+    parser.add_argument('--compression-min-size', type=int, default=COMPRESSION_MIN_SIZE,
+
+                        help="bytes mínimos de una respuesta para comprimirla")
+
+    parser.add_argument('--rate-limit', type=float, default=RATE_LIMIT_SESSION_RATE,
+
+                        help="peticiones de escritura por segundo y sesión (0 desactiva ese bucket)")
+
+    parser.add_argument('--ip-rate-limit', type=float, default=RATE_LIMIT_IP_RATE,
+
+                        help="peticiones de escritura por segundo e IP (0 desactiva ese bucket)")
+
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT,
+
+                        help="peticiones en curso por proceso antes de responder 503")
+
+    parser.add_argument('--kdf', choices=list(PASSWORD_KDFS), default=PASSWORD_KDF,
+
+                        help="KDF para contraseñas nuevas; los hashes con otro KDF se recalculan al hacer login")
+
+    parser.add_argument('--kdf-processes', type=int, default=KDF_PROCESSES,
+
+                        help="procesos dedicados a calcular hashes de contraseñas (en modo single, "
+
+                             "el hash se calcula en el hilo del servidor)")
+
+    parser.add_argument('--log-file', default=LOG_FILE,
+
+                        help="fichero JSON lines del registro de peticiones (rota por tamaño)")
+
+    parser.add_argument('--log-level', choices=list(RequestLog.LEVELS), default=LOG_LEVEL)
+
+    parser.add_argument('--log-sample', type=float, default=LOG_SAMPLE_RATE,
+
+                        help="fracción de registros DEBUG/INFO que se guardan (0-1)")
+
+    return parser.parse_args(argv)
 
 
 
 def main():
 
+    args = parse_args()
+
+    if args.bench_matching:
+
+        benchmark_matching()
+
+        return
+
+    if args.bench:
+
+        run_benchmarks(args)
+
+        return
+
+
+
+    response_cache.level = args.compression_level
+
+    response_cache.min_size = args.compression_min_size
+
+    request_log.configure(args.log_level, args.log_sample)
+
+    admission.session_rate = args.rate_limit
+
+    admission.ip_rate = args.ip_rate_limit
+
+    admission.max_in_flight = args.max_in_flight
+
+    admission.max_streams = stream_limit(args.workers)
+
+    password_pool.kdf = args.kdf
+
+    password_pool.processes = args.kdf_processes
+
+    password_pool.max_pending = kdf_max_pending(args.workers)
+
+    if args.server == 'single':
+
+        # Un solo hilo: cada login bloquea el servidor con o sin pool de procesos
+
+        password_pool.processes = 0
+
+
+
     print("🚀 Iniciando Sistema P2P Trading...")
 
     print(f"🌐 Servidor web: https://alquiler-back-soft-war2-qizb.vercel.app")
@@ -3026,7 +10732,9 @@ def main():
 
     global p2p_system
 
-    p2p_system = P2PSystem()
+    p2p_system = P2PSystem(args.db, storage_profile=args.storage_profile, reset=args.reset,
+
+                           matching=args.matching)
 
    
 
@@ -3038,15 +10746,79 @@ def main():
 
    
 
-    threading.Timer(1.5, open_browser).start()
+    browser = threading.Timer(1.5, open_browser)
 
    
 
     # Iniciar servidor
 
-    with socketserver.TCPServer(("", PORT), P2PRequestHandler) as httpd:
+    if args.server == 'prefork':
+
+        # El padre solo migra/siembra: sus conexiones no deben cruzar el fork, y el
+
+        # temporizador del navegador (un hilo) se arranca después de hacer fork
+
+        p2p_system.pool.close_all()
+
+        print(f"✅ Supervisor pre-fork: {args.processes} procesos en el puerto {args.port} (SO_REUSEPORT)")
+
+        print("⚠️  Presiona Ctrl+C para detener")
+
+        PreforkSupervisor(args, args.processes).run(on_started=browser.start)
+
+        print("\n🛑 Servidor detenido")
+
+        return
+
+
+
+    browser.start()
 
-        print(f"✅ Servidor iniciado en puerto {PORT}")
+
+
+    request_log.start(args.log_file)
+
+    print(f"📝 Registro de peticiones: {args.log_file} (nivel {args.log_level}, muestreo {args.log_sample:g})")
+
+
+
+    if args.server == 'asyncio':
+
+        frontend = AsyncHTTPFrontend(args.port, args.workers, args.backlog)
+
+        print(f"✅ Servidor iniciado en puerto {args.port} (modo asyncio, {args.workers} hilos de BD)")
+
+        print("⚠️  Presiona Ctrl+C para detener")
+
+        try:
+
+            asyncio.run(frontend.serve())
+
+        except KeyboardInterrupt:
+
+            print("\n🛑 Servidor detenido")
+
+        finally:
+
+            frontend.executor.shutdown(wait=False)
+
+            password_pool.shutdown()
+
+            request_log.close()
+
+        return
+
+
+
+    with make_server(args.server, args.port, args.workers, args.backlog) as httpd:
+
+        print(f"✅ Servidor iniciado en puerto {args.port} (modo {args.server})")
+
+        if args.server == 'single':
+
+            print("⚠️  Modo single: los hashes de contraseñas se calculan en el hilo del servidor y cada "
+
+                  "login bloquea al resto; usa --server threaded, asyncio o prefork para atenderlos en paralelo")
 
         print("⚠️  Presiona Ctrl+C para detener")
 
@@ -3058,6 +10830,12 @@ def main():
 
             print("\n🛑 Servidor detenido")
 
+        finally:
+
+            password_pool.shutdown()
+
+            request_log.close()
+
 
 
 if __name__ == "__main__":
@@ -0,0 +1,714 @@
+"""Pruebas unitarias de p2p proyecto.py (python -m pytest -q)"""
+import asyncio
+import http.client
+import importlib.util
+import os
+import socket
+import sqlite3
+import sys
+import threading
+
+import pytest
+
+MODULE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'p2p proyecto.py')
+
+
+def load_module():
+    # El nombre del script lleva un espacio: no se puede importar con `import`
+    spec = importlib.util.spec_from_file_location('p2p_proyecto', MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+p2p = load_module()
+
+
+@pytest.fixture(scope='module')
+def system(tmp_path_factory):
+    """BD nueva (migraciones + datos de ejemplo) en un directorio temporal"""
+    system = p2p.P2PSystem(str(tmp_path_factory.mktemp('db') / 'p2p_test.db'))
+    previous, p2p.p2p_system = p2p.p2p_system, system
+    yield system
+    p2p.p2p_system = previous
+    system.pool.close_all()
+
+
+@pytest.fixture(scope='module')
+def server(system):
+    """Servidor por hilos en un puerto libre; devuelve el puerto"""
+    httpd = p2p.make_server('threaded', 0, 4, 16)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def http_get(port, path, headers=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    try:
+        conn.request('GET', path, headers=headers or {})
+        response = conn.getresponse()
+        response.read()
+        return response.status, dict(response.getheaders())
+    finally:
+        conn.close()
+
+
+def session_cookie(system, user_id=1, username='trader1'):
+    return {'Cookie': f'{p2p.SESSION_COOKIE}={system.sessions.issue(user_id, username)}'}
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('', None),
+    ('gzip', 'gzip'),
+    ('deflate', 'deflate'),
+    ('gzip, deflate', 'gzip'),
+    ('deflate, gzip', 'gzip'),
+    ('gzip;q=0.5, deflate', 'deflate'),
+    ('GZIP; Q=0.8', 'gzip'),
+    ('gzip;q=0', None),
+    ('gzip;q=0, deflate;q=0', None),
+    ('gzip;q=0, *', 'deflate'),
+    ('gzip;q=0.5, *', 'deflate'),
+    ('*', 'gzip'),
+    ('*;q=0', None),
+    ('*;q=0, deflate', 'deflate'),
+    ('br', None),
+    ('identity', None),
+    ('identity;q=0', None),
+    ('gzip;q=0.5, identity', None),
+    ('gzip;q=0.5, identity;q=0', 'gzip'),
+    ('gzip, identity;q=0.5', 'gzip'),
+    ('*;q=0.3, identity;q=0.2', 'gzip'),
+    ('gzip;q=abc', None),
+    ('gzip;q=2, deflate', 'deflate'),
+    ('gzip;q=nan', None),
+])
+def test_negotiate(header, expected):
+    assert p2p.CompressionCache().negotiate(header) == expected
+
+
+def test_dashboard_etag_depends_on_filters_and_cursor(system, server):
+    cookie = session_cookie(system)
+    status, headers = http_get(server, '/dashboard', cookie)
+    assert status == 200
+    etag = headers['ETag']
+    assert http_get(server, '/dashboard', dict(cookie, **{'If-None-Match': etag}))[0] == 304
+    for path in ('/dashboard?asset=BTC', '/dashboard?order_type=SELL', '/dashboard?after=1.0:1'):
+        status, headers = http_get(server, path, dict(cookie, **{'If-None-Match': etag}))
+        assert status == 200, path
+        assert headers['ETag'] != etag
+    # Un filtro desconocido se normaliza al valor por defecto: misma página, mismo validador
+    assert http_get(server, '/dashboard?asset=XYZ', dict(cookie, **{'If-None-Match': etag}))[0] == 304
+
+
+def test_api_orders_etag_depends_on_query(system, server):
+    status, headers = http_get(server, '/api/v1/orders')
+    assert status == 200
+    etag = headers['ETag']
+    assert http_get(server, '/api/v1/orders', {'If-None-Match': etag})[0] == 304
+    for query in ('asset=BTC', 'fiat=EUR', 'order_type=BUY', 'payment_method=PayPal', 'limit=5',
+                  'after=1.0:1'):
+        status, headers = http_get(server, f'/api/v1/orders?{query}', {'If-None-Match': etag})
+        assert status == 200, query
+        assert headers['ETag'] != etag
+
+
+def test_stats_only_from_localhost(server, monkeypatch):
+    assert http_get(server, '/stats')[0] == 200
+    monkeypatch.setattr(p2p.P2PRequestHandler, 'is_local_client', lambda self: False)
+    assert http_get(server, '/stats')[0] == 403
+
+
+def test_session_round_trip_and_revocation(system):
+    token = system.sessions.issue(2, 'trader2')
+    claims = system.verify_session(token)
+    assert claims['user_id'] == '2' and claims['username'] == 'trader2'
+    assert system.revoke_session(token)
+    assert system.verify_session(token) is None
+    # Revocar una sesión no afecta a las demás del mismo usuario
+    assert system.verify_session(system.sessions.issue(2, 'trader2'))['user_id'] == '2'
+
+
+@pytest.mark.parametrize('token', [
+    '',
+    'garbage',
+    '1.a.2.b.é',
+    'é.é.é.é.é',
+    '1.a.2.b.c.d',
+    '....',
+    '1.dHJhZGVyMQ.9999999999.sid.' + 'A' * 43,
+])
+def test_session_rejects_forged_or_garbage_tokens(system, token):
+    assert system.sessions.decode(token) is None
+    assert system.verify_session(token) is None
+
+
+def test_session_rejects_tampered_payload(system):
+    _, rest = system.sessions.issue(1, 'trader1').split('.', 1)
+    assert system.verify_session(f'3.{rest}') is None
+
+
+def test_non_ascii_session_cookie_is_not_a_server_error(server):
+    status, headers = http_get(server, '/dashboard', {'Cookie': 'session=1.a.2.b.é'})
+    assert status == 302
+    assert headers['Location'] == '/login'
+
+
+def test_password_pool_inline_when_no_processes():
+    pool = p2p.PasswordPool(processes=0, max_pending=1)
+    stored = pool.hash('password123')
+    assert pool.verify('password123', stored) == (True, False)
+    assert pool.verify('otra', stored)[0] is False
+    assert pool._executor is None
+    assert pool.stats()['pending'] == 0
+
+
+def test_kdf_max_pending_follows_workers():
+    assert p2p.kdf_max_pending(16) == 8
+    assert p2p.kdf_max_pending(3) == 1
+    assert p2p.kdf_max_pending(1) == 1
+
+
+def make_order(order_id, side, price, quantity=1.0, methods=('Banco',), status=None, user_id=1):
+    return p2p.P2POrder(
+        id=order_id, user_id=user_id, username=f'trader{user_id}', order_type=p2p.OrderType(side),
+        asset='USDT', fiat='USD', price=price, quantity=quantity, available_quantity=quantity,
+        payment_methods=list(methods), status=status or p2p.OrderStatus.PENDING,
+        created_at='2024-01-01T00:00:00', min_amount=0.0, max_amount=1e9
+    )
+
+
+@pytest.fixture
+def book():
+    book = p2p.OrderBook('USDT', 'USD')
+    for order in (make_order(1, 'BUY', 0.98), make_order(2, 'BUY', 0.99, methods=('PayPal',)),
+                  make_order(3, 'BUY', 0.98, quantity=2.0), make_order(4, 'SELL', 1.02),
+                  make_order(5, 'SELL', 1.01, methods=('Banco', 'PayPal')), make_order(6, 'SELL', 1.02)):
+        book.add(order)
+    return book
+
+
+def test_order_book_price_time_priority(book):
+    assert [o.id for o in book.orders(p2p.OrderType.BUY)] == [2, 1, 3]
+    assert [o.id for o in book.orders(p2p.OrderType.SELL)] == [5, 4, 6]
+    assert [o.id for o in book.orders(p2p.OrderType.SELL, limit=2)] == [5, 4]
+    assert [o.id for o in book.iter_orders(p2p.OrderType.BUY)] == [2, 1, 3]
+
+
+def test_order_book_depth_and_snapshot(book):
+    assert book.depth(p2p.OrderType.BUY) == [(0.99, 1.0, 1), (0.98, 3.0, 2)]
+    assert book.depth(p2p.OrderType.SELL, levels=1) == [(1.01, 1.0, 1)]
+    version, sides = book.snapshot(levels=1)
+    assert version == book.version == 6
+    assert sides[p2p.OrderType.SELL] == [(1.01, 1.0, 1)]
+
+
+def test_order_book_late_older_order_keeps_time_priority():
+    book = p2p.OrderBook('USDT', 'USD')
+    book.add(make_order(9, 'SELL', 1.0))
+    book.add(make_order(7, 'SELL', 1.0))
+    assert [o.id for o in book.orders(p2p.OrderType.SELL)] == [7, 9]
+
+
+def test_order_book_ignores_closed_orders(book):
+    book.add(make_order(10, 'BUY', 0.97, status=p2p.OrderStatus.FILLED))
+    book.add(make_order(11, 'BUY', 0.97, quantity=0.0))
+    assert len(book) == 6 and book.get(10) is None
+
+
+def test_order_book_update_and_remove(book):
+    version = book.version
+    updated = book.update(1, 0.5, p2p.OrderStatus.PARTIALLY_FILLED)
+    assert updated.available_quantity == 0.5 and book.get(1) is updated
+    # Sustituir una orden conserva su puesto en el nivel
+    assert [o.id for o in book.orders(p2p.OrderType.BUY)] == [2, 1, 3]
+    assert book.update(1, 0.0, p2p.OrderStatus.FILLED) is None
+    assert book.get(1) is None
+    assert book.remove(5).id == 5 and book.remove(5) is None
+    assert book.depth(p2p.OrderType.SELL) == [(1.02, 2.0, 2)]
+    assert book.page(payment_method='PayPal') == [book.get(2)]
+    assert book.version == version + 3
+    assert book.update(99, 1.0, p2p.OrderStatus.PENDING) is None
+
+
+def test_order_book_page_by_price_and_id(book):
+    assert [o.id for o in book.page()] == [1, 3, 2, 5, 4, 6]
+    assert [o.id for o in book.page(limit=3)] == [1, 3, 2]
+    assert [o.id for o in book.page(after=(0.98, 1))] == [3, 2, 5, 4, 6]
+    assert [o.id for o in book.page(after=(0.99, 2), limit=2)] == [5, 4]
+    assert [o.id for o in book.page(p2p.OrderType.SELL, after=(1.02, 4))] == [6]
+    assert [o.id for o in book.page(p2p.OrderType.BUY, after=(0.98, 3))] == [2]
+    assert [o.id for o in book.page(payment_method='PayPal')] == [2, 5]
+    assert [o.id for o in book.page(p2p.OrderType.SELL, payment_method='Banco')] == [5, 4, 6]
+    assert [o.id for o in book.page(payment_method='Banco', after=(1.01, 5))] == [4, 6]
+
+
+@pytest.fixture
+def matching_system(tmp_path):
+    """Motor de cruce con el libro USDT/USD vacío (los anuncios de ejemplo se cancelan)"""
+    system = p2p.P2PSystem(str(tmp_path / 'matching.db'), matching=True)
+    with system.pool.connection() as conn:
+        conn.execute("UPDATE p2p_orders SET status = 'CANCELLED'")
+        conn.commit()
+    system.load_order_books()
+    yield system
+    system.pool.close_all()
+
+
+def wallet(system, user_id, asset):
+    return system.get_user_balance(user_id)[asset]
+
+
+def test_matching_fills_in_price_time_order(matching_system):
+    system = matching_system
+    first = system.create_order(1, 'SELL', 'USDT', 'USD', 1.00, 10, ['Banco'], 0, 1e9)
+    worse = system.create_order(1, 'SELL', 'USDT', 'USD', 1.01, 10, ['Banco'], 0, 1e9)
+    second = system.create_order(3, 'SELL', 'USDT', 'USD', 1.00, 5, ['Banco'], 0, 1e9)
+    buy = system.create_order(2, 'BUY', 'USDT', 'USD', 1.01, 18, ['Banco'], 0, 1e9)
+    assert buy is not None
+
+    with system.pool.connection() as conn:
+        trades = conn.execute('SELECT order_id, seller_id, price, quantity, status FROM trades '
+                              'ORDER BY id').fetchall()
+        statuses = dict(conn.execute('SELECT id, status FROM p2p_orders WHERE id IN (?, ?, ?, ?)',
+                                     (first, worse, second, buy)).fetchall())
+    assert trades == [(first, 1, 1.00, 10.0, 'COMPLETED'), (second, 3, 1.00, 5.0, 'COMPLETED'),
+                      (worse, 1, 1.01, 3.0, 'COMPLETED')]
+    assert statuses == {first: 'FILLED', second: 'FILLED', worse: 'PARTIALLY_FILLED', buy: 'FILLED'}
+    assert [(o.id, o.available_quantity) for o in system.get_orders('USDT', 'USD')] == [(worse, 7.0)]
+    assert system.engine_stats['matches'] == 3
+    assert system.engine_stats['matched_quantity'] == pytest.approx(18.0)
+
+
+def test_matching_settles_wallets_at_resting_price(matching_system):
+    system = matching_system
+    system.create_order(1, 'SELL', 'USDT', 'USD', 1.00, 10, ['Banco'], 0, 1e9)
+    # Límite 1.05, cruce a 1.00: la mejora de precio vuelve al saldo del comprador
+    system.create_order(2, 'BUY', 'USDT', 'USD', 1.05, 4, ['Banco'], 0, 1e9)
+    assert wallet(system, 2, 'USDT') == {'available': 5004.0, 'locked': 0.0, 'total': 5004.0}
+    assert wallet(system, 2, 'USD')['available'] == pytest.approx(9996.0)
+    assert wallet(system, 2, 'USD')['locked'] == pytest.approx(0.0)
+    assert wallet(system, 1, 'USDT') == {'available': 4990.0, 'locked': 6.0, 'total': 4996.0}
+    assert wallet(system, 1, 'USD')['available'] == pytest.approx(10004.0)
+    assert system.user_stats(1).completed_trades == system.user_stats(2).completed_trades == 1
+
+
+def test_matching_skips_own_orders_and_non_crossing_prices(matching_system):
+    system = matching_system
+    own = system.create_order(1, 'SELL', 'USDT', 'USD', 1.00, 5, ['Banco'], 0, 1e9)
+    high = system.create_order(3, 'SELL', 'USDT', 'USD', 1.10, 5, ['Banco'], 0, 1e9)
+    buy = system.create_order(1, 'BUY', 'USDT', 'USD', 1.05, 5, ['Banco'], 0, 1e9)
+    book = system.get_book('USDT', 'USD')
+    assert {o.id for o in book.page()} == {own, high, buy}
+    assert system.engine_stats['matches'] == 0
+    # Tras recargar desde SQLite el libro es el mismo
+    system.load_order_books()
+    assert {o.id for o in system.get_book('USDT', 'USD').page()} == {own, high, buy}
+
+
+def test_router_static_and_typed_params():
+    router = p2p.Router()
+    router.add('GET', '/items', 'list_items')
+    router.add('GET', '/items/<int:item_id>', 'get_item')
+    router.add('GET', '/items/<int:item_id>/price/<float:price>', 'price_item')
+    router.add('GET', '/files/<name>', 'get_file')
+    router.add('POST', '/items/<int:item_id>', 'update_item')
+
+    assert router.match('GET', '/items') == ('list_items', {})
+    assert router.match('GET', '/items/42') == ('get_item', {'item_id': 42})
+    assert router.match('GET', '/items/7/price/1.5') == ('price_item', {'item_id': 7, 'price': 1.5})
+    assert router.match('GET', '/files/app.v1.css') == ('get_file', {'name': 'app.v1.css'})
+    assert router.match('POST', '/items/3') == ('update_item', {'item_id': 3})
+    for method, path in (('GET', '/items/abc'), ('GET', '/items/42/'), ('GET', '/items/1/price/x'),
+                         ('GET', '/files/a/b'), ('POST', '/items'), ('GET', '/nothing')):
+        assert router.match(method, path) is None, (method, path)
+    assert router.allowed_methods('/items/3') == ['GET', 'POST']
+    assert router.allowed_methods('/items') == ['GET']
+    assert router.allowed_methods('/nothing') == []
+
+
+def test_routes_point_to_existing_handlers():
+    handlers = set(p2p.ROUTES._static.values())
+    handlers.update(handler for bucket in p2p.ROUTES._dynamic.values() for _, handler, _ in bucket)
+    missing = [name for name in handlers if not callable(getattr(p2p.P2PRequestHandler, name, None))]
+    assert missing == []
+    assert p2p.ROUTES.match('GET', '/trade_status/12/stream') == ('stream_trade_status', {'trade_id': 12})
+
+
+def test_dispatch_answers_404_and_405(server):
+    assert http_get(server, '/no-existe')[0] == 404
+    conn = http.client.HTTPConnection('127.0.0.1', server, timeout=5)
+    try:
+        conn.request('POST', '/dashboard', body=b'', headers={'Content-Length': '0'})
+        response = conn.getresponse()
+        response.read()
+        assert response.status == 405
+        assert response.getheader('Allow') == 'GET'
+    finally:
+        conn.close()
+
+
+def client_frame(opcode, payload, fin=True, mask=b'\x01\x02\x03\x04'):
+    """Frame enmascarado, como lo envía un navegador"""
+    length = len(payload)
+    first = (0x80 if fin else 0) | opcode
+    if length < 126:
+        head = bytes([first, 0x80 | length])
+    elif length < 65536:
+        head = bytes([first, 0x80 | 126]) + length.to_bytes(2, 'big')
+    else:
+        head = bytes([first, 0x80 | 127]) + length.to_bytes(8, 'big')
+    return head + mask + bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+
+
+def test_ws_handshake_accept_key():
+    # Ejemplo de la RFC 6455, sección 1.3
+    response = p2p.ws_handshake('dGhlIHNhbXBsZSBub25jZQ==')
+    assert response.startswith(b'HTTP/1.1 101 Switching Protocols\r\n')
+    assert b'Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=\r\n' in response
+    assert response.endswith(b'\r\n\r\n')
+
+
+@pytest.mark.parametrize('size, head', [
+    (5, b'\x81\x05'),
+    (200, b'\x81\x7e\x00\xc8'),
+    (70000, b'\x81\x7f' + (70000).to_bytes(8, 'big')),
+])
+def test_ws_frame_length_encoding(size, head):
+    frame = p2p.ws_frame(p2p.WS_TEXT, b'x' * size)
+    assert frame == head + b'x' * size
+
+
+def test_ws_close_frame():
+    assert p2p.ws_close_frame(1000) == b'\x88\x02\x03\xe8'
+
+
+@pytest.mark.parametrize('size', [0, 5, 125, 126, 300, 65535, 65536])
+def test_ws_parser_round_trip(size):
+    payload = bytes(i % 251 for i in range(size))
+    parser = p2p.WebSocketParser(max_message=70000)
+    assert parser.feed(client_frame(p2p.WS_TEXT, payload)) == [(p2p.WS_TEXT, payload)]
+
+
+def test_ws_parser_partial_reads():
+    parser = p2p.WebSocketParser()
+    data = client_frame(p2p.WS_TEXT, b'{"op":"subscribe"}') + client_frame(p2p.WS_PING, b'hi')
+    messages = []
+    for i in range(len(data)):
+        messages += parser.feed(data[i:i + 1])
+    assert messages == [(p2p.WS_TEXT, b'{"op":"subscribe"}'), (p2p.WS_PING, b'hi')]
+
+
+def test_ws_parser_fragments_with_interleaved_control_frame():
+    parser = p2p.WebSocketParser()
+    data = (client_frame(p2p.WS_TEXT, b'hola ', fin=False) + client_frame(p2p.WS_PING, b'')
+            + client_frame(0x0, b'mun', fin=False) + client_frame(0x0, b'do'))
+    assert parser.feed(data) == [(p2p.WS_PING, b''), (p2p.WS_TEXT, b'hola mundo')]
+
+
+def test_ws_parser_rejects_unmasked_frames():
+    with pytest.raises(p2p.WebSocketError) as error:
+        p2p.WebSocketParser().feed(p2p.ws_frame(p2p.WS_TEXT, b'x'))
+    assert error.value.code == 1002
+
+
+def test_ws_parser_rejects_oversized_messages():
+    with pytest.raises(p2p.WebSocketError) as error:
+        # Se rechaza con solo la cabecera, sin esperar al cuerpo
+        p2p.WebSocketParser(max_message=100).feed(client_frame(p2p.WS_TEXT, b'x' * 101)[:8])
+    assert error.value.code == 1009
+    parser = p2p.WebSocketParser(max_message=100)
+    parser.feed(client_frame(p2p.WS_TEXT, b'x' * 60, fin=False))
+    with pytest.raises(p2p.WebSocketError) as error:
+        parser.feed(client_frame(0x0, b'x' * 60))
+    assert error.value.code == 1009
+
+
+def make_v1_database(path):
+    """BD con solo la migración 1 aplicada y algo de histórico, como la dejaba una versión antigua"""
+    conn = sqlite3.connect(path)
+    p2p.P2PSystem._migration_base_tables(None, conn.cursor())
+    now = '2024-01-01T00:00:00'
+    conn.executemany('INSERT INTO users (username, email, password_hash, created_at) VALUES (?, ?, ?, ?)',
+                     [('ana', 'ana@example.com', 'legacy', now), ('bob', 'bob@example.com', 'legacy', now)])
+    conn.execute('''
+        INSERT INTO p2p_orders (user_id, order_type, asset, fiat, price, quantity, available_quantity,
+                                payment_methods, status, min_amount, max_amount, created_at)
+        VALUES (1, 'SELL', 'USDT', 'USD', 1.0, 10, 4, '["Banco"]', 'PARTIALLY_FILLED', 0, 100, ?)
+    ''', (now,))
+    conn.executemany('''
+        INSERT INTO trades (buyer_id, seller_id, order_id, asset, fiat, price, quantity, amount, status, created_at)
+        VALUES (2, 1, 1, 'USDT', 'USD', 1.0, ?, ?, ?, ?)
+    ''', [(4, 4.0, 'COMPLETED', now), (2, 2.0, 'COMPLETED', now), (1, 1.0, 'CANCELLED', now),
+          (3, 3.0, 'PENDING_PAYMENT', now)])
+    conn.execute('PRAGMA user_version = 1')
+    conn.commit()
+    conn.close()
+
+
+def test_migrations_upgrade_v1_database(tmp_path):
+    path = str(tmp_path / 'legacy.db')
+    make_v1_database(path)
+    # Índice cubriente que creaban las versiones con la consulta del libro en SQLite
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE INDEX idx_orders_book ON p2p_orders (asset, fiat, status, price)')
+    conn.commit()
+    conn.close()
+    system = p2p.P2PSystem(path)
+    try:
+        with system.pool.connection() as conn:
+            assert conn.execute('PRAGMA user_version').fetchone()[0] == p2p.P2PSystem.SCHEMA_VERSION == 6
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(trades)')}
+            usernames = [row[0] for row in conn.execute('SELECT username FROM users ORDER BY id')]
+        assert {'order_events', 'app_secrets', 'revoked_sessions', 'user_stats'} <= tables
+        assert set(p2p.MANAGED_INDEXES) <= indexes
+        assert 'idx_orders_book' not in indexes
+        assert 'completed_at' in columns
+        # Una BD existente no recibe datos de ejemplo
+        assert usernames == ['ana', 'bob']
+        # user_stats rellenado con el histórico: solo trades terminados
+        seller, buyer = system.user_stats(1), system.user_stats(2)
+        assert (seller.completed_trades, seller.cancelled_trades) == (2, 0)
+        assert (buyer.completed_trades, buyer.cancelled_trades) == (2, 1)
+        assert seller.volume == {'USDT': 6.0, 'USD': 6.0}
+        assert [o.id for o in system.get_orders('USDT', 'USD')] == [1]
+    finally:
+        system.pool.close_all()
+
+    # Un segundo arranque no vuelve a migrar
+    reopened = p2p.P2PSystem(path)
+    try:
+        with reopened.pool.connection() as conn:
+            assert reopened._migrate(conn) == []
+        assert reopened.user_stats(1).completed_trades == 2
+    finally:
+        reopened.pool.close_all()
+
+
+def test_migrations_refuse_newer_schema(tmp_path):
+    path = str(tmp_path / 'future.db')
+    make_v1_database(path)
+    conn = sqlite3.connect(path)
+    conn.execute(f'PRAGMA user_version = {p2p.P2PSystem.SCHEMA_VERSION + 1}')
+    conn.commit()
+    conn.close()
+    with pytest.raises(RuntimeError, match='más nuevo'):
+        p2p.P2PSystem(path)
+
+
+def raw_request(port, request: bytes) -> bytes:
+    """Respuesta completa de una petición en bruto; el servidor debe cerrar la conexión"""
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+        sock.sendall(request)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+
+@pytest.fixture
+def single_server(system):
+    """Servidor de un solo hilo (sin keep-alive); devuelve el puerto"""
+    httpd = p2p.make_server('single', 0)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.mark.parametrize('request_bytes, status', [
+    (b'POST /login HTTP/1.1\r\nHost: x\r\nContent-Length: abc\r\n\r\n', b'400'),
+    (b'GET /no-existe HTTP/1.1\r\nHost: x\r\n\r\n', b'404'),
+    (b'GET /login HTTP/1.1\r\nHost: x\r\n\r\n', b'200'),
+])
+def test_single_server_sends_connection_close_once(single_server, request_bytes, status):
+    response = raw_request(single_server, request_bytes)
+    head = response.split(b'\r\n\r\n', 1)[0].lower()
+    assert head.startswith(b'http/1.1 ' + status)
+    assert head.count(b'\r\nconnection: close') == 1
+
+
+def test_error_after_headers_closes_instead_of_second_status(server, monkeypatch):
+    def broken(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '10')
+        self.end_headers()
+        raise RuntimeError('fallo a mitad de respuesta')
+    monkeypatch.setattr(p2p.P2PRequestHandler, 'serve_root', broken)
+    response = raw_request(server, b'GET / HTTP/1.1\r\nHost: x\r\n\r\n')
+    assert response.startswith(b'HTTP/1.1 200')
+    assert response.count(b'HTTP/1.') == 1
+
+
+def wait_for_streams(kind, expected):
+    for _ in range(100):
+        if p2p.admission.stats()['open_streams'][kind] == expected:
+            return True
+        threading.Event().wait(0.02)
+    return False
+
+
+def test_sse_beyond_stream_cap_answers_once_and_closes(system, server, monkeypatch):
+    trade_id = 424242
+    monkeypatch.setattr(p2p.admission, 'max_streams', 1)
+    monkeypatch.setattr(system, 'get_trade_status', lambda tid: 'PENDING_PAYMENT')
+    request = f'GET /trade_status/{trade_id}/stream HTTP/1.1\r\nHost: x\r\n\r\n'.encode('ascii')
+    with socket.create_connection(('127.0.0.1', server), timeout=5) as held:
+        held.sendall(request)
+        received = b''
+        while b'event: status' not in received:
+            received += held.recv(65536)
+        assert wait_for_streams('sse', 1)
+        # Cupo lleno: estado actual, retry: y cierre, sin quedarse con otro hilo
+        response = raw_request(server, request)
+        assert response.startswith(b'HTTP/1.1 200')
+        assert b'retry: ' in response and b'PENDING_PAYMENT' in response
+        system.events.publish(p2p.P2PSystem.trade_topic(trade_id), 'COMPLETED')
+        while b'COMPLETED' not in received:
+            received += held.recv(65536)
+    assert wait_for_streams('sse', 0)
+
+
+WS_UPGRADE = {'Upgrade': 'websocket', 'Connection': 'Upgrade', 'Sec-WebSocket-Version': '13',
+              'Sec-WebSocket-Key': 'dGhlIHNhbXBsZSBub25jZQ=='}
+
+
+def test_ws_feed_beyond_stream_cap_is_rejected(server, monkeypatch):
+    monkeypatch.setattr(p2p.admission, 'max_streams', 1)
+    head = ''.join(f'{key}: {value}\r\n' for key, value in WS_UPGRADE.items())
+    with socket.create_connection(('127.0.0.1', server), timeout=5) as held:
+        held.sendall(f'GET /ws/market HTTP/1.1\r\nHost: x\r\n{head}\r\n'.encode('ascii'))
+        received = b''
+        while b'\r\n\r\n' not in received:
+            received += held.recv(65536)
+        assert received.startswith(b'HTTP/1.1 101')
+        assert wait_for_streams('ws', 1)
+        status, headers = http_get(server, '/ws/market', WS_UPGRADE)
+        assert status == 503
+        assert int(headers['Retry-After']) >= 1
+        assert headers['Connection'] == 'close'
+        # /login sigue respondiendo con el feed abierto
+        assert http_get(server, '/login')[0] == 200
+        held.sendall(client_frame(p2p.WS_CLOSE, (1000).to_bytes(2, 'big')))
+        assert wait_for_streams('ws', 0)
+
+
+def test_ws_frames_sent_with_the_handshake_are_not_lost(server):
+    head = ''.join(f'{key}: {value}\r\n' for key, value in WS_UPGRADE.items())
+    request = f'GET /ws/market HTTP/1.1\r\nHost: x\r\n{head}\r\n'.encode('ascii')
+    with socket.create_connection(('127.0.0.1', server), timeout=5) as sock:
+        # El ping llega en el mismo segmento que la petición y acaba en el buffer de rfile
+        sock.sendall(request + client_frame(p2p.WS_PING, b'eco'))
+        received = b''
+        while p2p.ws_frame(p2p.WS_PONG, b'eco') not in received:
+            chunk = sock.recv(65536)
+            assert chunk, received
+            received += chunk
+        assert received.startswith(b'HTTP/1.1 101')
+        sock.sendall(client_frame(p2p.WS_CLOSE, (1000).to_bytes(2, 'big')))
+
+
+def test_throttle_disabling_session_bucket_keeps_ip_bucket():
+    control = p2p.AdmissionControl(session_rate=0, ip_rate=1.0, ip_burst=2)
+    assert control.throttle('sid-a', '10.0.0.1') == (None, 0.0)
+    assert control.throttle('sid-b', '10.0.0.1') == (None, 0.0)
+    assert control.throttle('sid-c', '10.0.0.1')[0] == 'ip'
+    assert control.throttle(None, '10.0.0.2') == (None, 0.0)
+    assert control.stats()['rejected']['ip'] == 1
+
+
+def test_throttle_session_buckets_are_per_session():
+    control = p2p.AdmissionControl(session_rate=1.0, session_burst=1, ip_rate=0)
+    assert control.throttle('sid-a', '10.0.0.1') == (None, 0.0)
+    assert control.throttle('sid-a', '10.0.0.1')[0] == 'session'
+    # Otra sesión (aunque sea del mismo usuario) tiene su propio bucket
+    assert control.throttle('sid-b', '10.0.0.1') == (None, 0.0)
+    assert p2p.AdmissionControl(session_rate=0, ip_rate=0).throttle('sid-a', '10.0.0.1') == (None, 0.0)
+
+
+def test_password_pool_dummy_hash_is_lazy_and_cached():
+    pool = p2p.PasswordPool(processes=0, max_pending=1)
+    assert pool._dummy_hash is None
+    dummy = pool.dummy_hash()
+    assert pool.dummy_hash() is dummy
+    assert pool.verify('password123', dummy)[0] is False
+    pool.record_rehash(2)
+    assert pool.stats()['rehashed'] == 2 and pool.stats()['hashed'] == 0
+
+
+def test_unknown_user_login_compares_against_dummy_hash(system, monkeypatch):
+    pool = p2p.PasswordPool(processes=0)
+    monkeypatch.setattr(p2p, 'password_pool', pool)
+    assert system.authenticate_user('no-existe', 'password123') is None
+    assert pool._dummy_hash is not None and pool.stats()['verified'] == 1
+
+
+def test_async_frontend_builds_responses_through_frame_response():
+    frontend = p2p.AsyncHTTPFrontend(port=0, workers=1)
+    try:
+        framed = frontend._frame_response(frontend._body_error_response(p2p.RequestBodyError('mal', 400)), False)
+        assert framed == (b'HTTP/1.1 400 Bad Request\r\nContent-Type: text/plain; charset=utf-8\r\n'
+                          b'Content-Length: 3\r\nConnection: close\r\n\r\nmal')
+        overload = frontend._frame_response(frontend._overload_response(), True)
+        assert overload.startswith(b'HTTP/1.1 503 Service Unavailable\r\n')
+        assert b'\r\nRetry-After: 1\r\n' in overload and b'\r\nConnection: keep-alive\r\n' in overload
+    finally:
+        frontend.executor.shutdown()
+
+
+def test_async_frontend_counts_queued_executor_work():
+    frontend = p2p.AsyncHTTPFrontend(port=0, workers=1)
+    release = threading.Event()
+
+    async def scenario():
+        first = asyncio.ensure_future(frontend._in_executor(release.wait, 5))
+        second = asyncio.ensure_future(frontend._in_executor(lambda: 'hecho'))
+        third = asyncio.ensure_future(frontend._in_executor(lambda: 'cancelada'))
+        await asyncio.sleep(0.05)
+        # Un hilo ocupado con la primera: las otras dos esperan en la cola
+        assert frontend.stats()['executor_queue'] == 2
+        third.cancel()
+        await asyncio.sleep(0)
+        assert frontend.stats()['executor_queue'] == 1
+        release.set()
+        assert await first is True and await second == 'hecho'
+        assert frontend.stats()['executor_queue'] == 0
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        release.set()
+        frontend.executor.shutdown()
+
+
+def test_compression_cache_keys_on_digest_not_body():
+    cache = p2p.CompressionCache(level=6, min_size=0, size=2)
+    body = b'<html>' + b'orden ' * 500 + b'</html>'
+    first = cache.compress(body, 'gzip')
+    assert cache.compress(bytes(body), 'gzip') is first
+    assert cache.compress(body, 'deflate') is not first
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 2
+    assert all(len(key[1]) == 16 for key in cache._entries)
+    assert p2p.gzip.decompress(first) == body
+
+
+def test_hot_query_plans_use_indexes(system):
+    plans = system.check_query_plans()
+    assert set(plans) == set(p2p.HOT_QUERIES)
+    assert any('idx_orders_status' in detail for detail in plans['open_orders'])
+    assert any('idx_wallets_user_asset' in detail for detail in plans['wallet_balance'])
+
+
+def test_query_plan_guard_rejects_a_scan(system, monkeypatch):
+    monkeypatch.setitem(p2p.HOT_QUERIES, 'by_price', ('SELECT id FROM p2p_orders WHERE price = ?', (1.0,)))
+    with pytest.raises(p2p.QueryPlanError, match='by_price'):
+        system.check_query_plans()